@@ -1,35 +1,166 @@
-from fastapi import FastAPI, APIRouter, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, APIRouter, Header, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, FileResponse, ORJSONResponse, StreamingResponse
 from dotenv import load_dotenv
+from starlette.datastructures import MutableHeaders
 from starlette.middleware.cors import CORSMiddleware
 import asyncpg
+import asyncio
+import io
 import os
+import re
 import json
+import base64
+import hashlib
+import gzip
+import mimetypes
 import logging
+import math
+import time
+import bisect
+import html
+import tempfile
+from abc import ABC, abstractmethod
+from string import Template
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import lru_cache, partial
 from pathlib import Path
-from pydantic import BaseModel, ConfigDict
-from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from pydantic import BaseModel, ConfigDict, Field
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 import uuid
 from datetime import datetime, timezone
 from google import genai
+from PIL import Image, ImageDraw, ImageFont, ImageOps, UnidentifiedImageError
+from python_multipart.exceptions import FormParserError
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 API_KEYS = []
+API_KEY_NAMES = []
 for key_name in ['GOOGLE_API_KEY', 'GOOGLE_API_KEY1', 'GOOGLE_API_KEY2', 'GOOGLE_API_KEY3', 'GEMINI_API_KEY']:
     key = os.environ.get(key_name)
     if key:
         API_KEYS.append(key)
+        API_KEY_NAMES.append(key_name)
+
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-2.0-flash')
+GEMINI_BASE_URL = os.environ.get('GEMINI_BASE_URL', '')
+GEMINI_MAX_CONCURRENCY = int(os.environ.get('GEMINI_MAX_CONCURRENCY', '8'))
+KEY_BREAKER_THRESHOLD = int(os.environ.get('KEY_BREAKER_THRESHOLD', '3'))
+KEY_BREAKER_COOLDOWN = float(os.environ.get('KEY_BREAKER_COOLDOWN', '30'))
+KEY_THROTTLE_COOLDOWN = float(os.environ.get('KEY_THROTTLE_COOLDOWN', '60'))
+KEY_ERROR_WINDOW = int(os.environ.get('KEY_ERROR_WINDOW', '50'))
+
+GENERATION_CACHE_SIZE = int(os.environ.get('GENERATION_CACHE_SIZE', '1024'))
+GENERATION_CACHE_TTL = float(os.environ.get('GENERATION_CACHE_TTL', '86400'))
+GENERATION_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('GENERATION_CACHE_MAX_ENTRY_BYTES', '65536'))
+GENERATION_CACHE_DB = os.environ.get('GENERATION_CACHE_DB', '').lower() in ('1', 'true', 'yes')
+GENERATION_BUDGET_SECONDS = float(os.environ.get('GENERATION_BUDGET_SECONDS', '12'))
+GENERATION_UPGRADE = os.environ.get('GENERATION_UPGRADE', 'true').lower() in ('1', 'true', 'yes')
+PROMPT_CONTEXT_TOKENS = int(os.environ.get('PROMPT_CONTEXT_TOKENS', '400'))
+PROMPT_CUSTOM_TOKENS = int(os.environ.get('PROMPT_CUSTOM_TOKENS', '200'))
+PROMPT_NAME_TOKENS = int(os.environ.get('PROMPT_NAME_TOKENS', '16'))
+CARD_MAX_OUTPUT_TOKENS = int(os.environ.get('CARD_MAX_OUTPUT_TOKENS', '700'))
+LETTER_MAX_OUTPUT_TOKENS = os.environ.get('LETTER_MAX_OUTPUT_TOKENS', '')
+
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRY_BYTES', str(1024 * 1024)))
+RESPONSE_CACHE_MAX_AGE = int(os.environ.get('RESPONSE_CACHE_MAX_AGE', '2592000'))
 
 DATABASE_URL = os.environ.get('DATABASE_URL', '')
+RUN_MIGRATIONS_ON_STARTUP = os.environ.get('RUN_MIGRATIONS_ON_STARTUP', '').lower() in ('1', 'true', 'yes')
+MIGRATION_LOCK_TIMEOUT_MS = int(os.environ.get('MIGRATION_LOCK_TIMEOUT_MS', '5000'))
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '10'))
+DB_ACQUIRE_TIMEOUT = float(os.environ.get('DB_ACQUIRE_TIMEOUT', '5'))
+DB_COMMAND_TIMEOUT = float(os.environ.get('DB_COMMAND_TIMEOUT', '10'))
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', '10000'))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', '100'))
+BLOB_STORE_BACKEND = os.environ.get('BLOB_STORE_BACKEND', 'local').lower()
+BLOB_STORE_DIR = Path(os.environ.get('BLOB_STORE_DIR') or ROOT_DIR / 'blobs')
+IMAGE_FORMAT = os.environ.get('IMAGE_FORMAT', 'WEBP').upper()
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', str(min(2, os.cpu_count() or 1))))
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', str(50_000_000)))
+IMAGE_MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', '4096'))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '500'))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '8'))
+BATCH_WRITE_SIZE = int(os.environ.get('BATCH_WRITE_SIZE', '50'))
+API_COMPRESSION_ENCODINGS = [
+    encoding.strip() for encoding in os.environ.get('API_COMPRESSION_ENCODINGS', 'br,gzip').split(',')
+    if encoding.strip() in ('br', 'gzip') and (encoding.strip() != 'br' or brotli is not None)
+]
+API_COMPRESSION_MIN_BYTES = int(os.environ.get('API_COMPRESSION_MIN_BYTES', '1024'))
+API_GZIP_LEVEL = int(os.environ.get('API_GZIP_LEVEL', '6'))
+API_BROTLI_QUALITY = int(os.environ.get('API_BROTLI_QUALITY', '4'))
+API_COMPRESSION_CACHE_BYTES = int(os.environ.get('API_COMPRESSION_CACHE_BYTES', str(16 * 1024 * 1024)))
+API_COMPRESSION_THREAD_BYTES = int(os.environ.get('API_COMPRESSION_THREAD_BYTES', str(256 * 1024)))
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory').lower()
+RATE_LIMIT_PER_MINUTE = float(os.environ.get('RATE_LIMIT_PER_MINUTE', '30'))
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', '20'))
+RATE_LIMIT_PROXY_HOPS = int(os.environ.get('RATE_LIMIT_PROXY_HOPS', '0'))
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', '100000'))
+API_TOKENS = {token.strip() for token in os.environ.get('API_TOKENS', '').split(',') if token.strip()}
+GENERATION_MAX_IN_FLIGHT = int(os.environ.get('GENERATION_MAX_IN_FLIGHT', '32'))
+ADMISSION_POLL_INTERVAL = 0.05
+UPLOAD_MAX_REQUEST_BYTES = int(os.environ.get('UPLOAD_MAX_REQUEST_BYTES', str(40 * 1024 * 1024)))
+UPLOAD_MAX_PHOTO_BYTES = int(os.environ.get('UPLOAD_MAX_PHOTO_BYTES', str(10 * 1024 * 1024)))
+UPLOAD_ORPHAN_HOURS = float(os.environ.get('UPLOAD_ORPHAN_HOURS', '24'))
+UPLOAD_MAX_PHOTOS = int(os.environ.get('UPLOAD_MAX_PHOTOS', '10'))
+UPLOAD_SPOOL_BYTES = int(os.environ.get('UPLOAD_SPOOL_BYTES', str(1024 * 1024)))
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', '').rstrip('/')
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', '3600'))
+CLUSTER_EVENTS = os.environ.get('CLUSTER_EVENTS', 'true').lower() in ('1', 'true', 'yes')
+CLUSTER_PING_INTERVAL = float(os.environ.get('CLUSTER_PING_INTERVAL', '30'))
+CLUSTER_RECONNECT_DELAY = float(os.environ.get('CLUSTER_RECONNECT_DELAY', '5'))
+RETENTION_DAYS = float(os.environ.get('RETENTION_DAYS', '0'))
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', '3600'))
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '200'))
+RETENTION_BATCH_PAUSE = float(os.environ.get('RETENTION_BATCH_PAUSE', '0.1'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+JOB_QUEUE_CAPACITY = int(os.environ.get('JOB_QUEUE_CAPACITY', '500'))
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', '120'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', '5'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '1'))
 
 db_pool: Optional[asyncpg.Pool] = None
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+REQUEST_PHASES = ("llm", "db", "json")
+request_phases: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_phases", default=None)
+
+
+def record_phase(phase: str, seconds: float):
+    phases = request_phases.get()
+    if phases is not None:
+        phases[phase] += seconds
+
+
+@contextmanager
+def timed_phase(phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - start)
 
 app = FastAPI()
 
-api_router = APIRouter(prefix="/api")
+api_router = APIRouter(prefix="/api", default_response_class=ORJSONResponse if orjson is not None else JSONResponse)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -43,6 +174,11 @@ class CardCreate(BaseModel):
     description: str
     photos: List[str]
     sender_name: str
+    use_cache: Optional[bool] = True
+
+
+class CardBatchCreate(BaseModel):
+    cards: List[CardCreate] = Field(min_length=1, max_length=BATCH_MAX_ITEMS)
 
 
 class CardResponse(BaseModel):
@@ -57,6 +193,7 @@ class CardResponse(BaseModel):
     love_notes: List[str]
     scratch_message: str
     created_at: str
+    status: str = "ready"
 
 
 class GeneratedContent(BaseModel):
@@ -76,6 +213,11 @@ class LetterCreate(BaseModel):
     template: Optional[str] = "classic"
     font: Optional[str] = "playfair"
     color_scheme: Optional[str] = "romantic-red"
+    use_cache: Optional[bool] = True
+
+
+class LetterBatchCreate(BaseModel):
+    letters: List[LetterCreate] = Field(min_length=1, max_length=BATCH_MAX_ITEMS)
 
 
 class LetterResponse(BaseModel):
@@ -94,202 +236,2424 @@ class LetterResponse(BaseModel):
     font: str
     color_scheme: str
     created_at: str
+    status: str = "ready"
 
 
-async def generate_romantic_content(girlfriend_name: str, description: str, sender_name: str) -> GeneratedContent:
-    last_error = None
-    for api_key in API_KEYS:
+PHOTO_URL_PREFIX = "/api/photos/"
+PHOTO_CACHE_CONTROL = "public, max-age=31536000, immutable"
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+DATA_URL_RE = re.compile(r"^data:(image/[a-zA-Z0-9.+-]+);base64,", re.IGNORECASE)
+
+
+class BlobStore(ABC):
+    @abstractmethod
+    async def put(self, digest: str, data: bytes) -> None:
+        ...
+
+    @abstractmethod
+    async def get(self, digest: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    async def exists(self, digest: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def delete(self, digest: str) -> None:
+        ...
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, root: Path):
+        self.root = root
+
+    def _path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    def _write(self, digest: str, data: bytes) -> None:
+        path = self._path(digest)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _read(self, digest: str) -> Optional[bytes]:
         try:
-            gemini_client = genai.Client(api_key=api_key)
+            return self._path(digest).read_bytes()
+        except FileNotFoundError:
+            return None
 
-            system_instruction = """You are a romantic poet and love letter writer. Create deeply personal, heartfelt content 
-            that makes the recipient feel truly special and loved. Be creative, poetic, and emotionally touching.
-            Always respond in valid JSON format."""
+    async def put(self, digest: str, data: bytes) -> None:
+        await asyncio.to_thread(self._write, digest, data)
 
-            prompt = f"""Create romantic Valentine's content for {girlfriend_name} from {sender_name}.
+    async def get(self, digest: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._read, digest)
 
-About her: {description}
+    async def exists(self, digest: str) -> bool:
+        return await asyncio.to_thread(self._path(digest).exists)
 
-Generate a JSON response with exactly this structure:
-{{
-    "poem": "A 4-6 line romantic poem personalized to her",
-    "love_notes": ["Note 1", "Note 2", "Note 3", "Note 4", "Note 5"],
-    "scratch_message": "A special surprise message for the scratch reveal"
-}}
+    async def delete(self, digest: str) -> None:
+        await asyncio.to_thread(self._path(digest).unlink, missing_ok=True)
 
-The love_notes should be 5 short, sweet messages like "I love how you..." or "My favorite thing about us is..."
-The scratch_message should be something very special and personal.
-Make everything deeply personal based on the description provided."""
-
-            response = gemini_client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=prompt,
-                config=genai.types.GenerateContentConfig(
-                    system_instruction=system_instruction,
-                ),
-            )
 
-            response_text = response.text.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-
-            content = json.loads(response_text.strip())
-
-            return GeneratedContent(
-                poem=content.get("poem", "My heart beats only for you, my love"),
-                love_notes=content.get("love_notes", [
-                    "I love everything about you",
-                    "You make my world brighter",
-                    "Every moment with you is precious",
-                    "You are my everything",
-                    "Forever and always, I choose you"
-                ]),
-                scratch_message=content.get("scratch_message", f"I love you more than words can say, {girlfriend_name}!")
+# Shared by every instance and kept across redeploys, for hosts whose local disk is neither
+class PostgresBlobStore(BlobStore):
+    async def put(self, digest: str, data: bytes) -> None:
+        async with blob_connection() as conn:
+            await conn.execute("INSERT INTO blobs (key, data) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING", digest, data)
+
+    async def get(self, digest: str) -> Optional[bytes]:
+        async with blob_connection() as conn:
+            return await conn.fetchval("SELECT data FROM blobs WHERE key = $1", digest)
+
+    async def exists(self, digest: str) -> bool:
+        async with blob_connection() as conn:
+            return await conn.fetchval("SELECT EXISTS (SELECT 1 FROM blobs WHERE key = $1)", digest)
+
+    async def delete(self, digest: str) -> None:
+        async with blob_connection() as conn:
+            await conn.execute("DELETE FROM blobs WHERE key = $1", digest)
+
+
+def make_blob_store(backend: str) -> BlobStore:
+    if backend == "postgres":
+        return PostgresBlobStore()
+    if backend != "local":
+        raise ValueError(f"Unknown BLOB_STORE_BACKEND {backend!r}, expected local or postgres")
+    return LocalBlobStore(BLOB_STORE_DIR)
+
+
+blob_store: BlobStore = make_blob_store(BLOB_STORE_BACKEND)
+
+
+def sniff_image_type(data: bytes) -> str:
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:12] in (b"ftypavif", b"ftypheic"):
+        return "image/avif" if data[8:12] == b"avif" else "image/heic"
+    return "application/octet-stream"
+
+
+def format_bytes(size: int) -> str:
+    for unit, scale in (("MB", 1024 * 1024), ("KB", 1024)):
+        if size >= scale:
+            # Rounded down so the stated limit is never above the real one
+            return f"{math.floor(size * 10 / scale) / 10:g}{unit}"
+    return f"{size} bytes"
+
+
+def photo_too_large() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Photos must be at most {format_bytes(UPLOAD_MAX_PHOTO_BYTES)} each")
+
+
+def decode_photo(photo: str) -> bytes:
+    match = DATA_URL_RE.match(photo)
+    if not match:
+        raise HTTPException(status_code=400, detail="Photos must be base64 image data URLs")
+    if (len(photo) - match.end()) * 3 // 4 > UPLOAD_MAX_PHOTO_BYTES:
+        raise photo_too_large()
+    try:
+        return base64.b64decode(photo[match.end():], validate=True)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid base64 photo data")
+
+
+IMAGE_VARIANTS = {
+    "thumb": (480, 75),
+    "display": (1600, 82),
+    "original": (IMAGE_MAX_DIMENSION, 90),
+}
+DEFAULT_IMAGE_VARIANT = "display"
+ALLOWED_IMAGE_FORMATS = {"JPEG", "PNG", "GIF", "WEBP", "AVIF", "HEIF", "MPO", "BMP"}
+
+image_executor: Optional[ProcessPoolExecutor] = None
+
+
+def process_image(data: bytes, image_format: str, max_pixels: int) -> Dict[str, bytes]:
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            if source.format not in ALLOWED_IMAGE_FORMATS:
+                raise ValueError(f"Unsupported image format: {source.format}")
+            if source.width * source.height > max_pixels:
+                raise ValueError("Image dimensions are too large")
+            image = ImageOps.exif_transpose(source)
+            has_alpha = "A" in image.getbands() or "transparency" in image.info
+            if has_alpha and image_format == "JPEG":
+                # JPEG has no alpha channel, so transparent areas are flattened onto white
+                rgba = image.convert("RGBA")
+                image = Image.new("RGB", rgba.size, "white")
+                image.paste(rgba, mask=rgba.getchannel("A"))
+            elif image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if has_alpha else "RGB")
+
+            variants = {}
+            for variant, (max_side, quality) in IMAGE_VARIANTS.items():
+                resized = image.copy()
+                resized.thumbnail((max_side, max_side), Image.LANCZOS)
+                output = io.BytesIO()
+                resized.save(output, format=image_format, quality=quality)
+                variants[variant] = output.getvalue()
+            return variants
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise ValueError(f"Invalid image: {e}")
+
+
+def get_image_executor() -> ProcessPoolExecutor:
+    global image_executor
+    if image_executor is None:
+        image_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return image_executor
+
+
+def shutdown_image_executor():
+    global image_executor
+    if image_executor is not None:
+        image_executor.shutdown(wait=False, cancel_futures=True)
+        image_executor = None
+
+
+def variant_key(digest: str, variant: str) -> str:
+    return f"{digest}.{variant}"
+
+
+async def photo_exists(digest: str) -> bool:
+    return await blob_store.exists(variant_key(digest, "original")) or await blob_store.exists(digest)
+
+
+async def store_photo(data: bytes) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    if not await blob_store.exists(variant_key(digest, "original")):
+        try:
+            variants = await asyncio.get_running_loop().run_in_executor(
+                get_image_executor(), process_image, data, IMAGE_FORMAT, IMAGE_MAX_PIXELS
             )
-        except Exception as e:
-            last_error = e
-            logger.warning(f"API key failed, trying next: {e}")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        for variant, variant_data in variants.items():
+            await blob_store.put(variant_key(digest, variant), variant_data)
+    return digest
+
+
+async def store_photos(photos: List[str]) -> List[str]:
+    digests = []
+    for photo in photos:
+        if photo.startswith(PHOTO_URL_PREFIX) and DIGEST_RE.match(photo[len(PHOTO_URL_PREFIX):]):
+            digest = photo[len(PHOTO_URL_PREFIX):]
+            if not await photo_exists(digest):
+                raise HTTPException(status_code=400, detail="Unknown photo reference")
+            digests.append(digest)
             continue
+        digests.append(await store_photo(decode_photo(photo)))
+    return digests
 
-    logger.error(f"All API keys failed. Last error: {last_error}")
-    return GeneratedContent(
-        poem=f"""My dearest {girlfriend_name},
+
+class Base64Decoder:
+    def __init__(self):
+        self.pending = b""
+
+    def feed(self, data: bytes) -> bytes:
+        data = self.pending + b"".join(data.split())
+        usable = len(data) - len(data) % 4
+        self.pending = data[usable:]
+        try:
+            return base64.b64decode(data[:usable], validate=True)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid base64 photo data")
+
+    def finish(self):
+        if self.pending:
+            raise HTTPException(status_code=400, detail="Invalid base64 photo data")
+
+
+class PhotoUpload:
+    MAX_DATA_URL_HEADER = 256
+
+    def __init__(self, data_url: bool):
+        self.file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+        self.size = 0
+        self.header: Optional[bytes] = b"" if data_url else None
+        self.decoder = Base64Decoder() if data_url else None
+
+    def write(self, chunk: bytes):
+        if self.header is not None:
+            self.header += chunk
+            comma = self.header.find(b",")
+            if comma == -1:
+                if len(self.header) > self.MAX_DATA_URL_HEADER:
+                    raise HTTPException(status_code=400, detail="Photos must be base64 image data URLs")
+                return
+            if not DATA_URL_RE.match(self.header[:comma + 1].decode("latin-1")):
+                raise HTTPException(status_code=400, detail="Photos must be base64 image data URLs")
+            chunk, self.header = self.header[comma + 1:], None
+        if self.decoder is not None:
+            chunk = self.decoder.feed(chunk)
+        self.size += len(chunk)
+        if self.size > UPLOAD_MAX_PHOTO_BYTES:
+            raise photo_too_large()
+        self.file.write(chunk)
+
+    def read(self) -> bytes:
+        if self.header is not None:
+            raise HTTPException(status_code=400, detail="Photos must be base64 image data URLs")
+        if self.decoder is not None:
+            self.decoder.finish()
+        if self.size == 0:
+            raise HTTPException(status_code=400, detail="Empty photo upload")
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+
+class MultipartPhotoReader:
+    def __init__(self, boundary: bytes):
+        self.parser = MultipartParser(boundary, {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        })
+        self.headers: Dict[bytes, bytes] = {}
+        self.header_field = b""
+        self.header_value = b""
+        self.part: Optional[PhotoUpload] = None
+        self.completed: List[PhotoUpload] = []
+        self.count = 0
+
+    def on_part_begin(self):
+        self.headers = {}
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field = self.header_value = b""
+
+    def on_headers_finished(self):
+        _, disposition = parse_options_header(self.headers.get(b"content-disposition", b""))
+        content_type, _ = parse_options_header(self.headers.get(b"content-type", b""))
+        self.count += 1
+        if self.count > UPLOAD_MAX_PHOTOS:
+            raise HTTPException(status_code=413, detail=f"At most {UPLOAD_MAX_PHOTOS} photos per upload")
+        self.part = PhotoUpload(data_url=b"filename" not in disposition or content_type == b"text/plain")
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        self.part.write(data[start:end])
+
+    def on_part_end(self):
+        self.completed.append(self.part)
+        self.part = None
+
+    def feed(self, chunk: bytes):
+        try:
+            self.parser.write(chunk)
+        except FormParserError as e:
+            raise HTTPException(status_code=400, detail="Malformed multipart body") from e
+
+    def finish(self):
+        try:
+            self.parser.finalize()
+        except FormParserError as e:
+            raise HTTPException(status_code=400, detail="Malformed multipart body") from e
+
+    def close(self):
+        for upload in self.completed + ([self.part] if self.part else []):
+            upload.close()
+
+
+async def receive_photos(request: Request) -> List[str]:
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    digests = []
+    if content_type == b"multipart/form-data":
+        if b"boundary" not in options:
+            raise HTTPException(status_code=400, detail="Missing multipart boundary")
+        reader = MultipartPhotoReader(options[b"boundary"])
+        try:
+            async for chunk in request.stream():
+                reader.feed(chunk)
+                while reader.completed:
+                    upload = reader.completed.pop(0)
+                    try:
+                        digests.append(await store_photo(upload.read()))
+                    finally:
+                        upload.close()
+            reader.finish()
+        finally:
+            reader.close()
+    elif content_type.startswith(b"image/") or content_type == b"application/octet-stream":
+        upload = PhotoUpload(data_url=False)
+        try:
+            async for chunk in request.stream():
+                upload.write(chunk)
+            digests.append(await store_photo(upload.read()))
+        finally:
+            upload.close()
+    else:
+        raise HTTPException(status_code=415, detail="Upload photos as multipart/form-data or a raw image body")
+
+    if not digests:
+        raise HTTPException(status_code=400, detail="No photos uploaded")
+    return digests
+
+
+def photo_urls(refs: List[str]) -> List[str]:
+    return [f"{PHOTO_URL_PREFIX}{ref}" if DIGEST_RE.match(ref) else ref for ref in refs]
+
+
+RESPONSE_ETAG_VERSION = "3"
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int, max_entry_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries: OrderedDict = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        body = self.entries.get(key)
+        if body is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return body
+
+    def put(self, key: str, body: bytes):
+        if len(body) > self.max_entry_bytes:
+            return
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.total_bytes -= len(previous)
+        self.entries[key] = body
+        self.total_bytes += len(body)
+        while self.total_bytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= len(evicted)
+
+    def discard(self, key: str):
+        body = self.entries.pop(key, None)
+        if body is not None:
+            self.total_bytes -= len(body)
+
+    def snapshot(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_ENTRY_BYTES)
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # "*" is deliberately not honoured: callers check before loading, so it would 304 resources that do not exist
+    if_none_match = request.headers.get("if-none-match", "")
+    return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+
+def resource_etag(kind: str, resource_id: str) -> str:
+    return f'"{kind}-{resource_id}-v{RESPONSE_ETAG_VERSION}"'
+
+
+def resource_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": f"public, max-age={RESPONSE_CACHE_MAX_AGE}, immutable"}
+
+
+PENDING_HEADERS = {"Cache-Control": "no-store"}
+
+
+class KeyState:
+    def __init__(self, name: str, client: genai.Client):
+        self.name = name
+        self.client = client
+        self.in_flight = 0
+        self.selected = 0
+        self.successes = 0
+        self.errors = 0
+        self.throttled = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trial_in_flight = False
+        self.last_error: Optional[str] = None
+        self.recent = deque(maxlen=KEY_ERROR_WINDOW)
+
+    def breaker_state(self, now: float) -> str:
+        if self.open_until == 0.0:
+            return "closed"
+        if now < self.open_until:
+            return "open"
+        return "half_open"
+
+    def error_rate(self) -> float:
+        if not self.recent:
+            return 0.0
+        return self.recent.count(False) / len(self.recent)
+
+
+def generation_config(system_instruction: str, max_output_tokens: int, response_schema=None) -> genai.types.GenerateContentConfig:
+    if response_schema is None:
+        return genai.types.GenerateContentConfig(system_instruction=system_instruction, max_output_tokens=max_output_tokens)
+    return genai.types.GenerateContentConfig(
+        system_instruction=system_instruction,
+        max_output_tokens=max_output_tokens,
+        response_mime_type="application/json",
+        response_schema=response_schema,
+    )
+
+
+PROMPT_CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // PROMPT_CHARS_PER_TOKEN)
+
+
+def hit_token_limit(response) -> bool:
+    candidates = getattr(response, "candidates", None) or []
+    return bool(candidates) and candidates[0].finish_reason == genai.types.FinishReason.MAX_TOKENS
+
+
+def trim_partial_sentence(text: str) -> str:
+    match = re.search(r".*[.!?][\"')\u201d]*(?=\s|$)", text, re.S)
+    return match.group(0) if match and len(match.group(0)) > len(text) // 2 else text
+
+
+def is_throttle_error(error: Exception) -> bool:
+    if getattr(error, "code", None) == 429:
+        return True
+    return "RESOURCE_EXHAUSTED" in str(error)
+
+
+class KeyScheduler:
+    def __init__(self, states: List[KeyState]):
+        self.states = states
+        self.cursor = 0
+        self.generations = 0
+        self.retries = 0
+        self.exhausted = 0
+        self.fallbacks: Dict[str, int] = {}
+        self.templates: Dict[Tuple[str, str], int] = {}
+        self.repairs = {"local": 0, "retry": 0, "failed": 0}
+        self.tokens: Dict[str, Dict[str, int]] = {}
+        self.prompt_trims: Dict[str, int] = {}
+
+    @staticmethod
+    def usable(state: KeyState, now: float) -> bool:
+        breaker = state.breaker_state(now)
+        if breaker == "open":
+            return False
+        return not (breaker == "half_open" and state.trial_in_flight)
+
+    def available(self) -> bool:
+        now = time.monotonic()
+        return any(self.usable(state, now) for state in self.states)
+
+    def candidates(self) -> List[KeyState]:
+        now = time.monotonic()
+        count = len(self.states)
+        rotated = [self.states[(self.cursor + i) % count] for i in range(count)]
+        self.cursor = (self.cursor + 1) % max(count, 1)
+
+        available = [state for state in rotated if self.usable(state, now)]
+        available.sort(key=lambda state: state.in_flight)
+        return available
+
+    async def generate(self, state: KeyState, kind: str, prompt: str, system_instruction: str, max_output_tokens: int, response_schema=None) -> str:
+        trial = state.breaker_state(time.monotonic()) == "half_open"
+        if trial:
+            state.trial_in_flight = True
+        state.selected += 1
+        state.in_flight += 1
+        try:
+            with timed_phase("llm"):
+                async with gemini_semaphore:
+                    response = await state.client.aio.models.generate_content(
+                        model=GEMINI_MODEL,
+                        contents=prompt,
+                        config=generation_config(system_instruction, max_output_tokens, response_schema),
+                    )
+            self.record_success(state)
+            text = response.text or ""
+            truncated = hit_token_limit(response)
+            self.record_usage(state, kind, system_instruction + prompt, text, getattr(response, "usage_metadata", None), truncated)
+            # JSON replies are left to the repair pass; prose is cut back to its last full sentence
+            return trim_partial_sentence(text) if truncated and response_schema is None else text
+        except Exception as e:
+            self.record_failure(state, e)
+            raise
+        finally:
+            state.in_flight -= 1
+            if trial:
+                state.trial_in_flight = False
+
+    async def stream(self, state: KeyState, kind: str, prompt: str, system_instruction: str, max_output_tokens: int) -> AsyncIterator[str]:
+        trial = state.breaker_state(time.monotonic()) == "half_open"
+        if trial:
+            state.trial_in_flight = True
+        state.selected += 1
+        state.in_flight += 1
+        try:
+            parts = []
+            usage = None
+            truncated = False
+            with timed_phase("llm"):
+                async with gemini_semaphore:
+                    response_stream = await state.client.aio.models.generate_content_stream(
+                        model=GEMINI_MODEL,
+                        contents=prompt,
+                        config=generation_config(system_instruction, max_output_tokens),
+                    )
+                    async for chunk in response_stream:
+                        usage = getattr(chunk, "usage_metadata", None) or usage
+                        truncated = truncated or hit_token_limit(chunk)
+                        if chunk.text:
+                            parts.append(chunk.text)
+                            yield chunk.text
+            self.record_success(state)
+            self.record_usage(state, kind, system_instruction + prompt, "".join(parts), usage, truncated)
+        except Exception as e:
+            self.record_failure(state, e)
+            raise
+        finally:
+            state.in_flight -= 1
+            if trial:
+                state.trial_in_flight = False
+
+    def record_success(self, state: KeyState):
+        state.successes += 1
+        state.consecutive_failures = 0
+        state.open_until = 0.0
+        state.recent.append(True)
+
+    def record_failure(self, state: KeyState, error: Exception):
+        now = time.monotonic()
+        state.errors += 1
+        state.consecutive_failures += 1
+        state.last_error = str(error)[:200]
+        state.recent.append(False)
+        if is_throttle_error(error):
+            state.throttled += 1
+            state.open_until = now + KEY_THROTTLE_COOLDOWN
+            logger.warning(f"Gemini key {state.name} throttled, cooling down for {KEY_THROTTLE_COOLDOWN}s")
+            cluster_events.publish("key_open", key=state.name, seconds=KEY_THROTTLE_COOLDOWN)
+        elif state.consecutive_failures >= KEY_BREAKER_THRESHOLD or state.breaker_state(now) == "half_open":
+            state.open_until = now + KEY_BREAKER_COOLDOWN
+            logger.warning(f"Gemini key {state.name} circuit opened after {state.consecutive_failures} failures")
+            cluster_events.publish("key_open", key=state.name, seconds=KEY_BREAKER_COOLDOWN)
+
+    def record_generation(self, kind: str, attempts: int, succeeded: bool):
+        self.generations += 1
+        self.retries += max(attempts - 1, 0)
+        if not succeeded:
+            self.exhausted += 1
+            self.fallbacks[kind] = self.fallbacks.get(kind, 0) + 1
+
+    def record_template(self, kind: str, reason: str):
+        self.templates[(kind, reason)] = self.templates.get((kind, reason), 0) + 1
+
+    def record_usage(self, state: KeyState, kind: str, prompt: str, text: str, usage, truncated: bool):
+        # Fall back to the character estimate when the SDK reports no usage metadata
+        input_tokens = getattr(usage, "prompt_token_count", None) or estimate_tokens(prompt)
+        output_tokens = (getattr(usage, "candidates_token_count", None) or estimate_tokens(text)) + (getattr(usage, "thoughts_token_count", None) or 0)
+        totals = self.tokens.setdefault(kind, {"calls": 0, "input": 0, "output": 0, "truncated": 0})
+        totals["calls"] += 1
+        totals["input"] += input_tokens
+        totals["output"] += output_tokens
+        totals["truncated"] += truncated
+        logger.info(f"Gemini {kind} on {state.name}: {input_tokens} input / {output_tokens} output tokens{' (hit max_output_tokens)' if truncated else ''}")
+
+    def record_prompt_trim(self, field: str):
+        self.prompt_trims[field] = self.prompt_trims.get(field, 0) + 1
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {
+            "generations": self.generations,
+            "retries": self.retries,
+            "exhausted": self.exhausted,
+            "fallbacks": self.fallbacks,
+            "repairs": self.repairs,
+            "tokens": self.tokens,
+            "prompt_trims": self.prompt_trims,
+            "templates": [
+                {"kind": kind, "reason": reason, "count": count}
+                for (kind, reason), count in self.templates.items()
+            ],
+            "keys": [
+                {
+                    "name": state.name,
+                    "breaker_state": state.breaker_state(now),
+                    "cooldown_remaining": round(max(state.open_until - now, 0.0), 1),
+                    "in_flight": state.in_flight,
+                    "selected": state.selected,
+                    "successes": state.successes,
+                    "errors": state.errors,
+                    "throttled": state.throttled,
+                    "error_rate": round(state.error_rate(), 3),
+                    "last_error": state.last_error,
+                }
+                for state in self.states
+            ],
+        }
+
+
+key_scheduler = KeyScheduler([])
+
+
+def init_gemini_clients():
+    global key_scheduler
+    http_options = genai.types.HttpOptions(base_url=GEMINI_BASE_URL) if GEMINI_BASE_URL else None
+    key_scheduler = KeyScheduler([
+        KeyState(key_name, genai.Client(api_key=api_key, http_options=http_options))
+        for key_name, api_key in zip(API_KEY_NAMES, API_KEYS)
+    ])
+    logger.info(f"Initialized {len(key_scheduler.states)} Gemini clients (max concurrency {GEMINI_MAX_CONCURRENCY})")
+
+
+async def close_gemini_clients():
+    for state in key_scheduler.states:
+        try:
+            await state.client.aio.aclose()
+        except Exception as e:
+            logger.warning(f"Failed to close Gemini client {state.name}: {e}")
+    key_scheduler.states = []
+
+
+def normalize_prompt_input(value: Optional[str]) -> str:
+    return " ".join((value or "").split())
+
+
+def generation_cache_key(kind: str, **inputs) -> str:
+    normalized = {name: normalize_prompt_input(value) for name, value in inputs.items()}
+    payload = json.dumps({"kind": kind, "model": GEMINI_MODEL, "inputs": normalized}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class GenerationCache:
+    def __init__(self, max_entries: int, ttl: float, max_entry_bytes: int, use_db: bool):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.use_db = use_db
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    def _remember(self, key: str, value: str, expires_at: float):
+        self.entries[key] = (expires_at, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+
+        if self.use_db and db_pool is not None:
+            try:
+                async with acquire_connection() as conn:
+                    row = await conn.fetchrow(
+                        "SELECT value, EXTRACT(EPOCH FROM expires_at - NOW()) AS remaining FROM generation_cache WHERE key = $1 AND expires_at > NOW()",
+                        key
+                    )
+                if row:
+                    self._remember(key, row["value"], time.monotonic() + float(row["remaining"]))
+                    self.db_hits += 1
+                    return row["value"]
+            except Exception as e:
+                logger.warning(f"Generation cache lookup failed: {e}")
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: str):
+        if len(value.encode()) > self.max_entry_bytes:
+            self.rejected += 1
+            return
+        self._remember(key, value, time.monotonic() + self.ttl)
+
+        if self.use_db and db_pool is not None:
+            try:
+                async with acquire_connection() as conn:
+                    await conn.execute(
+                        """INSERT INTO generation_cache (key, value, expires_at)
+                           VALUES ($1, $2, NOW() + make_interval(secs => $3))
+                           ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at""",
+                        key, value, self.ttl
+                    )
+            except Exception as e:
+                logger.warning(f"Generation cache store failed: {e}")
+
+    def snapshot(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "rejected": self.rejected,
+        }
+
+
+generation_cache = GenerationCache(
+    GENERATION_CACHE_SIZE, GENERATION_CACHE_TTL, GENERATION_CACHE_MAX_ENTRY_BYTES, GENERATION_CACHE_DB
+)
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls: Dict[str, asyncio.Task] = {}
+        self.coalesced = 0
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            task.exception()
+
+    async def run(self, key: str, factory: Callable[[], Awaitable]):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def cancel(self):
+        tasks = list(self.calls.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+generation_flights = SingleFlight()
+request_flights = SingleFlight()
+
+
+class GenerationUnavailable(Exception):
+    pass
+
+
+CARD_POEMS = [Template(text) for text in (
+    """My dearest ${name},
 You are the sunshine in my days,
 The stars that light my darkest nights,
 In countless beautiful ways,
 You make everything feel right.
-Forever yours, {sender_name}""",
-        love_notes=[
-            "I love how you make me smile every day",
-            "My favorite thing about us is our laughter together",
-            "You are the best thing that ever happened to me",
-            "Every day with you feels like a dream",
-            "I fall in love with you more each day"
-        ],
-        scratch_message=f"You are my forever, {girlfriend_name}! I love you to the moon and back!"
+Forever yours, ${sender}""",
+    """${name}, you are my favorite kind of morning,
+The quiet light that finds me every day,
+A song I never tire of hearing,
+A home I never want to walk away from.
+Always yours, ${sender}""",
+    """Of all the stars I could have wished upon,
+I only ever needed one, ${name}, and it was you.
+You turned my ordinary into magic,
+And made every day feel brand new.
+With all my love, ${sender}""",
+)]
+
+CARD_NOTES = [Template(text) for text in (
+    "I love how you make me smile every day",
+    "My favorite thing about us is our laughter together",
+    "You are the best thing that ever happened to me",
+    "Every day with you feels like a dream",
+    "I fall in love with you more each day",
+    "I love the way you say my name",
+    "My favorite place in the world is right next to you",
+    "You make even the boring days feel like an adventure",
+    "I love how safe I feel when I'm with you, ${name}",
+    "Thank you for being exactly who you are",
+)]
+
+CARD_DETAIL_NOTE = Template('When people ask me about you, I tell them: "${detail}". It never feels like enough')
+
+CARD_SCRATCH_MESSAGES = [Template(text) for text in (
+    "You are my forever, ${name}! I love you to the moon and back!",
+    "Surprise, ${name}: you are the best part of every single day. Love, ${sender}",
+    "${name}, if I had to choose again, I would choose you every time!",
+)]
+
+LETTER_OPENINGS = {
+    "romantic": (
+        "Every moment I spend thinking about you, ${name}, fills my heart with a warmth that words can barely capture.",
+        "There is a place in my heart that has always belonged to you, ${name}, even before I knew your name.",
+    ),
+    "poetic": (
+        "If my love for you were written in starlight, ${name}, the night sky would never be dark again.",
+        "Some people arrive like weather and leave like seasons; you, ${name}, arrived like sunrise and stayed.",
+    ),
+    "funny": (
+        "I tried to write you a normal letter, ${name}, but my heart kept stealing the pen.",
+        "Scientists still cannot explain it, ${name}, but every time I think of you I start grinning like an idiot.",
+    ),
+    "emotional": (
+        "I have started this letter so many times, ${name}, because nothing I write feels as big as what I feel.",
+        "Sometimes I catch myself just looking at you, ${name}, and wondering how I got this lucky.",
+    ),
+    "casual": (
+        "Hey you. I was just sitting here thinking about you, ${name}, and figured I should finally write it all down.",
+        "So, ${name}, I have been meaning to tell you something, and it turns out it takes a whole letter.",
+    ),
+    "dramatic": (
+        "Let the whole world hear it, ${name}: no love in any story ever written comes close to mine for you.",
+        "If this letter were a film, ${name}, this is where the music swells and the rain starts to fall.",
+    ),
+}
+
+LETTER_BODIES = {
+    "love": (
+        "You are the most extraordinary person I have ever known, and I find myself falling deeper in love with you with each passing day. The way you laugh, the way you care, the way you make ordinary moments feel like something worth remembering.",
+        "Loving you has changed the way I see everything. Colors are brighter, songs mean more, and even the quiet evenings feel full because you are in them.",
+    ),
+    "sorry": (
+        "I am so sorry for hurting you. I have been replaying everything, and I can see now how my words and my actions made you feel, and you deserved so much better from me.",
+        "I owe you an apology, and not a small one. I let my pride speak louder than my love, and I hate that it put distance between us.",
+    ),
+    "proposal": (
+        "Every step of our journey together has been leading me here. From our first conversations to every adventure since, you have become my best friend, my safe place, and the love of my life.",
+        "I have imagined my future a thousand different ways, and in every single one of them, you are there. I do not want a life that does not have you at the center of it.",
+    ),
+    "anniversary": (
+        "Another year with you, and somehow I love you more than I did on our very first day. Looking back at everything we have shared, I am amazed at how much we have grown together.",
+        "When I think about all the moments we have collected, the big celebrations and the tiny everyday ones, I realize they are the best story I will ever get to tell.",
+    ),
+    "miss-you": (
+        "I miss you in ways I did not know were possible. I miss your voice, your laugh, and the way the room feels different when you walk into it.",
+        "The days feel longer without you, and the nights feel quieter. I keep turning to tell you something, only to remember you are not here yet.",
+    ),
+    "first-love": (
+        "I do not really know how to say this, so I am just going to be brave: I think I am falling for you. Every time I see you, my heart does this silly little jump.",
+        "I have never felt anything like this before. You make me nervous and happy all at once, and I cannot stop smiling when I think about you.",
+    ),
+    "long-distance": (
+        "The miles between us are real, but they have never been stronger than what we have. Every call, every message, and every countdown brings me closer to you.",
+        "Distance has taught me just how much you mean to me. I carry you with me everywhere I go, and I am counting down the days until I can hold you again.",
+    ),
+    "custom": (
+        "I wanted to put into words something that has been on my heart for a long time: you matter to me more than I could ever fully explain.",
+        "There are some things that deserve more than a quick message, and what I feel for you is one of them.",
+    ),
+}
+
+LETTER_DETAILS = {
+    "sorry": 'I keep thinking about what happened ("${detail}"), and I want you to know I am going to do better, not just say it.',
+}
+
+LETTER_DEFAULT_DETAIL = 'I think about the little things that make us, us: "${detail}". Those details are where I find you most, and where I fall for you all over again.'
+
+LETTER_CLOSINGS = {
+    "romantic": (
+        "You are my today, my tomorrow, and my forever. Nothing in this world compares to the joy of loving you and being loved by you in return.",
+        "Whatever comes next, I want to face it with your hand in mine. I love you, completely and always.",
+    ),
+    "poetic": (
+        "And when the stars finally go out, I will still be writing your name into the dark.",
+        "You are the verse I keep returning to, the line I never want to end.",
+    ),
+    "funny": (
+        "In conclusion: you are stuck with me, and honestly, that is the best deal you are ever going to get.",
+        "Thank you for putting up with my terrible jokes. I promise to keep telling them forever.",
+    ),
+    "emotional": (
+        "Thank you for loving me the way you do. I will spend every day trying to deserve it.",
+        "Whatever else changes, please know this never will: I love you with everything I have.",
+    ),
+    "casual": (
+        "Anyway, that is what has been on my mind. You are my favorite person, and I just wanted you to know.",
+        "So yeah, I love you. A lot. Talk soon.",
+    ),
+    "dramatic": (
+        "Let empires fall and oceans rise; my heart will still be yours until the very end of time.",
+        "Cue the orchestra, roll the credits: this is the love story I will tell for the rest of my life.",
+    ),
+}
+
+LETTER_TEMPLATES = {
+    (letter_type, tone): [
+        (Template(opening), Template(body), Template(LETTER_DETAILS.get(letter_type, LETTER_DEFAULT_DETAIL)), Template(closing))
+        for opening in LETTER_OPENINGS[tone]
+        for body in bodies
+        for closing in LETTER_CLOSINGS[tone]
+    ]
+    for letter_type, bodies in LETTER_BODIES.items()
+    for tone in LETTER_OPENINGS
+}
+
+
+def template_detail(text: Optional[str], limit: int = 160) -> str:
+    text = normalize_prompt_input(text)
+    sentence = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0].rstrip(".!? ")
+    if len(sentence) > limit:
+        sentence = sentence[:limit].rsplit(" ", 1)[0] + "..."
+    return sentence
+
+
+def template_choice(seed: str, salt: str, count: int) -> int:
+    return int.from_bytes(hashlib.sha256(f"{salt}:{seed}".encode()).digest()[:4], "big") % count
+
+
+def template_card_content(girlfriend_name: str, description: str, sender_name: str) -> GeneratedContent:
+    seed = generation_cache_key("card", girlfriend_name=girlfriend_name, description=description, sender_name=sender_name)
+    fields = {"name": girlfriend_name, "sender": sender_name, "detail": template_detail(description)}
+
+    start = template_choice(seed, "notes", len(CARD_NOTES))
+    notes = [CARD_NOTES[(start + i) % len(CARD_NOTES)] for i in range(5)]
+    if fields["detail"]:
+        notes = [CARD_DETAIL_NOTE] + notes[:4]
+
+    return GeneratedContent(
+        poem=CARD_POEMS[template_choice(seed, "poem", len(CARD_POEMS))].safe_substitute(fields),
+        love_notes=[note.safe_substitute(fields) for note in notes],
+        scratch_message=CARD_SCRATCH_MESSAGES[template_choice(seed, "scratch", len(CARD_SCRATCH_MESSAGES))].safe_substitute(fields),
     )
 
 
-async def generate_letter_content(letter_type: str, recipient_name: str, sender_name: str, context: str, tone: str, custom_prompt: Optional[str] = None) -> str:
-    type_instructions = {
-        "love": f"Write a deeply romantic and passionate love letter from {sender_name} to {recipient_name}. Make it heartfelt, intimate, and emotionally powerful.",
-        "sorry": f"Write a sincere, heartfelt apology letter from {sender_name} to {recipient_name}. They had a fight/disagreement about: {context}. Acknowledge the hurt caused, take responsibility, express genuine remorse, and promise to do better. Be vulnerable and honest.",
-        "proposal": f"Write an unforgettable marriage proposal letter from {sender_name} to {recipient_name}. Make it deeply personal, emotional, and build up to the magical question. Reference their journey together.",
-        "anniversary": f"Write a beautiful anniversary letter from {sender_name} to {recipient_name}. Celebrate their time together, reminisce about beautiful moments, and look forward to the future.",
-        "miss-you": f"Write an emotionally touching 'I miss you' letter from {sender_name} to {recipient_name}. Express how much they miss them, what they miss most, and how they can't wait to be together again.",
-        "first-love": f"Write a sweet and innocent first love confession letter from {sender_name} to {recipient_name}. Capture the butterflies, nervousness, and pure joy of falling in love for the first time.",
-        "long-distance": f"Write a heartfelt long-distance relationship letter from {sender_name} to {recipient_name}. Express how distance makes the heart grow fonder, share dreams of being together, and reassure your love.",
-        "custom": f"Write a personalized letter from {sender_name} to {recipient_name} based on these instructions: {custom_prompt or context}",
-    }
+def template_letter_content(letter_type: str, recipient_name: str, sender_name: str, context: str, tone: str, custom_prompt: Optional[str] = None) -> str:
+    seed = letter_cache_key(letter_type, recipient_name, sender_name, context, tone, custom_prompt)
+    variants = LETTER_TEMPLATES[(
+        letter_type if letter_type in LETTER_BODIES else "love",
+        tone if tone in LETTER_OPENINGS else "romantic",
+    )]
+    opening, body, detail, closing = variants[template_choice(seed, "letter", len(variants))]
+    fields = {"name": recipient_name, "sender": sender_name, "detail": template_detail(context)}
 
-    type_instruction = type_instructions.get(letter_type, type_instructions["love"])
+    paragraphs = [opening, body, detail, closing] if fields["detail"] else [opening, body, closing]
+    return "\n\n".join(paragraph.safe_substitute(fields) for paragraph in paragraphs)
 
-    tone_map = {
-        "romantic": "deeply romantic, passionate, and sensual",
-        "poetic": "lyrical, metaphor-rich, and beautifully poetic like a piece of literature",
-        "funny": "witty, playful, and humorous while still being loving and sweet",
-        "emotional": "raw, vulnerable, and deeply emotional - pull at heartstrings",
-        "casual": "warm, genuine, and conversational like talking to your best friend who you love",
-        "dramatic": "grand, theatrical, and over-the-top romantic like a movie scene",
-    }
 
-    tone_desc = tone_map.get(tone, tone_map["romantic"])
+async def generate_within_budget(kind: str, generation: Callable[[], Awaitable], budget: Optional[float] = None):
+    if not key_scheduler.available():
+        key_scheduler.record_template(kind, "breaker_open")
+        return None
+    try:
+        return await asyncio.wait_for(generation(), budget or None)
+    except asyncio.TimeoutError:
+        key_scheduler.record_template(kind, "budget")
+        logger.warning(f"No {kind} generation within {budget}s, serving template content")
+    except GenerationUnavailable:
+        key_scheduler.record_template(kind, "exhausted")
+    return None
+
+
+JSON_CLOSERS = {"{": "}", "[": "]"}
+JSON_STRING_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+
+
+def strip_trailing_comma(out: List[str]):
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ",":
+        out.pop()
+
+
+def repair_json(text: str) -> str:
+    start = text.find("{")
+    if start == -1:
+        raise ValueError("no JSON object in response")
+
+    out: List[str] = []
+    stack: List[str] = []
+    in_string = escaped = False
+    for char in text[start:]:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            out.append(JSON_STRING_ESCAPES.get(char, char))
+            continue
+        if char == '"':
+            in_string = True
+        elif char in JSON_CLOSERS:
+            stack.append(JSON_CLOSERS[char])
+        elif char in "}]":
+            if not stack or stack[-1] != char:
+                continue
+            strip_trailing_comma(out)
+            stack.pop()
+            out.append(char)
+            if not stack:
+                break
+            continue
+        out.append(char)
 
-    last_error = None
-    for api_key in API_KEYS:
+    if in_string:
+        if escaped:
+            out.pop()
+        out.append('"')
+    strip_trailing_comma(out)
+    if out and out[-1] == ":":
+        out.append("null")
+    out.extend(reversed(stack))
+    return "".join(out)
+
+
+def parse_generated_content(text: str) -> GeneratedContent:
+    with timed_phase("json"):
         try:
-            gemini_client = genai.Client(api_key=api_key)
+            return GeneratedContent.model_validate_json(text)
+        except ValueError:
+            pass
+        content = GeneratedContent.model_validate(json.loads(repair_json(text)))
+    key_scheduler.repairs["local"] += 1
+    return content
 
-            system_instruction = f"""You are a world-class letter writer who creates deeply personal, beautifully written letters.
+
+def fit_prompt_input(field: str, value: Optional[str], budget: int) -> str:
+    text = normalize_prompt_input(value)
+    limit = budget * PROMPT_CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    key_scheduler.record_prompt_trim(field)
+    cut = text[:limit]
+    sentence_end = max(cut.rfind(". "), cut.rfind("! "), cut.rfind("? "))
+    cut = cut[:sentence_end + 1] if sentence_end > limit // 2 else cut.rsplit(" ", 1)[0]
+    return f"{cut} [...]"
+
+
+CARD_SYSTEM_INSTRUCTION = """You are a romantic poet and love letter writer. Create deeply personal, heartfelt content that makes the recipient feel truly special and loved. Be creative, poetic, and emotionally touching.
+Always respond in valid JSON format."""
+
+CARD_PROMPT = Template("""Create romantic Valentine's content for ${name} from ${sender}.
+
+About her: ${description}
+
+Generate a JSON response with exactly this structure:
+{
+    "poem": "A 4-6 line romantic poem personalized to her",
+    "love_notes": ["Note 1", "Note 2", "Note 3", "Note 4", "Note 5"],
+    "scratch_message": "A special surprise message for the scratch reveal"
+}
+
+The love_notes should be 5 short, sweet messages like "I love how you..." or "My favorite thing about us is..."
+The scratch_message should be something very special and personal.
+Make everything deeply personal based on the description provided.""")
+
+LETTER_TYPE_INSTRUCTIONS = {letter_type: Template(text) for letter_type, text in {
+    "love": "Write a deeply romantic and passionate love letter from ${sender} to ${name}. Make it heartfelt, intimate, and emotionally powerful.",
+    "sorry": "Write a sincere, heartfelt apology letter from ${sender} to ${name}. They had a fight/disagreement, described in the context below. Acknowledge the hurt caused, take responsibility, express genuine remorse, and promise to do better. Be vulnerable and honest.",
+    "proposal": "Write an unforgettable marriage proposal letter from ${sender} to ${name}. Make it deeply personal, emotional, and build up to the magical question. Reference their journey together.",
+    "anniversary": "Write a beautiful anniversary letter from ${sender} to ${name}. Celebrate their time together, reminisce about beautiful moments, and look forward to the future.",
+    "miss-you": "Write an emotionally touching 'I miss you' letter from ${sender} to ${name}. Express how much they miss them, what they miss most, and how they can't wait to be together again.",
+    "first-love": "Write a sweet and innocent first love confession letter from ${sender} to ${name}. Capture the butterflies, nervousness, and pure joy of falling in love for the first time.",
+    "long-distance": "Write a heartfelt long-distance relationship letter from ${sender} to ${name}. Express how distance makes the heart grow fonder, share dreams of being together, and reassure your love.",
+    "custom": "Write a personalized letter from ${sender} to ${name} based on the ${instructions} below.",
+}.items()}
+
+LETTER_TONES = {
+    "romantic": "deeply romantic, passionate, and sensual",
+    "poetic": "lyrical, metaphor-rich, and beautifully poetic like a piece of literature",
+    "funny": "witty, playful, and humorous while still being loving and sweet",
+    "emotional": "raw, vulnerable, and deeply emotional - pull at heartstrings",
+    "casual": "warm, genuine, and conversational like talking to your best friend who you love",
+    "dramatic": "grand, theatrical, and over-the-top romantic like a movie scene",
+}
+
+LETTER_SYSTEM_INSTRUCTIONS = {tone: f"""You are a world-class letter writer who creates deeply personal, beautifully written letters.
 Your tone should be {tone_desc}.
 Write in a natural, flowing style with proper paragraphs.
 Do NOT include any JSON formatting, code blocks, or markdown.
 Just write the pure letter content with proper paragraphs.
 Do NOT include "Dear..." or sign-off like "Love, name" - those will be added separately.
-The letter should be 3-5 paragraphs long, each paragraph being meaningful and personal."""
+The letter should be 3-5 paragraphs long, each paragraph being meaningful and personal.""" for tone, tone_desc in LETTER_TONES.items()}
+
+LETTER_PROMPT = Template("""${instruction}
+
+Context/Details about them and their relationship: ${context}
+${custom}
+Write a beautiful, ${tone} letter. Make it personal and reference the specific details provided. 3-5 paragraphs.""")
+
+# Replies are asked for 3-5 paragraphs (~400-600 words); the caps leave headroom for the longer types
+LETTER_OUTPUT_TOKENS = {
+    "love": 900,
+    "sorry": 1000,
+    "proposal": 1200,
+    "anniversary": 1000,
+    "miss-you": 900,
+    "first-love": 900,
+    "long-distance": 1000,
+    "custom": 1200,
+}
+
+
+def parse_output_token_overrides(value: str, defaults: Dict[str, int]) -> Dict[str, int]:
+    overrides = {}
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        name, _, tokens = item.partition("=")
+        try:
+            limit = int(tokens)
+        except ValueError:
+            limit = 0
+        if name.strip() not in defaults or limit <= 0:
+            logger.warning(f"Ignoring LETTER_MAX_OUTPUT_TOKENS entry {item!r}, expected <letter_type>=<positive integer>")
+            continue
+        overrides[name.strip()] = limit
+    return overrides
+
+
+LETTER_OUTPUT_TOKENS.update(parse_output_token_overrides(LETTER_MAX_OUTPUT_TOKENS, LETTER_OUTPUT_TOKENS))
+
+
+def build_card_prompt(girlfriend_name: str, description: str, sender_name: str) -> Tuple[str, str]:
+    prompt = CARD_PROMPT.substitute(
+        name=fit_prompt_input("name", girlfriend_name, PROMPT_NAME_TOKENS),
+        sender=fit_prompt_input("name", sender_name, PROMPT_NAME_TOKENS),
+        description=fit_prompt_input("description", description, PROMPT_CONTEXT_TOKENS),
+    )
+    return CARD_SYSTEM_INSTRUCTION, prompt
 
-            prompt = f"""{type_instruction}
 
-Context/Details about them and their relationship: {context}
+def build_letter_prompt(letter_type: str, recipient_name: str, sender_name: str, context: str, tone: str, custom_prompt: Optional[str] = None) -> Tuple[str, str]:
+    tone = tone if tone in LETTER_TONES else "romantic"
+    custom_prompt = fit_prompt_input("custom_prompt", custom_prompt, PROMPT_CUSTOM_TOKENS)
+    instruction = LETTER_TYPE_INSTRUCTIONS.get(letter_type, LETTER_TYPE_INSTRUCTIONS["love"]).substitute(
+        name=fit_prompt_input("name", recipient_name, PROMPT_NAME_TOKENS),
+        sender=fit_prompt_input("name", sender_name, PROMPT_NAME_TOKENS),
+        instructions="additional custom instructions" if custom_prompt else "context",
+    )
+    prompt = LETTER_PROMPT.substitute(
+        instruction=instruction,
+        context=fit_prompt_input("context", context, PROMPT_CONTEXT_TOKENS),
+        custom=f"\nAdditional custom instructions: {custom_prompt}\n" if custom_prompt else "",
+        tone=LETTER_TONES[tone],
+    )
+    return LETTER_SYSTEM_INSTRUCTIONS[tone], prompt
+
+
+def letter_output_tokens(letter_type: str) -> int:
+    return LETTER_OUTPUT_TOKENS.get(letter_type, LETTER_OUTPUT_TOKENS["love"])
+
+
+def card_repair_prompt(prompt: str, response_text: str, error: Exception) -> str:
+    return f"""{prompt}
+
+Your previous reply could not be parsed ({str(error)[:300]}):
+{response_text[:4000]}
 
-{f"Additional custom instructions: {custom_prompt}" if custom_prompt else ""}
+Reply again with only the corrected JSON object with "poem", "love_notes" and "scratch_message", and nothing else."""
 
-Write a beautiful, {tone_desc} letter. Make it personal and reference the specific details provided. 3-5 paragraphs."""
 
-            response = gemini_client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=prompt,
-                config=genai.types.GenerateContentConfig(
-                    system_instruction=system_instruction,
-                ),
+async def generate_romantic_content(girlfriend_name: str, description: str, sender_name: str, use_cache: bool = True) -> GeneratedContent:
+    cache_key = generation_cache_key("card", girlfriend_name=girlfriend_name, description=description, sender_name=sender_name)
+    if use_cache:
+        cached = await generation_cache.get(cache_key)
+        if cached is not None:
+            with timed_phase("json"):
+                return GeneratedContent.model_validate_json(cached)
+
+    return await generation_flights.run(
+        cache_key, lambda: _generate_romantic_content(girlfriend_name, description, sender_name, cache_key)
+    )
+
+
+async def _generate_romantic_content(girlfriend_name: str, description: str, sender_name: str, cache_key: str) -> GeneratedContent:
+    system_instruction, prompt = build_card_prompt(girlfriend_name, description, sender_name)
+
+    last_error = None
+    attempts = 0
+    for key_state in key_scheduler.candidates():
+        attempts += 1
+        try:
+            response_text = await key_scheduler.generate(
+                key_state, "card", prompt, system_instruction, CARD_MAX_OUTPUT_TOKENS, GeneratedContent
             )
+            try:
+                generated = parse_generated_content(response_text)
+            except ValueError as e:
+                logger.warning(f"Unparseable card JSON from {key_state.name}, asking the same key to repair it: {e}")
+                response_text = await key_scheduler.generate(
+                    key_state, "card_repair", card_repair_prompt(prompt, response_text, e),
+                    system_instruction, CARD_MAX_OUTPUT_TOKENS, GeneratedContent
+                )
+                try:
+                    generated = parse_generated_content(response_text)
+                except ValueError as e:
+                    key_scheduler.repairs["failed"] += 1
+                    key_scheduler.record_generation("card", attempts, False)
+                    raise GenerationUnavailable(f"Card JSON still unparseable after repair: {e}")
+                key_scheduler.repairs["retry"] += 1
+
+            key_scheduler.record_generation("card", attempts, True)
+            await generation_cache.set(cache_key, generated.model_dump_json())
+            return generated
+        except GenerationUnavailable:
+            raise
+        except Exception as e:
+            last_error = e
+            logger.warning(f"API key failed, trying next: {e}")
+            continue
+
+    key_scheduler.record_generation("card", attempts, False)
+    logger.error(f"All API keys failed. Last error: {last_error}")
+    raise GenerationUnavailable(f"All API keys failed for card: {last_error}")
+
+
+def letter_cache_key(letter_type: str, recipient_name: str, sender_name: str, context: str, tone: str, custom_prompt: Optional[str]) -> str:
+    return generation_cache_key(
+        "letter",
+        letter_type=letter_type,
+        recipient_name=recipient_name,
+        sender_name=sender_name,
+        context=context,
+        tone=tone,
+        custom_prompt=custom_prompt,
+    )
+
+
+async def generate_letter_content(letter_type: str, recipient_name: str, sender_name: str, context: str, tone: str, custom_prompt: Optional[str] = None, use_cache: bool = True) -> str:
+    cache_key = letter_cache_key(letter_type, recipient_name, sender_name, context, tone, custom_prompt)
+    if use_cache:
+        cached = await generation_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    return await generation_flights.run(
+        cache_key,
+        lambda: _generate_letter_content(letter_type, recipient_name, sender_name, context, tone, custom_prompt, cache_key)
+    )
+
+
+async def _generate_letter_content(letter_type: str, recipient_name: str, sender_name: str, context: str, tone: str, custom_prompt: Optional[str], cache_key: str) -> str:
+    system_instruction, prompt = build_letter_prompt(letter_type, recipient_name, sender_name, context, tone, custom_prompt)
 
-            return response.text.strip()
+    last_error = None
+    attempts = 0
+    for key_state in key_scheduler.candidates():
+        attempts += 1
+        try:
+            response_text = await key_scheduler.generate(
+                key_state, "letter", prompt, system_instruction, letter_output_tokens(letter_type)
+            )
+            key_scheduler.record_generation("letter", attempts, True)
+            await generation_cache.set(cache_key, response_text.strip())
+            return response_text.strip()
         except Exception as e:
             last_error = e
             logger.warning(f"API key failed for letter generation, trying next: {e}")
             continue
 
+    key_scheduler.record_generation("letter", attempts, False)
     logger.error(f"All API keys failed for letter. Last error: {last_error}")
-    return f"""Every moment I spend thinking about you fills my heart with a warmth that words can barely capture. You are the most extraordinary person I have ever known, and I find myself falling deeper in love with you with each passing day.
+    raise GenerationUnavailable(f"All API keys failed for letter: {last_error}")
+
+
+async def stream_letter_content(letter_type: str, recipient_name: str, sender_name: str, context: str, tone: str, custom_prompt: Optional[str] = None, use_cache: bool = True) -> AsyncIterator[Tuple[str, str]]:
+    cache_key = letter_cache_key(letter_type, recipient_name, sender_name, context, tone, custom_prompt)
+    if use_cache:
+        cached = await generation_cache.get(cache_key)
+        if cached is not None:
+            yield "chunk", cached
+            return
+
+    if not key_scheduler.available():
+        key_scheduler.record_template("letter_stream", "breaker_open")
+        yield "chunk", template_letter_content(letter_type, recipient_name, sender_name, context, tone, custom_prompt)
+        return
+
+    system_instruction, prompt = build_letter_prompt(letter_type, recipient_name, sender_name, context, tone, custom_prompt)
+
+    last_error = None
+    attempts = 0
+    for key_state in key_scheduler.candidates():
+        attempts += 1
+        parts = []
+        try:
+            async for text in key_scheduler.stream(
+                key_state, "letter_stream", prompt, system_instruction, letter_output_tokens(letter_type)
+            ):
+                parts.append(text)
+                yield "chunk", text
+            key_scheduler.record_generation("letter_stream", attempts, True)
+            await generation_cache.set(cache_key, "".join(parts).strip())
+            return
+        except Exception as e:
+            last_error = e
+            logger.warning(f"API key failed for streamed letter generation, trying next: {e}")
+            if parts:
+                yield "reset", ""
+            continue
+
+    key_scheduler.record_generation("letter_stream", attempts, False)
+    logger.error(f"All API keys failed for streamed letter. Last error: {last_error}")
+    key_scheduler.record_template("letter_stream", "exhausted")
+    yield "chunk", template_letter_content(letter_type, recipient_name, sender_name, context, tone, custom_prompt)
+
+
+JSON_COLUMNS = [
+    ("valentine_cards", "photos"),
+    ("valentine_cards", "love_notes"),
+    ("love_letters", "photos"),
+]
+
+MIGRATION_LOCK_ID = 5_412_020_214
+
+
+PHOTO_URLS_SQL = f"""(
+    SELECT COALESCE(json_agg(
+        CASE WHEN photo ~ '^[0-9a-f]{{64}}$' THEN '{PHOTO_URL_PREFIX}' || photo ELSE photo END
+        ORDER BY position
+    ), '[]'::json)
+    FROM jsonb_array_elements_text(photos) WITH ORDINALITY AS p(photo, position)
+)"""
+
+CREATED_AT_SQL = """to_char(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"+00:00"')"""
+
+CARD_DOCUMENT_SQL = f"""SELECT json_build_object(
+    'id', id,
+    'girlfriend_name', girlfriend_name,
+    'sender_name', sender_name,
+    'description', description,
+    'photos', {PHOTO_URLS_SQL},
+    'poem', poem,
+    'love_notes', love_notes,
+    'scratch_message', scratch_message,
+    'created_at', {CREATED_AT_SQL},
+    'status', status
+)::text, status FROM valentine_cards WHERE id = $1"""
+
+LETTER_DOCUMENT_SQL = f"""SELECT json_build_object(
+    'id', id,
+    'letter_type', letter_type,
+    'recipient_name', recipient_name,
+    'sender_name', sender_name,
+    'context', context,
+    'custom_prompt', NULLIF(custom_prompt, ''),
+    'tone', tone,
+    'photos', {PHOTO_URLS_SQL},
+    'content', content,
+    'template', template,
+    'font', font,
+    'color_scheme', color_scheme,
+    'created_at', {CREATED_AT_SQL},
+    'status', status
+)::text, status FROM love_letters WHERE id = $1"""
+
+
+INSERT_CARD_SQL = """INSERT INTO valentine_cards (id, girlfriend_name, sender_name, description, photos, poem, love_notes, scratch_message, created_at, status)
+   VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)"""
+
+INSERT_LETTER_SQL = """INSERT INTO love_letters (id, letter_type, recipient_name, sender_name, context, custom_prompt, tone, photos, content, template, font, color_scheme, created_at, status)
+   VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14)"""
+
+HOT_STATEMENTS = {
+    "insert_card": INSERT_CARD_SQL,
+    "insert_letter": INSERT_LETTER_SQL,
+    "select_card": CARD_DOCUMENT_SQL,
+    "select_letter": LETTER_DOCUMENT_SQL,
+}
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> dict:
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        buckets["+Inf"] = self.count
+        return {"count": self.count, "sum": round(self.sum, 6), "buckets": buckets}
+
+
+class DatabaseMetrics:
+    def __init__(self):
+        self.acquire_wait = Histogram()
+        self.acquire_timeouts = 0
+        self.queries: Dict[str, Histogram] = {name: Histogram() for name in HOT_STATEMENTS}
+        self.query_errors: Dict[str, int] = {name: 0 for name in HOT_STATEMENTS}
+
+    def snapshot(self) -> dict:
+        pool = {}
+        if db_pool is not None:
+            pool = {
+                "size": db_pool.get_size(),
+                "idle": db_pool.get_idle_size(),
+                "min_size": db_pool.get_min_size(),
+                "max_size": db_pool.get_max_size(),
+            }
+        return {
+            "pool": pool,
+            "acquire_wait": self.acquire_wait.snapshot(),
+            "acquire_timeouts": self.acquire_timeouts,
+            "queries": {name: histogram.snapshot() for name, histogram in self.queries.items()},
+            "query_errors": self.query_errors,
+        }
+
+
+db_metrics = DatabaseMetrics()
+
+
+async def init_connection(conn):
+    await conn.set_type_codec("jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+    for name, sql in HOT_STATEMENTS.items():
+        try:
+            await conn.executemany(sql, [])
+        except asyncpg.PostgresError as e:
+            # Left to check_schema_version to explain; the statement is prepared on first use instead
+            logger.warning(f"Could not pre-prepare {name}, schema may not be migrated yet: {e}")
+
+
+@asynccontextmanager
+async def acquire_connection():
+    start = time.perf_counter()
+    try:
+        conn = await db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        db_metrics.acquire_timeouts += 1
+        logger.warning(f"Timed out after {DB_ACQUIRE_TIMEOUT}s waiting for a database connection")
+        raise HTTPException(status_code=503, detail="Database is busy, please retry.")
+    db_metrics.acquire_wait.observe(time.perf_counter() - start)
+    try:
+        yield conn
+    finally:
+        await db_pool.release(conn)
+        record_phase("db", time.perf_counter() - start)
+
+
+@asynccontextmanager
+async def blob_connection():
+    if db_pool is None:
+        raise HTTPException(status_code=503, detail="Database not configured.")
+    async with acquire_connection() as conn:
+        yield conn
+
+
+async def run_statement(conn, name: str, method: str, *args):
+    start = time.perf_counter()
+    try:
+        return await getattr(conn, method)(HOT_STATEMENTS[name], *args, timeout=DB_COMMAND_TIMEOUT)
+    except Exception:
+        db_metrics.query_errors[name] += 1
+        raise
+    finally:
+        db_metrics.queries[name].observe(time.perf_counter() - start)
 
-{context}
 
-There are a thousand things I want to say to you, and yet when I try to put them into words, I realize that no language was ever designed to hold this much love. You deserve the world and more, and I promise to spend every day trying to give it to you.
+async def migrate_json_columns(conn):
+    for table, column in JSON_COLUMNS:
+        data_type = await conn.fetchval(
+            "SELECT data_type FROM information_schema.columns WHERE table_name = $1 AND column_name = $2",
+            table, column
+        )
+        if data_type == "text":
+            await conn.execute(
+                f"""ALTER TABLE {table}
+                   ALTER COLUMN {column} DROP DEFAULT,
+                   ALTER COLUMN {column} TYPE JSONB USING {column}::jsonb,
+                   ALTER COLUMN {column} SET DEFAULT '[]'::jsonb"""
+            )
+            logger.info(f"Migrated {table}.{column} to JSONB")
+
+
+async def migrate_uuid_ids(conn):
+    # Retyping the key rewrites each table and its indexes under an ACCESS EXCLUSIVE lock that blocks reads too,
+    # so on a populated database this runs in a maintenance window. The lock timeout makes it fail fast instead of
+    # queueing every request behind it while a long transaction holds the table.
+    await conn.execute(f"SET LOCAL lock_timeout = {MIGRATION_LOCK_TIMEOUT_MS}")
+    for table in ("valentine_cards", "love_letters"):
+        rows = await conn.fetchval("SELECT reltuples::bigint FROM pg_class WHERE oid = $1::regclass", table)
+        logger.warning(f"Rewriting {table} (about {max(rows, 0)} rows) with UUID ids under an exclusive lock")
+        await conn.execute(f"ALTER TABLE {table} ALTER COLUMN id TYPE UUID USING id::uuid")
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS valentine_cards_created_at_idx ON valentine_cards (created_at);
+        CREATE INDEX IF NOT EXISTS love_letters_created_at_idx ON love_letters (created_at);
+        CREATE INDEX IF NOT EXISTS idempotency_keys_created_at_idx ON idempotency_keys (created_at);
+        CREATE INDEX IF NOT EXISTS valentine_cards_photos_idx ON valentine_cards USING GIN (photos jsonb_path_ops);
+        CREATE INDEX IF NOT EXISTS love_letters_photos_idx ON love_letters USING GIN (photos jsonb_path_ops);
+    """)
+
+
+MIGRATIONS = [
+    (1, "create valentine_cards and love_letters", """
+        CREATE TABLE IF NOT EXISTS valentine_cards (
+            id VARCHAR(36) PRIMARY KEY,
+            girlfriend_name VARCHAR(255) NOT NULL,
+            sender_name VARCHAR(255) NOT NULL,
+            description TEXT NOT NULL,
+            photos JSONB NOT NULL DEFAULT '[]',
+            poem TEXT NOT NULL DEFAULT '',
+            love_notes JSONB NOT NULL DEFAULT '[]',
+            scratch_message TEXT NOT NULL DEFAULT '',
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS love_letters (
+            id VARCHAR(36) PRIMARY KEY,
+            letter_type VARCHAR(50) NOT NULL,
+            recipient_name VARCHAR(255) NOT NULL,
+            sender_name VARCHAR(255) NOT NULL,
+            context TEXT NOT NULL DEFAULT '',
+            custom_prompt TEXT,
+            tone VARCHAR(50) NOT NULL DEFAULT 'romantic',
+            photos JSONB NOT NULL DEFAULT '[]',
+            content TEXT NOT NULL DEFAULT '',
+            template VARCHAR(50) NOT NULL DEFAULT 'classic',
+            font VARCHAR(50) NOT NULL DEFAULT 'playfair',
+            color_scheme VARCHAR(50) NOT NULL DEFAULT 'romantic-red',
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+    """),
+    (2, "create idempotency_keys", """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            kind VARCHAR(16) NOT NULL,
+            key VARCHAR(255) NOT NULL,
+            resource_id VARCHAR(36) NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            PRIMARY KEY (kind, key)
+        );
+    """),
+    (3, "convert photos and love_notes to JSONB", migrate_json_columns),
+    (4, "create generation_cache", """
+        CREATE TABLE IF NOT EXISTS generation_cache (
+            key VARCHAR(64) PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+        );
+    """),
+    (5, "add status columns and generation_jobs", """
+        ALTER TABLE valentine_cards ADD COLUMN IF NOT EXISTS status VARCHAR(16) NOT NULL DEFAULT 'ready';
+        ALTER TABLE love_letters ADD COLUMN IF NOT EXISTS status VARCHAR(16) NOT NULL DEFAULT 'ready';
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            kind VARCHAR(16) NOT NULL,
+            resource_id VARCHAR(36) NOT NULL,
+            payload JSONB NOT NULL DEFAULT '{}',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            run_after TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS generation_jobs_run_after_idx ON generation_jobs (run_after);
+    """),
+    (6, "create rate_limit_buckets", """
+        CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+            key VARCHAR(128) PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            allowed BOOLEAN NOT NULL DEFAULT TRUE,
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS rate_limit_buckets_updated_at_idx ON rate_limit_buckets (updated_at);
+    """),
+    (7, "native UUID ids and created_at/photo indexes", migrate_uuid_ids),
+    (8, "create photo_uploads", """
+        CREATE TABLE IF NOT EXISTS photo_uploads (
+            digest TEXT PRIMARY KEY,
+            uploaded_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS photo_uploads_uploaded_at_idx ON photo_uploads (uploaded_at);
+    """),
+    (9, "index generation_cache expiry", """
+        CREATE INDEX IF NOT EXISTS generation_cache_expires_at_idx ON generation_cache (expires_at);
+    """),
+    (10, "create blobs", """
+        CREATE TABLE IF NOT EXISTS blobs (
+            key TEXT PRIMARY KEY,
+            data BYTEA NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+        );
+        -- Images and compressed pages gain nothing from TOAST compression
+        ALTER TABLE blobs ALTER COLUMN data SET STORAGE EXTERNAL;
+    """),
+    (11, "add idempotency_keys.request_hash", """
+        ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS request_hash TEXT;
+    """),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def run_migrations(conn) -> int:
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+    try:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+            )
+        """)
+        current = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        for version, description, migration in MIGRATIONS:
+            if version <= current:
+                continue
+            async with conn.transaction():
+                if callable(migration):
+                    await migration(conn)
+                else:
+                    await conn.execute(migration)
+                await conn.execute(
+                    "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+                    version, description
+                )
+            logger.info(f"Applied migration {version}: {description}")
+            current = version
+        return current
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+
+
+async def check_schema_version(conn):
+    try:
+        current = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    except asyncpg.UndefinedTableError:
+        current = 0
+    if current < SCHEMA_VERSION:
+        logger.error(
+            f"Database schema is at version {current}, expected {SCHEMA_VERSION}. "
+            f"Run `python -m backend.server migrate` before starting workers."
+        )
 
-You are my today, my tomorrow, and my forever. Nothing in this world compares to the joy of loving you and being loved by you in return."""
+
+CLUSTER_CHANNEL = "valentine_events"
+# NOTIFY payloads are capped at 8000 bytes, so expired ids are sent in chunks of this many
+CLUSTER_IDS_PER_EVENT = 100
+
+
+class ClusterEvents:
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self.handlers: Dict[str, Callable[[dict], None]] = {}
+        self.conn: Optional[asyncpg.Connection] = None
+        self.task: Optional[asyncio.Task] = None
+        self.pending: set = set()
+        self.published = 0
+        self.received = 0
+        self.reconnects = 0
+
+    def on(self, event: str, handler: Callable[[dict], None]):
+        self.handlers[event] = handler
+
+    def dispatch(self, conn, pid: int, channel: str, payload: str):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        if message.get("origin") == self.origin:
+            return
+        handler = self.handlers.get(message.get("event"))
+        if handler is not None:
+            self.received += 1
+            handler(message)
+
+    def payload(self, event: str, fields: dict) -> str:
+        return json.dumps({"event": event, "origin": self.origin, **fields})
+
+    async def notify_in(self, conn, event: str, **fields):
+        if self.task is None:
+            return
+        await conn.execute("SELECT pg_notify($1, $2)", CLUSTER_CHANNEL, self.payload(event, fields))
+        self.published += 1
+
+    async def send(self, event: str, fields: dict):
+        try:
+            async with acquire_connection() as conn:
+                await self.notify_in(conn, event, **fields)
+        except Exception as e:
+            logger.warning(f"Failed to publish cluster event {event}: {e}")
+
+    def publish(self, event: str, **fields):
+        if self.task is None:
+            return
+        task = asyncio.get_running_loop().create_task(self.send(event, fields))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def listen(self):
+        while True:
+            try:
+                self.conn = await asyncpg.connect(DATABASE_URL)
+                await self.conn.add_listener(CLUSTER_CHANNEL, self.dispatch)
+                while True:
+                    await asyncio.sleep(CLUSTER_PING_INTERVAL)
+                    await self.conn.execute("SELECT 1")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Cluster event listener disconnected: {e}")
+            finally:
+                if self.conn is not None:
+                    self.conn.terminate()
+                    self.conn = None
+            self.reconnects += 1
+            await asyncio.sleep(CLUSTER_RECONNECT_DELAY)
+
+    def start(self):
+        if CLUSTER_EVENTS:
+            self.task = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        tasks = list(self.pending) + ([self.task] if self.task is not None else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.task = None
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.task is not None,
+            "connected": self.conn is not None and not self.conn.is_closed(),
+            "published": self.published,
+            "received": self.received,
+            "reconnects": self.reconnects,
+        }
+
+
+cluster_events = ClusterEvents()
+
+
+def open_key_from_peer(message: dict):
+    for state in key_scheduler.states:
+        if state.name == message.get("key"):
+            open_until = time.monotonic() + float(message.get("seconds", 0))
+            if open_until > state.open_until:
+                state.open_until = open_until
+                logger.info(f"Gemini key {state.name} opened by another worker for {message.get('seconds')}s")
+
+
+cluster_events.on("key_open", open_key_from_peer)
+cluster_events.on("job", lambda message: job_queue.notify())
+
+
+def discard_expired_from_peer(message: dict):
+    for resource_id in message.get("ids", []):
+        response_cache.discard(f"{message.get('kind')}:{resource_id}")
+
+
+cluster_events.on("expired", discard_expired_from_peer)
+
+
+JOB_TABLES = {"card": "valentine_cards", "letter": "love_letters"}
+
+CLAIM_JOB_SQL = """UPDATE generation_jobs
+   SET attempts = attempts + 1, run_after = NOW() + make_interval(secs => $1)
+   WHERE id = (
+       SELECT id FROM generation_jobs WHERE run_after <= NOW()
+       ORDER BY run_after, id FOR UPDATE SKIP LOCKED LIMIT 1
+   )
+   RETURNING id, kind, resource_id, payload, attempts"""
+
+
+class JobQueue:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.tasks: List[asyncio.Task] = []
+        self.wakeup = asyncio.Event()
+        self.enqueued = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.rejected = 0
+        self.duration = Histogram()
+
+    async def check_capacity(self):
+        async with acquire_connection() as conn:
+            depth = await conn.fetchval("SELECT count(*) FROM generation_jobs")
+        if depth >= JOB_QUEUE_CAPACITY:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=429,
+                detail="Generation queue is full, please retry shortly.",
+                headers={"Retry-After": str(int(JOB_RETRY_DELAY) or 1)},
+            )
+
+    async def enqueue(self, conn, kind: str, resource_id: str, payload: dict):
+        await conn.execute(
+            "INSERT INTO generation_jobs (kind, resource_id, payload) VALUES ($1, $2, $3)",
+            kind, resource_id, payload
+        )
+        await cluster_events.notify_in(conn, "job")
+        self.enqueued += 1
+
+    def notify(self):
+        self.wakeup.set()
+
+    async def claim(self) -> Optional[asyncpg.Record]:
+        async with acquire_connection() as conn:
+            return await conn.fetchrow(CLAIM_JOB_SQL, JOB_LEASE_SECONDS)
+
+    async def complete(self, conn, job_id: int):
+        await conn.execute("DELETE FROM generation_jobs WHERE id = $1", job_id)
+        self.completed += 1
+
+    async def fail(self, job: asyncpg.Record, error: Exception):
+        async with acquire_connection() as conn:
+            if job["attempts"] >= JOB_MAX_ATTEMPTS:
+                async with conn.transaction():
+                    await conn.execute(
+                        f"""UPDATE {JOB_TABLES[job['kind']]}
+                            SET status = CASE WHEN status = 'draft' THEN 'ready' ELSE 'failed' END
+                            WHERE id = $1""",
+                        job["resource_id"]
+                    )
+                    await conn.execute("DELETE FROM generation_jobs WHERE id = $1", job["id"])
+                self.failed += 1
+                logger.error(f"Job {job['id']} ({job['kind']} {job['resource_id']}) failed permanently: {error}")
+                return
+            await conn.execute(
+                """UPDATE generation_jobs
+                   SET run_after = NOW() + make_interval(secs => $2), last_error = $3
+                   WHERE id = $1""",
+                job["id"], JOB_RETRY_DELAY * 2 ** (job["attempts"] - 1), str(error)[:1000]
+            )
+        self.retried += 1
+        logger.warning(f"Job {job['id']} attempt {job['attempts']} failed: {error}")
+
+    async def run(self, job: asyncpg.Record):
+        started = time.monotonic()
+        try:
+            await JOB_HANDLERS[job["kind"]](job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self.fail(job, e)
+        finally:
+            self.duration.observe(time.monotonic() - started)
+
+    async def worker(self):
+        while True:
+            try:
+                job = await self.claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job queue poll failed: {e}")
+                job = None
+            if job is not None:
+                await self.run(job)
+                continue
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def snapshot(self) -> dict:
+        depth = ready = 0
+        if db_pool is not None:
+            async with acquire_connection() as conn:
+                row = await conn.fetchrow(
+                    "SELECT count(*) AS depth, count(*) FILTER (WHERE run_after <= NOW()) AS ready FROM generation_jobs"
+                )
+            depth, ready = row["depth"], row["ready"]
+        return {
+            "workers": len(self.tasks),
+            "capacity": JOB_QUEUE_CAPACITY,
+            "depth": depth,
+            "ready": ready,
+            "enqueued": self.enqueued,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "duration_seconds": self.duration.snapshot(),
+        }
+
+
+job_queue = JobQueue(JOB_WORKERS)
+
+
+async def run_card_job(job: asyncpg.Record):
+    async with acquire_connection() as conn:
+        card = await conn.fetchrow(
+            "SELECT girlfriend_name, description, sender_name FROM valentine_cards WHERE id = $1",
+            job["resource_id"]
+        )
+    if card is None:
+        async with acquire_connection() as conn:
+            await job_queue.complete(conn, job["id"])
+        return
+
+    try:
+        content = await generate_romantic_content(
+            card["girlfriend_name"], card["description"], card["sender_name"],
+            job["payload"].get("use_cache", True)
+        )
+    except GenerationUnavailable:
+        if job["attempts"] < JOB_MAX_ATTEMPTS:
+            raise
+        key_scheduler.record_template("card", "exhausted")
+        content = template_card_content(card["girlfriend_name"], card["description"], card["sender_name"])
+
+    async with acquire_connection() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                """UPDATE valentine_cards
+                   SET poem = $2, love_notes = $3, scratch_message = $4, status = 'ready'
+                   WHERE id = $1""",
+                job["resource_id"], content.poem, content.love_notes, content.scratch_message
+            )
+            await job_queue.complete(conn, job["id"])
+
+
+async def run_letter_job(job: asyncpg.Record):
+    async with acquire_connection() as conn:
+        letter = await conn.fetchrow(
+            """SELECT letter_type, recipient_name, sender_name, context, tone, custom_prompt
+               FROM love_letters WHERE id = $1""",
+            job["resource_id"]
+        )
+    if letter is None:
+        async with acquire_connection() as conn:
+            await job_queue.complete(conn, job["id"])
+        return
+
+    try:
+        content = await generate_letter_content(
+            letter["letter_type"], letter["recipient_name"], letter["sender_name"],
+            letter["context"], letter["tone"], letter["custom_prompt"] or None,
+            job["payload"].get("use_cache", True)
+        )
+    except GenerationUnavailable:
+        if job["attempts"] < JOB_MAX_ATTEMPTS:
+            raise
+        key_scheduler.record_template("letter", "exhausted")
+        content = template_letter_content(
+            letter["letter_type"], letter["recipient_name"], letter["sender_name"],
+            letter["context"], letter["tone"], letter["custom_prompt"] or None
+        )
+
+    async with acquire_connection() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                "UPDATE love_letters SET content = $2, status = 'ready' WHERE id = $1",
+                job["resource_id"], content
+            )
+            await job_queue.complete(conn, job["id"])
+
+
+JOB_HANDLERS: Dict[str, Callable[[asyncpg.Record], Awaitable[None]]] = {
+    "card": run_card_job,
+    "letter": run_letter_job,
+}
+
+
+RETENTION_LOCK_ID = 5_412_020_215
+RETENTION_TABLES = {"card": "valentine_cards", "letter": "love_letters"}
+
+EXPIRE_ROWS_SQL = """DELETE FROM {table} WHERE id IN (
+    SELECT id FROM {table} WHERE created_at < NOW() - make_interval(secs => $1)
+    ORDER BY created_at LIMIT $2 FOR UPDATE SKIP LOCKED
+) RETURNING id, photos"""
+
+EXPIRE_IDEMPOTENCY_KEYS_SQL = """DELETE FROM idempotency_keys WHERE (kind, key) IN (
+    SELECT kind, key FROM idempotency_keys WHERE created_at < NOW() - make_interval(secs => $1)
+    ORDER BY created_at LIMIT $2 FOR UPDATE SKIP LOCKED
+) RETURNING kind"""
+
+EXPIRE_UPLOADS_SQL = """DELETE FROM photo_uploads WHERE digest IN (
+    SELECT digest FROM photo_uploads WHERE uploaded_at < NOW() - make_interval(secs => $1)
+    ORDER BY uploaded_at LIMIT $2 FOR UPDATE SKIP LOCKED
+) RETURNING digest"""
+
+EXPIRE_GENERATION_CACHE_SQL = """DELETE FROM generation_cache WHERE key IN (
+    SELECT key FROM generation_cache WHERE expires_at < NOW() - make_interval(secs => $1)
+    ORDER BY expires_at LIMIT $2 FOR UPDATE SKIP LOCKED
+) RETURNING key"""
+
+PHOTO_REFERENCED_SQL = """SELECT EXISTS (SELECT 1 FROM valentine_cards WHERE photos @> jsonb_build_array($1::text))
+    OR EXISTS (SELECT 1 FROM love_letters WHERE photos @> jsonb_build_array($1::text))"""
+
+
+class RetentionJob:
+    def __init__(self, ttl_days: float):
+        self.ttl = ttl_days * 86400
+        self.task: Optional[asyncio.Task] = None
+        self.deleted: Dict[str, int] = {kind: 0 for kind in RETENTION_TABLES}
+        self.idempotency_keys = 0
+        self.uploads = 0
+        self.cache_entries = 0
+        self.blobs = 0
+        self.runs = 0
+        self.last_run: Optional[str] = None
+
+    async def expire(self, conn, sql: str, age: float) -> AsyncIterator[List[asyncpg.Record]]:
+        while True:
+            rows = await conn.fetch(sql, age, RETENTION_BATCH_SIZE)
+            yield rows
+            if len(rows) < RETENTION_BATCH_SIZE:
+                return
+            await asyncio.sleep(RETENTION_BATCH_PAUSE)
+
+    async def collect_photos(self, conn, digests: set):
+        for digest in digests:
+            if await conn.fetchval(PHOTO_REFERENCED_SQL, digest):
+                continue
+            for key in [digest] + [variant_key(digest, variant) for variant in IMAGE_VARIANTS]:
+                await blob_store.delete(key)
+            self.blobs += 1
+
+    async def sweep(self):
+        async with acquire_connection() as conn:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", RETENTION_LOCK_ID):
+                return
+            try:
+                digests = set()
+                if self.ttl > 0:
+                    for kind, table in RETENTION_TABLES.items():
+                        async for rows in self.expire(conn, EXPIRE_ROWS_SQL.format(table=table), self.ttl):
+                            self.deleted[kind] += len(rows)
+                            for row in rows:
+                                response_cache.discard(f"{kind}:{row['id']}")
+                                await blob_store.delete(f"og.{kind}.{row['id']}.v{OG_IMAGE_VERSION}")
+                                await blob_store.delete(f"share.{kind}.{row['id']}")
+                            ids = [str(row["id"]) for row in rows]
+                            for start in range(0, len(ids), CLUSTER_IDS_PER_EVENT):
+                                await cluster_events.notify_in(conn, "expired", kind=kind, ids=ids[start:start + CLUSTER_IDS_PER_EVENT])
+                            digests.update(photo for row in rows for photo in row["photos"] if DIGEST_RE.match(photo))
+                    async for rows in self.expire(conn, EXPIRE_IDEMPOTENCY_KEYS_SQL, self.ttl):
+                        self.idempotency_keys += len(rows)
+                # Uploads nothing referenced within the grace period are dropped along with their blobs
+                if UPLOAD_ORPHAN_HOURS > 0:
+                    async for rows in self.expire(conn, EXPIRE_UPLOADS_SQL, UPLOAD_ORPHAN_HOURS * 3600):
+                        self.uploads += len(rows)
+                        digests.update(row["digest"] for row in rows)
+                await self.collect_photos(conn, digests)
+                async for rows in self.expire(conn, EXPIRE_GENERATION_CACHE_SQL, 0):
+                    self.cache_entries += len(rows)
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", RETENTION_LOCK_ID)
+        self.runs += 1
+        self.last_run = datetime.now(timezone.utc).isoformat()
+
+    async def run(self):
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Retention sweep failed: {e}")
+            await asyncio.sleep(RETENTION_INTERVAL)
+
+    def start(self):
+        if self.ttl > 0 or UPLOAD_ORPHAN_HOURS > 0 or GENERATION_CACHE_DB:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.task is not None,
+            "ttl_days": self.ttl / 86400,
+            "runs": self.runs,
+            "last_run": self.last_run,
+            "deleted": self.deleted,
+            "idempotency_keys": self.idempotency_keys,
+            "uploads": self.uploads,
+            "generation_cache": self.cache_entries,
+            "blobs": self.blobs,
+        }
+
+
+retention_job = RetentionJob(RETENTION_DAYS)
+
+
+REFILLED_TOKENS_SQL = "LEAST($3::float8, b.tokens + EXTRACT(EPOCH FROM statement_timestamp() - b.updated_at)::float8 * $2::float8)"
+
+TAKE_TOKENS_SQL = f"""INSERT INTO rate_limit_buckets AS b (key, tokens, allowed, updated_at)
+   VALUES ($1, $3::float8 - $4::float8, TRUE, statement_timestamp())
+   ON CONFLICT (key) DO UPDATE SET
+       allowed = {REFILLED_TOKENS_SQL} >= $4::float8,
+       tokens = {REFILLED_TOKENS_SQL} - CASE WHEN {REFILLED_TOKENS_SQL} >= $4::float8 THEN $4::float8 ELSE 0 END,
+       updated_at = statement_timestamp()
+   RETURNING tokens, allowed"""
+
+
+class RateLimiter:
+    def __init__(self, backend: str, per_minute: float, burst: int, max_clients: int):
+        self.backend = backend
+        self.rate = per_minute / 60.0
+        self.burst = float(burst)
+        self.max_clients = max_clients
+        self.buckets: OrderedDict = OrderedDict()
+        self.allowed = 0
+        self.denied = 0
+        self.errors = 0
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend in ("memory", "postgres") and self.rate > 0
+
+    def take_memory(self, key: str, cost: float) -> float:
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / self.rate
+        self.buckets[key] = (tokens, now)
+        while len(self.buckets) > self.max_clients:
+            self.buckets.popitem(last=False)
+        return wait
+
+    async def take_postgres(self, key: str, cost: float) -> float:
+        async with acquire_connection() as conn:
+            row = await conn.fetchrow(TAKE_TOKENS_SQL, key, self.rate, self.burst, cost)
+        if row["allowed"]:
+            return 0.0
+        return (cost - row["tokens"]) / self.rate
+
+    async def take(self, key: str, cost: float) -> float:
+        if self.backend == "postgres" and db_pool is not None:
+            try:
+                return await self.take_postgres(key, cost)
+            except HTTPException:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Shared rate limit check failed, using local bucket: {e}")
+        return self.take_memory(key, cost)
+
+    async def check(self, request: Request, cost: int = 1):
+        if not self.enabled:
+            return
+        # A bucket never holds more than the burst, so a larger batch is charged a full bucket
+        wait = await self.take(client_key(request), float(min(cost, self.burst)))
+        if wait <= 0:
+            self.allowed += 1
+            return
+        self.denied += 1
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded, please slow down.",
+            headers={"Retry-After": str(max(1, math.ceil(wait)))},
+        )
+
+    async def prune(self):
+        while True:
+            await asyncio.sleep(60)
+            try:
+                async with acquire_connection() as conn:
+                    await conn.execute(
+                        "DELETE FROM rate_limit_buckets WHERE updated_at < NOW() - make_interval(secs => $1)",
+                        self.burst / self.rate
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Rate limit bucket cleanup failed: {e}")
+
+    def start(self):
+        if self.backend == "postgres" and self.enabled:
+            self.task = asyncio.create_task(self.prune())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def snapshot(self) -> dict:
+        return {
+            "backend": self.backend if self.enabled else "off",
+            "per_minute": RATE_LIMIT_PER_MINUTE,
+            "burst": RATE_LIMIT_BURST,
+            "local_clients": len(self.buckets),
+            "allowed": self.allowed,
+            "denied": self.denied,
+            "errors": self.errors,
+        }
+
+
+def client_key(request: Request) -> str:
+    authorization = request.headers.get("authorization", "")
+    token = authorization[7:].strip() if authorization.lower().startswith("bearer ") else request.headers.get("x-api-token", "")
+    if token and token in API_TOKENS:
+        return "token:" + hashlib.sha256(token.encode()).hexdigest()[:32]
+
+    host = request.client.host if request.client else "unknown"
+    forwarded = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    if RATE_LIMIT_PROXY_HOPS > 0:
+        if len(forwarded) >= RATE_LIMIT_PROXY_HOPS:
+            host = forwarded[-RATE_LIMIT_PROXY_HOPS]
+    elif forwarded:
+        warn_shared_proxy_bucket()
+    return "ip:" + host
+
+
+@lru_cache(maxsize=None)
+def warn_shared_proxy_bucket():
+    logger.warning(
+        "Requests carry X-Forwarded-For but RATE_LIMIT_PROXY_HOPS is 0, so every client behind the proxy "
+        "shares one rate limit bucket; set it to the number of trusted proxies in front of the app"
+    )
+
+
+rate_limiter = RateLimiter(RATE_LIMIT_BACKEND, RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST, RATE_LIMIT_MAX_CLIENTS)
+
+
+class AdmissionControl:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.average_seconds = 5.0
+
+    def full(self) -> bool:
+        return self.limit > 0 and self.in_flight >= self.limit
+
+    def reject_if_full(self):
+        if self.full():
+            self.rejected += 1
+            raise HTTPException(
+                status_code=429,
+                detail="Too many generations in progress, please retry shortly.",
+                headers={"Retry-After": str(max(1, math.ceil(self.average_seconds)))},
+            )
+
+    def acquire(self) -> float:
+        self.reject_if_full()
+        self.in_flight += 1
+        self.admitted += 1
+        return time.monotonic()
+
+    def release(self, started: float):
+        self.in_flight -= 1
+        self.average_seconds = 0.9 * self.average_seconds + 0.1 * (time.monotonic() - started)
+
+    @contextmanager
+    def admit(self):
+        started = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(started)
+
+    @asynccontextmanager
+    async def admit_queued(self):
+        while self.full():
+            await asyncio.sleep(ADMISSION_POLL_INTERVAL)
+        started = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(started)
+
+    def snapshot(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "average_seconds": round(self.average_seconds, 3),
+        }
+
+
+admission = AdmissionControl(GENERATION_MAX_IN_FLIGHT)
 
 
 @app.on_event("startup")
 async def startup():
     global db_pool
+    init_gemini_clients()
+    if isinstance(blob_store, LocalBlobStore) and (os.environ.get("K_SERVICE") or os.environ.get("REPLIT_DEPLOYMENT")):
+        logger.error(
+            f"Photos are stored under {BLOB_STORE_DIR} on this instance's own disk, which is lost on redeploy and "
+            "not shared between instances; set BLOB_STORE_BACKEND=postgres"
+        )
     if DATABASE_URL:
         try:
-            db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
-            async with db_pool.acquire() as conn:
-                await conn.execute("""
-                    CREATE TABLE IF NOT EXISTS valentine_cards (
-                        id VARCHAR(36) PRIMARY KEY,
-                        girlfriend_name VARCHAR(255) NOT NULL,
-                        sender_name VARCHAR(255) NOT NULL,
-                        description TEXT NOT NULL,
-                        photos TEXT NOT NULL DEFAULT '[]',
-                        poem TEXT NOT NULL DEFAULT '',
-                        love_notes TEXT NOT NULL DEFAULT '[]',
-                        scratch_message TEXT NOT NULL DEFAULT '',
-                        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-                    )
-                """)
-                await conn.execute("""
-                    CREATE TABLE IF NOT EXISTS love_letters (
-                        id VARCHAR(36) PRIMARY KEY,
-                        letter_type VARCHAR(50) NOT NULL,
-                        recipient_name VARCHAR(255) NOT NULL,
-                        sender_name VARCHAR(255) NOT NULL,
-                        context TEXT NOT NULL DEFAULT '',
-                        custom_prompt TEXT,
-                        tone VARCHAR(50) NOT NULL DEFAULT 'romantic',
-                        photos TEXT NOT NULL DEFAULT '[]',
-                        content TEXT NOT NULL DEFAULT '',
-                        template VARCHAR(50) NOT NULL DEFAULT 'classic',
-                        font VARCHAR(50) NOT NULL DEFAULT 'playfair',
-                        color_scheme VARCHAR(50) NOT NULL DEFAULT 'romantic-red',
-                        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-                    )
-                """)
-            logger.info("Database connected and table ready")
+            if RUN_MIGRATIONS_ON_STARTUP:
+                await migrate()
+            db_pool = await asyncpg.create_pool(
+                DATABASE_URL,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                command_timeout=DB_COMMAND_TIMEOUT,
+                statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                server_settings={"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)},
+                init=init_connection,
+            )
+            async with acquire_connection() as conn:
+                await check_schema_version(conn)
+            logger.info("Database connected")
         except Exception as e:
             logger.error(f"Database connection failed: {e}")
             db_pool = None
+    if db_pool is not None and JOB_WORKERS > 0:
+        job_queue.start()
+    if db_pool is not None:
+        rate_limiter.start()
+        cluster_events.start()
+        retention_job.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
     global db_pool
+    await job_queue.stop()
+    await rate_limiter.stop()
+    await cluster_events.stop()
+    await retention_job.stop()
+    # Generations outlive callers that gave up on their budget, so stop them before their clients close
+    await request_flights.cancel()
+    await generation_flights.cancel()
+    await close_gemini_clients()
+    shutdown_image_executor()
     if db_pool:
         await db_pool.close()
 
@@ -299,44 +2663,172 @@ async def root():
     return {"message": "Valentine Card API"}
 
 
-@api_router.post("/cards", response_model=CardResponse)
-async def create_card(card_data: CardCreate):
-    if db_pool is None:
-        raise HTTPException(status_code=503, detail="Database not configured.")
-    try:
-        content = await generate_romantic_content(
-            card_data.girlfriend_name,
-            card_data.description,
-            card_data.sender_name
-        )
+def request_hash(data: BaseModel) -> str:
+    return hashlib.sha256(data.model_dump_json().encode()).hexdigest()
 
-        card_id = str(uuid.uuid4())
-        created_at = datetime.now(timezone.utc).isoformat()
 
-        photos_json = json.dumps(card_data.photos)
-        love_notes_json = json.dumps(content.love_notes)
+def check_idempotent_request(row, request_digest: str) -> Optional[str]:
+    if row is None:
+        return None
+    # Keys claimed before request hashes were stored have none to compare against
+    if row["request_hash"] is not None and row["request_hash"] != request_digest:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request body")
+    return row["resource_id"]
 
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                """INSERT INTO valentine_cards (id, girlfriend_name, sender_name, description, photos, poem, love_notes, scratch_message, created_at)
-                   VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)""",
-                card_id, card_data.girlfriend_name, card_data.sender_name,
-                card_data.description, photos_json, content.poem,
-                love_notes_json, content.scratch_message,
-                datetime.now(timezone.utc)
-            )
 
-        return CardResponse(
-            id=card_id,
-            girlfriend_name=card_data.girlfriend_name,
-            sender_name=card_data.sender_name,
-            description=card_data.description,
-            photos=card_data.photos,
-            poem=content.poem,
-            love_notes=content.love_notes,
-            scratch_message=content.scratch_message,
-            created_at=created_at
+async def find_idempotent_resource(kind: str, idempotency_key: str, request_digest: str) -> Optional[str]:
+    async with acquire_connection() as conn:
+        row = await conn.fetchrow(
+            "SELECT resource_id, request_hash FROM idempotency_keys WHERE kind = $1 AND key = $2",
+            kind, idempotency_key
         )
+    return check_idempotent_request(row, request_digest)
+
+
+async def claim_idempotency_key(conn, kind: str, idempotency_key: Optional[str], resource_id: str, request_digest: Optional[str]) -> Optional[str]:
+    if not idempotency_key:
+        return None
+    claimed = await conn.fetchval(
+        """INSERT INTO idempotency_keys (kind, key, resource_id, request_hash) VALUES ($1, $2, $3, $4)
+           ON CONFLICT (kind, key) DO NOTHING RETURNING resource_id""",
+        kind, idempotency_key, resource_id, request_digest
+    )
+    if claimed is not None:
+        return None
+    row = await conn.fetchrow(
+        "SELECT resource_id, request_hash FROM idempotency_keys WHERE kind = $1 AND key = $2",
+        kind, idempotency_key
+    )
+    return check_idempotent_request(row, request_digest)
+
+
+def uuid7() -> uuid.UUID:
+    timestamp_ms = time.time_ns() // 1_000_000
+    random_bits = int.from_bytes(os.urandom(10), "big")
+    value = (timestamp_ms & (1 << 48) - 1) << 80
+    value |= 0x7 << 76 | (random_bits >> 68) << 64
+    value |= 0b10 << 62 | random_bits & (1 << 62) - 1
+    return uuid.UUID(int=value)
+
+
+def canonical_id(resource_id: str) -> Optional[str]:
+    try:
+        return str(uuid.UUID(resource_id))
+    except ValueError:
+        return None
+
+
+def card_record(card_data: CardCreate, photo_refs: List[str], content: GeneratedContent, status: str = "ready") -> Tuple[tuple, CardResponse]:
+    card_id = str(uuid7())
+    created_at = datetime.now(timezone.utc)
+    row = (
+        card_id, card_data.girlfriend_name, card_data.sender_name,
+        card_data.description, photo_refs, content.poem,
+        content.love_notes, content.scratch_message,
+        created_at, status
+    )
+    card = CardResponse(
+        id=card_id,
+        girlfriend_name=card_data.girlfriend_name,
+        sender_name=card_data.sender_name,
+        description=card_data.description,
+        photos=photo_urls(photo_refs),
+        poem=content.poem,
+        love_notes=content.love_notes,
+        scratch_message=content.scratch_message,
+        created_at=created_at.isoformat(timespec="microseconds"),
+        status=status
+    )
+    return row, card
+
+
+async def save_card(card_data: CardCreate, photo_refs: List[str], content: GeneratedContent, idempotency_key: Optional[str] = None, status: str = "ready") -> CardResponse:
+    row, card = card_record(card_data, photo_refs, content, status)
+    card_id = card.id
+    request_digest = request_hash(card_data) if idempotency_key else None
+
+    async with acquire_connection() as conn:
+        async with conn.transaction():
+            existing_id = await claim_idempotency_key(conn, "card", idempotency_key, card_id, request_digest)
+            if existing_id is None:
+                await run_statement(conn, "insert_card", "execute", *row)
+                if status != "ready":
+                    await job_queue.enqueue(conn, "card", card_id, {"use_cache": status == "draft" or card_data.use_cache is not False})
+
+    if existing_id is not None:
+        return await existing_card(existing_id)
+
+    if status != "ready":
+        job_queue.notify()
+    else:
+        with timed_phase("json"):
+            response_cache.put(f"card:{card_id}", card.model_dump_json().encode())
+    return card
+
+
+async def compose_card(card_data: CardCreate) -> Tuple[GeneratedContent, bool]:
+    content = await generate_within_budget("card", lambda: generate_romantic_content(
+        card_data.girlfriend_name,
+        card_data.description,
+        card_data.sender_name,
+        card_data.use_cache is not False
+    ), GENERATION_BUDGET_SECONDS)
+    if content is not None:
+        return content, True
+    return template_card_content(card_data.girlfriend_name, card_data.description, card_data.sender_name), False
+
+
+async def build_card(card_data: CardCreate, idempotency_key: Optional[str] = None, allow_draft: bool = False) -> CardResponse:
+    photo_refs = await store_photos(card_data.photos)
+    content, generated = await compose_card(card_data)
+    status = "draft" if allow_draft and not generated and GENERATION_UPGRADE else "ready"
+    return await save_card(card_data, photo_refs, content, idempotency_key, status)
+
+
+async def queue_card(card_data: CardCreate, idempotency_key: Optional[str] = None) -> CardResponse:
+    await job_queue.check_capacity()
+    photo_refs = await store_photos(card_data.photos)
+    content = GeneratedContent(poem="", love_notes=[], scratch_message="")
+    return await save_card(card_data, photo_refs, content, idempotency_key, status="pending")
+
+
+def prefers_async(request: Request) -> bool:
+    return "respond-async" in request.headers.get("Prefer", "").lower()
+
+
+def created_response(resource) -> Response:
+    with timed_phase("json"):
+        body = resource.model_dump_json()
+    if resource.status == "ready":
+        return Response(content=body, media_type="application/json")
+    return Response(content=body, status_code=202, media_type="application/json", headers=PENDING_HEADERS)
+
+
+@api_router.post("/cards", response_model=CardResponse)
+async def create_card(
+    card_data: CardCreate,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    run_async: bool = Query(False, alias="async"),
+):
+    if db_pool is None:
+        raise HTTPException(status_code=503, detail="Database not configured.")
+    # Template content is only handed out as a 202 draft to clients that asked for an async answer
+    build = queue_card if run_async else partial(build_card, allow_draft=prefers_async(request))
+    try:
+        if idempotency_key:
+            request_digest = request_hash(card_data)
+            existing_id = await find_idempotent_resource("card", idempotency_key, request_digest)
+            if existing_id is not None:
+                return created_response(await existing_card(existing_id))
+
+        await rate_limiter.check(request)
+        with nullcontext() if run_async else admission.admit():
+            if not idempotency_key:
+                return created_response(await build(card_data))
+            return created_response(await request_flights.run(
+                f"card:{idempotency_key}:{request_digest}", lambda: build(card_data, idempotency_key)
+            ))
     except HTTPException:
         raise
     except Exception as e:
@@ -344,75 +2836,173 @@ async def create_card(card_data: CardCreate):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def compact_document(text: str) -> bytes:
+    # json_build_object spaces out its separators; match the compact bodies cached on write under the same ETag
+    return orjson.dumps(orjson.loads(text))
+
+
+async def load_card(card_id: str) -> Optional[Tuple[bytes, str]]:
+    cache_key = f"card:{card_id}"
+    body = response_cache.get(cache_key)
+    if body is not None:
+        return body, "ready"
+
+    async with acquire_connection() as conn:
+        row = await run_statement(conn, "select_card", "fetchrow", card_id)
+
+    if row is None:
+        return None
+
+    body, status = compact_document(row[0]), row["status"]
+    if status == "ready":
+        response_cache.put(cache_key, body)
+    return body, status
+
+
+async def existing_card(card_id: str) -> CardResponse:
+    loaded = await load_card(card_id)
+    if loaded is None:
+        raise HTTPException(status_code=404, detail="Card not found")
+    with timed_phase("json"):
+        return CardResponse.model_validate_json(loaded[0])
+
+
 @api_router.get("/cards/{card_id}", response_model=CardResponse)
-async def get_card(card_id: str):
+async def get_card(card_id: str, request: Request):
+    card_id = canonical_id(card_id)
+    if card_id is None:
+        raise HTTPException(status_code=404, detail="Card not found")
+
+    etag = resource_etag("card", card_id)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=resource_headers(etag))
+
     if db_pool is None:
         raise HTTPException(status_code=503, detail="Database not configured.")
 
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM valentine_cards WHERE id = $1", card_id)
-
-    if not row:
+    loaded = await load_card(card_id)
+    if loaded is None:
         raise HTTPException(status_code=404, detail="Card not found")
 
-    return CardResponse(
-        id=row["id"],
-        girlfriend_name=row["girlfriend_name"],
-        sender_name=row["sender_name"],
-        description=row["description"],
-        photos=json.loads(row["photos"]),
-        poem=row["poem"],
-        love_notes=json.loads(row["love_notes"]),
-        scratch_message=row["scratch_message"],
-        created_at=row["created_at"].isoformat()
+    body, status = loaded
+    headers = resource_headers(etag) if status == "ready" else PENDING_HEADERS
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def letter_record(letter_data: LetterCreate, photo_refs: List[str], content: str, status: str = "ready") -> Tuple[tuple, LetterResponse]:
+    letter_id = str(uuid7())
+    created_at = datetime.now(timezone.utc)
+    row = (
+        letter_id, letter_data.letter_type, letter_data.recipient_name,
+        letter_data.sender_name, letter_data.context,
+        letter_data.custom_prompt or "", letter_data.tone or "romantic",
+        photo_refs, content, letter_data.template or "classic",
+        letter_data.font or "playfair", letter_data.color_scheme or "romantic-red",
+        created_at, status
     )
+    letter = LetterResponse(
+        id=letter_id,
+        letter_type=letter_data.letter_type,
+        recipient_name=letter_data.recipient_name,
+        sender_name=letter_data.sender_name,
+        context=letter_data.context,
+        # Stored as "" and read back as null, so a cached and a cold read give the same body for one ETag
+        custom_prompt=letter_data.custom_prompt or None,
+        tone=letter_data.tone or "romantic",
+        photos=photo_urls(photo_refs),
+        content=content,
+        template=letter_data.template or "classic",
+        font=letter_data.font or "playfair",
+        color_scheme=letter_data.color_scheme or "romantic-red",
+        created_at=created_at.isoformat(timespec="microseconds"),
+        status=status
+    )
+    return row, letter
+
+
+async def save_letter(letter_data: LetterCreate, photo_refs: List[str], content: str, idempotency_key: Optional[str] = None, status: str = "ready") -> LetterResponse:
+    row, letter = letter_record(letter_data, photo_refs, content, status)
+    letter_id = letter.id
+    request_digest = request_hash(letter_data) if idempotency_key else None
+
+    async with acquire_connection() as conn:
+        async with conn.transaction():
+            existing_id = await claim_idempotency_key(conn, "letter", idempotency_key, letter_id, request_digest)
+            if existing_id is None:
+                await run_statement(conn, "insert_letter", "execute", *row)
+                if status != "ready":
+                    await job_queue.enqueue(conn, "letter", letter_id, {"use_cache": status == "draft" or letter_data.use_cache is not False})
+
+    if existing_id is not None:
+        return await existing_letter(existing_id)
+
+    if status != "ready":
+        job_queue.notify()
+    else:
+        with timed_phase("json"):
+            response_cache.put(f"letter:{letter_id}", letter.model_dump_json().encode())
+    return letter
+
+
+async def compose_letter(letter_data: LetterCreate) -> Tuple[str, bool]:
+    content = await generate_within_budget("letter", lambda: generate_letter_content(
+        letter_data.letter_type,
+        letter_data.recipient_name,
+        letter_data.sender_name,
+        letter_data.context,
+        letter_data.tone or "romantic",
+        letter_data.custom_prompt,
+        letter_data.use_cache is not False
+    ), GENERATION_BUDGET_SECONDS)
+    if content is not None:
+        return content, True
+    return template_letter_content(
+        letter_data.letter_type,
+        letter_data.recipient_name,
+        letter_data.sender_name,
+        letter_data.context,
+        letter_data.tone or "romantic",
+        letter_data.custom_prompt
+    ), False
+
+
+async def build_letter(letter_data: LetterCreate, idempotency_key: Optional[str] = None, allow_draft: bool = False) -> LetterResponse:
+    photo_refs = await store_photos(letter_data.photos or [])
+    content, generated = await compose_letter(letter_data)
+    status = "draft" if allow_draft and not generated and GENERATION_UPGRADE else "ready"
+    return await save_letter(letter_data, photo_refs, content, idempotency_key, status)
+
+
+async def queue_letter(letter_data: LetterCreate, idempotency_key: Optional[str] = None) -> LetterResponse:
+    await job_queue.check_capacity()
+    photo_refs = await store_photos(letter_data.photos or [])
+    return await save_letter(letter_data, photo_refs, "", idempotency_key, status="pending")
 
 
 @api_router.post("/letters", response_model=LetterResponse)
-async def create_letter(letter_data: LetterCreate):
+async def create_letter(
+    letter_data: LetterCreate,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    run_async: bool = Query(False, alias="async"),
+):
     if db_pool is None:
         raise HTTPException(status_code=503, detail="Database not configured.")
+    build = queue_letter if run_async else partial(build_letter, allow_draft=prefers_async(request))
     try:
-        content = await generate_letter_content(
-            letter_data.letter_type,
-            letter_data.recipient_name,
-            letter_data.sender_name,
-            letter_data.context,
-            letter_data.tone or "romantic",
-            letter_data.custom_prompt
-        )
-
-        letter_id = str(uuid.uuid4())
-        created_at = datetime.now(timezone.utc).isoformat()
-        photos_json = json.dumps(letter_data.photos or [])
-
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                """INSERT INTO love_letters (id, letter_type, recipient_name, sender_name, context, custom_prompt, tone, photos, content, template, font, color_scheme, created_at)
-                   VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)""",
-                letter_id, letter_data.letter_type, letter_data.recipient_name,
-                letter_data.sender_name, letter_data.context,
-                letter_data.custom_prompt or "", letter_data.tone or "romantic",
-                photos_json, content, letter_data.template or "classic",
-                letter_data.font or "playfair", letter_data.color_scheme or "romantic-red",
-                datetime.now(timezone.utc)
-            )
-
-        return LetterResponse(
-            id=letter_id,
-            letter_type=letter_data.letter_type,
-            recipient_name=letter_data.recipient_name,
-            sender_name=letter_data.sender_name,
-            context=letter_data.context,
-            custom_prompt=letter_data.custom_prompt,
-            tone=letter_data.tone or "romantic",
-            photos=letter_data.photos or [],
-            content=content,
-            template=letter_data.template or "classic",
-            font=letter_data.font or "playfair",
-            color_scheme=letter_data.color_scheme or "romantic-red",
-            created_at=created_at
-        )
+        if idempotency_key:
+            request_digest = request_hash(letter_data)
+            existing_id = await find_idempotent_resource("letter", idempotency_key, request_digest)
+            if existing_id is not None:
+                return created_response(await existing_letter(existing_id))
+
+        await rate_limiter.check(request)
+        with nullcontext() if run_async else admission.admit():
+            if not idempotency_key:
+                return created_response(await build(letter_data))
+            return created_response(await request_flights.run(
+                f"letter:{idempotency_key}:{request_digest}", lambda: build(letter_data, idempotency_key)
+            ))
     except HTTPException:
         raise
     except Exception as e:
@@ -420,34 +3010,757 @@ async def create_letter(letter_data: LetterCreate):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@api_router.get("/letters/{letter_id}", response_model=LetterResponse)
-async def get_letter(letter_id: str):
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@api_router.post("/letters/stream")
+async def create_letter_stream(letter_data: LetterCreate, request: Request):
     if db_pool is None:
         raise HTTPException(status_code=503, detail="Database not configured.")
+    await rate_limiter.check(request)
+    admission.reject_if_full()
+    photo_refs = await store_photos(letter_data.photos or [])
+
+    async def event_stream():
+        # The slot is taken once the body is iterated, so a response that is never sent cannot leak it
+        parts = []
+        try:
+            with admission.admit():
+                async for event, text in stream_letter_content(
+                    letter_data.letter_type,
+                    letter_data.recipient_name,
+                    letter_data.sender_name,
+                    letter_data.context,
+                    letter_data.tone or "romantic",
+                    letter_data.custom_prompt,
+                    letter_data.use_cache is not False
+                ):
+                    if event == "reset":
+                        parts = []
+                        yield sse_event("reset", {})
+                        continue
+                    parts.append(text)
+                    yield sse_event("chunk", {"text": text})
+
+                letter = await save_letter(letter_data, photo_refs, "".join(parts).strip())
+            yield sse_event("done", letter.model_dump())
+        except HTTPException as e:
+            yield sse_event("error", {"detail": e.detail})
+        except Exception as e:
+            logger.error(f"Error streaming letter: {e}")
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def load_letter(letter_id: str) -> Optional[Tuple[bytes, str]]:
+    cache_key = f"letter:{letter_id}"
+    body = response_cache.get(cache_key)
+    if body is not None:
+        return body, "ready"
+
+    async with acquire_connection() as conn:
+        row = await run_statement(conn, "select_letter", "fetchrow", letter_id)
+
+    if row is None:
+        return None
+
+    body, status = compact_document(row[0]), row["status"]
+    if status == "ready":
+        response_cache.put(cache_key, body)
+    return body, status
+
+
+async def existing_letter(letter_id: str) -> LetterResponse:
+    loaded = await load_letter(letter_id)
+    if loaded is None:
+        raise HTTPException(status_code=404, detail="Letter not found")
+    with timed_phase("json"):
+        return LetterResponse.model_validate_json(loaded[0])
 
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM love_letters WHERE id = $1", letter_id)
 
-    if not row:
+@api_router.get("/letters/{letter_id}", response_model=LetterResponse)
+async def get_letter(letter_id: str, request: Request):
+    letter_id = canonical_id(letter_id)
+    if letter_id is None:
         raise HTTPException(status_code=404, detail="Letter not found")
 
-    return LetterResponse(
-        id=row["id"],
-        letter_type=row["letter_type"],
-        recipient_name=row["recipient_name"],
-        sender_name=row["sender_name"],
-        context=row["context"],
-        custom_prompt=row["custom_prompt"] if row["custom_prompt"] else None,
-        tone=row["tone"],
-        photos=json.loads(row["photos"]),
-        content=row["content"],
-        template=row["template"],
-        font=row["font"],
-        color_scheme=row["color_scheme"],
-        created_at=row["created_at"].isoformat()
+    etag = resource_etag("letter", letter_id)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=resource_headers(etag))
+
+    if db_pool is None:
+        raise HTTPException(status_code=503, detail="Database not configured.")
+
+    loaded = await load_letter(letter_id)
+    if loaded is None:
+        raise HTTPException(status_code=404, detail="Letter not found")
+
+    body, status = loaded
+    headers = resource_headers(etag) if status == "ready" else PENDING_HEADERS
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+async def prepare_card(card_data: CardCreate) -> Tuple[tuple, CardResponse]:
+    photo_refs = await store_photos(card_data.photos)
+    content, _ = await compose_card(card_data)
+    return card_record(card_data, photo_refs, content)
+
+
+async def prepare_letter(letter_data: LetterCreate) -> Tuple[tuple, LetterResponse]:
+    photo_refs = await store_photos(letter_data.photos or [])
+    content, _ = await compose_letter(letter_data)
+    return letter_record(letter_data, photo_refs, content)
+
+
+def ndjson_line(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data) + b"\n"
+    return json.dumps(data).encode() + b"\n"
+
+
+async def stream_batch(kind: str, items: list, prepare: Callable[..., Awaitable[tuple]]) -> AsyncIterator[bytes]:
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def run(index: int, item):
+        async with semaphore:
+            try:
+                # Each running item holds its own generation slot, queueing behind other requests when full
+                async with admission.admit_queued():
+                    record = await prepare(item)
+                results.put_nowait((index, record, None))
+            except HTTPException as e:
+                results.put_nowait((index, None, str(e.detail)))
+            except Exception as e:
+                logger.error(f"Batch {kind} item {index} failed: {e}")
+                results.put_nowait((index, None, str(e)))
+
+    tasks = [asyncio.create_task(run(index, item)) for index, item in enumerate(items)]
+    remaining = len(items)
+    succeeded = failed = 0
+    try:
+        while remaining:
+            done = [await results.get()]
+            while len(done) < BATCH_WRITE_SIZE and not results.empty():
+                done.append(results.get_nowait())
+            remaining -= len(done)
+
+            records = []
+            for index, record, error in done:
+                if record is None:
+                    failed += 1
+                    yield ndjson_line({"index": index, "status": "error", "error": error})
+                else:
+                    records.append((index, record))
+            if not records:
+                continue
+
+            try:
+                async with acquire_connection() as conn:
+                    await run_statement(conn, f"insert_{kind}", "executemany", [row for _, (row, _) in records])
+            except Exception as e:
+                logger.error(f"Batch {kind} write of {len(records)} rows failed: {e}")
+                failed += len(records)
+                for index, _ in records:
+                    yield ndjson_line({"index": index, "status": "error", "error": "Failed to save."})
+                continue
+
+            for index, (_, resource) in records:
+                with timed_phase("json"):
+                    body = resource.model_dump_json()
+                response_cache.put(f"{kind}:{resource.id}", body.encode())
+                succeeded += 1
+                yield f'{{"index": {index}, "status": "ok", "{kind}": {body}}}\n'.encode()
+
+        yield ndjson_line({"done": True, "succeeded": succeeded, "failed": failed})
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def batch_response(request: Request, kind: str, items: list, prepare: Callable[..., Awaitable[tuple]]) -> StreamingResponse:
+    if db_pool is None:
+        raise HTTPException(status_code=503, detail="Database not configured.")
+    await rate_limiter.check(request, len(items))
+    admission.reject_if_full()
+    return StreamingResponse(
+        stream_batch(kind, items, prepare),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
+@api_router.post("/cards/batch")
+async def create_cards_batch(batch: CardBatchCreate, request: Request):
+    return await batch_response(request, "card", batch.cards, prepare_card)
+
+
+@api_router.post("/letters/batch")
+async def create_letters_batch(batch: LetterBatchCreate, request: Request):
+    return await batch_response(request, "letter", batch.letters, prepare_letter)
+
+
+@api_router.get("/metrics/keys")
+async def get_key_metrics():
+    return key_scheduler.snapshot()
+
+
+@api_router.get("/metrics/cache")
+async def get_cache_metrics():
+    return {
+        **generation_cache.snapshot(),
+        "in_flight": len(generation_flights.calls),
+        "coalesced": generation_flights.coalesced,
+        "idempotent_replays": request_flights.coalesced,
+    }
+
+
+@api_router.get("/metrics/responses")
+async def get_response_cache_metrics():
+    return {**response_cache.snapshot(), "compression": response_compressor.snapshot()}
+
+
+@api_router.get("/metrics/db")
+async def get_db_metrics():
+    return db_metrics.snapshot()
+
+
+@api_router.get("/metrics/limits")
+async def get_limit_metrics():
+    return {"rate_limit": rate_limiter.snapshot(), "admission": admission.snapshot()}
+
+
+@api_router.get("/metrics/cluster")
+async def get_cluster_metrics():
+    return {"pid": os.getpid(), **cluster_events.snapshot()}
+
+
+@api_router.get("/metrics/retention")
+async def get_retention_metrics():
+    return retention_job.snapshot()
+
+
+@api_router.get("/metrics/jobs")
+async def get_job_metrics():
+    return await job_queue.snapshot()
+
+
+RECORD_UPLOADS_SQL = """INSERT INTO photo_uploads (digest) SELECT unnest($1::text[])
+   ON CONFLICT (digest) DO UPDATE SET uploaded_at = NOW()"""
+
+
+@api_router.post("/photos")
+async def upload_photos(request: Request):
+    await rate_limiter.check(request)
+    digests = await receive_photos(request)
+    if db_pool is not None:
+        async with acquire_connection() as conn:
+            await conn.execute(RECORD_UPLOADS_SQL, digests)
+    return {"photos": photo_urls(digests)}
+
+
+@api_router.get("/photos/{digest}")
+async def get_photo(digest: str, request: Request, variant: str = DEFAULT_IMAGE_VARIANT):
+    if not DIGEST_RE.match(digest) or variant not in IMAGE_VARIANTS:
+        raise HTTPException(status_code=404, detail="Photo not found")
+
+    key = variant_key(digest, variant)
+    etag = f'"{digest}-{variant}"'
+    headers = {"ETag": etag, "Cache-Control": PHOTO_CACHE_CONTROL}
+    if etag_matches(request, etag) and await blob_store.exists(key):
+        return Response(status_code=304, headers=headers)
+
+    data = await blob_store.get(key)
+    if data is None:
+        etag = f'"{digest}"'
+        headers["ETag"] = etag
+        if etag_matches(request, etag) and await blob_store.exists(digest):
+            return Response(status_code=304, headers=headers)
+        data = await blob_store.get(digest)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Photo not found")
+
+    return Response(content=data, media_type=sniff_image_type(data), headers=headers)
+
+
+OG_IMAGE_VERSION = "1"
+OG_IMAGE_SIZE = (1200, 630)
+OG_MARGIN = 60
+OG_BACKGROUND = (158, 42, 43)
+OG_TITLE_COLOR = (255, 209, 220)
+OG_TEXT_COLOR = (255, 255, 255)
+
+
+def wrap_text(draw: ImageDraw.ImageDraw, text: str, font, width: int) -> List[str]:
+    lines = []
+    for paragraph in text.splitlines():
+        line = ""
+        for word in paragraph.split():
+            candidate = f"{line} {word}".strip()
+            if line and draw.textlength(candidate, font=font) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        if line:
+            lines.append(line)
+    return lines
+
+
+def render_og_image(title: str, excerpt: str, photo: Optional[bytes]) -> bytes:
+    image = Image.new("RGB", OG_IMAGE_SIZE, OG_BACKGROUND)
+    text_left = OG_MARGIN
+    if photo is not None:
+        try:
+            with Image.open(io.BytesIO(photo)) as source:
+                side = OG_IMAGE_SIZE[1] - 2 * OG_MARGIN
+                image.paste(ImageOps.fit(source.convert("RGB"), (side, side)), (OG_MARGIN, OG_MARGIN))
+                text_left = side + 2 * OG_MARGIN
+        except (UnidentifiedImageError, OSError):
+            pass
+
+    draw = ImageDraw.Draw(image)
+    width = OG_IMAGE_SIZE[0] - text_left - OG_MARGIN
+    title_font = ImageFont.load_default(size=56)
+    body_font = ImageFont.load_default(size=32)
+    y = OG_MARGIN + 20
+    for line in wrap_text(draw, title, title_font, width)[:2]:
+        draw.text((text_left, y), line, font=title_font, fill=OG_TITLE_COLOR)
+        y += 70
+    y += 30
+    lines = wrap_text(draw, excerpt, body_font, width)
+    max_lines = (OG_IMAGE_SIZE[1] - OG_MARGIN - y) // 44
+    if len(lines) > max_lines:
+        lines = lines[:max_lines - 1] + [lines[max_lines - 1].rstrip(".,;") + "..."]
+    for line in lines:
+        draw.text((text_left, y), line, font=body_font, fill=OG_TEXT_COLOR)
+        y += 44
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=85, optimize=True)
+    return output.getvalue()
+
+
+def share_summary(kind: str, resource: dict) -> Tuple[str, str]:
+    if kind == "card":
+        return f"A Valentine for {resource['girlfriend_name']}", resource["poem"]
+    return f"A letter for {resource['recipient_name']}", resource["content"]
+
+
+async def load_ready_resource(kind: str, resource_id: str) -> Optional[Tuple[bytes, dict]]:
+    loaded = await (load_card if kind == "card" else load_letter)(resource_id)
+    if loaded is None or loaded[1] != "ready":
+        return None
+    with timed_phase("json"):
+        return loaded[0], json.loads(loaded[0])
+
+
+async def first_photo(resource: dict) -> Optional[bytes]:
+    for photo in resource["photos"][:1]:
+        digest = photo[len(PHOTO_URL_PREFIX):] if photo.startswith(PHOTO_URL_PREFIX) else photo
+        if DIGEST_RE.match(digest):
+            return await blob_store.get(variant_key(digest, "display")) or await blob_store.get(digest)
+    return None
+
+
+async def og_image_response(kind: str, resource_id: str, request: Request) -> Response:
+    resource_id = canonical_id(resource_id)
+    if resource_id is None:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    key = f"og.{kind}.{resource_id}.v{OG_IMAGE_VERSION}"
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": PHOTO_CACHE_CONTROL}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    data = await blob_store.get(key)
+    if data is None:
+        if db_pool is None:
+            raise HTTPException(status_code=503, detail="Database not configured.")
+        loaded = await load_ready_resource(kind, resource_id)
+        if loaded is None:
+            raise HTTPException(status_code=404, detail="Not found")
+        resource = loaded[1]
+        title, excerpt = share_summary(kind, resource)
+        data = await asyncio.get_running_loop().run_in_executor(
+            get_image_executor(), render_og_image, title, excerpt, await first_photo(resource)
+        )
+        await blob_store.put(key, data)
+    return Response(content=data, media_type="image/jpeg", headers=headers)
+
+
+@api_router.get("/cards/{card_id}/og.jpg", include_in_schema=False)
+async def get_card_og_image(card_id: str, request: Request):
+    return await og_image_response("card", card_id, request)
+
+
+@api_router.get("/letters/{letter_id}/og.jpg", include_in_schema=False)
+async def get_letter_og_image(letter_id: str, request: Request):
+    return await og_image_response("letter", letter_id, request)
+
+
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.requests: Dict[Tuple[str, str, int], int] = {}
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        self.response_bytes: Dict[Tuple[str, str], Histogram] = {}
+        self.phases: Dict[Tuple[str, str, str], Histogram] = {}
+
+    def observe(self, method: str, route: str, status_code: int, elapsed: float, size: int, phases: Dict[str, float]):
+        key = (method, route)
+        self.requests[(method, route, status_code)] = self.requests.get((method, route, status_code), 0) + 1
+        self.latency.setdefault(key, Histogram()).observe(elapsed)
+        self.response_bytes.setdefault(key, Histogram(SIZE_BUCKETS)).observe(size)
+        for phase, seconds in phases.items():
+            if seconds:
+                self.phases.setdefault((method, route, phase), Histogram()).observe(seconds)
+
+
+request_metrics = RequestMetrics()
+
+
+def route_label(scope) -> str:
+    if scope["path"].startswith("/static/"):
+        return "/static"
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    return "unmatched"
+
+
+CONTENT_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def compress(data: bytes, encoding: str, gzip_level: int = 9, brotli_quality: int = 11) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+
+def negotiate_encoding(request: Request, available) -> Optional[str]:
+    accepted: Dict[str, float] = {}
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    for encoding, _ in CONTENT_ENCODINGS:
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        phases = {phase: 0.0 for phase in REQUEST_PHASES}
+        token = request_phases.set(phases)
+        status_code = 500
+        size = 0
+
+        async def send_with_metrics(message):
+            nonlocal status_code, size
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            request_phases.reset(token)
+            request_metrics.observe(
+                scope["method"], route_label(scope), status_code, time.perf_counter() - start, size, phases
+            )
+
+
+class BodyLimitMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT", "PATCH") or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+
+        detail = f"Request body must be at most {format_bytes(UPLOAD_MAX_REQUEST_BYTES)}"
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > UPLOAD_MAX_REQUEST_BYTES:
+            response = JSONResponse({"detail": detail}, status_code=413, headers={"Connection": "close"})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > UPLOAD_MAX_REQUEST_BYTES:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, receive_limited, send)
+
+
+API_COMPRESSIBLE_TYPES = {"application/json", "text/plain", "text/html"}
+
+
+def compress_timed(body: bytes, encoding: str) -> Tuple[bytes, float]:
+    start = time.thread_time()
+    compressed = compress(body, encoding, API_GZIP_LEVEL, API_BROTLI_QUALITY)
+    return compressed, time.thread_time() - start
+
+
+class ResponseCompressor:
+    def __init__(self, cache: ResponseCache):
+        self.cache = cache
+        self.raw_bytes: Dict[str, int] = {}
+        self.compressed_bytes: Dict[str, int] = {}
+        self.cpu_seconds = Histogram()
+
+    async def compress(self, body: bytes, encoding: str, etag: Optional[str]) -> bytes:
+        cache_key = f"{etag}:{encoding}" if etag and not etag.startswith("W/") else None
+        compressed = self.cache.get(cache_key) if cache_key else None
+        if compressed is None:
+            if len(body) >= API_COMPRESSION_THREAD_BYTES:
+                compressed, cpu = await asyncio.to_thread(compress_timed, body, encoding)
+            else:
+                compressed, cpu = compress_timed(body, encoding)
+            self.cpu_seconds.observe(cpu)
+            if cache_key:
+                self.cache.put(cache_key, compressed)
+        self.raw_bytes[encoding] = self.raw_bytes.get(encoding, 0) + len(body)
+        self.compressed_bytes[encoding] = self.compressed_bytes.get(encoding, 0) + len(compressed)
+        return compressed
+
+    def snapshot(self) -> dict:
+        return {
+            "encodings": API_COMPRESSION_ENCODINGS,
+            "raw_bytes": self.raw_bytes,
+            "compressed_bytes": self.compressed_bytes,
+            "cpu_seconds": self.cpu_seconds.snapshot(),
+            "cache": self.cache.snapshot(),
+        }
+
+
+response_compressor = ResponseCompressor(ResponseCache(API_COMPRESSION_CACHE_BYTES, RESPONSE_CACHE_MAX_ENTRY_BYTES))
+
+
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not API_COMPRESSION_ENCODINGS or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Request(scope), API_COMPRESSION_ENCODINGS)
+        start_message = None
+        started = False
+
+        async def send_compressed(message):
+            nonlocal start_message, started
+            if started:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+
+            started = True
+            headers = MutableHeaders(scope=start_message)
+            body = message.get("body", b"")
+            content_type = headers.get("content-type", "").split(";")[0].strip()
+            if content_type in API_COMPRESSIBLE_TYPES and "content-encoding" not in headers:
+                headers.add_vary_header("Accept-Encoding")
+                if encoding and not message.get("more_body") and len(body) >= API_COMPRESSION_MIN_BYTES:
+                    etag = headers.get("etag")
+                    body = await response_compressor.compress(body, encoding, etag)
+                    headers["Content-Encoding"] = encoding
+                    headers["Content-Length"] = str(len(body))
+                    if etag and not etag.startswith("W/"):
+                        headers["ETag"] = f"W/{etag}"
+                    message = {**message, "body": body}
+            await send(start_message)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+
+def prometheus_escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{prometheus_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class PrometheusExposition:
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.lines: List[str] = []
+
+    def metric(self, name: str, kind: str, help_text: str, samples: List[Tuple[dict, float]]):
+        name = self.prefix + name
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            self.lines.append(f"{name}{prometheus_labels(labels)} {value}")
+
+    def histogram(self, name: str, help_text: str, samples: List[Tuple[dict, Histogram]]):
+        name = self.prefix + name
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in samples:
+            snapshot = histogram.snapshot()
+            for bound, count in snapshot["buckets"].items():
+                self.lines.append(f"{name}_bucket{prometheus_labels({**labels, 'le': bound})} {count}")
+            self.lines.append(f"{name}_sum{prometheus_labels(labels)} {histogram.sum}")
+            self.lines.append(f"{name}_count{prometheus_labels(labels)} {histogram.count}")
+
+    def render(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+
+def render_prometheus_metrics() -> str:
+    out = PrometheusExposition("valentine_")
+    now = time.monotonic()
+
+    out.metric("http_requests_total", "counter", "HTTP requests by route and status.", [
+        ({"method": method, "route": route, "status": status}, count)
+        for (method, route, status), count in request_metrics.requests.items()
+    ])
+    out.histogram("http_request_duration_seconds", "HTTP request latency, including streamed bodies.", [
+        ({"method": method, "route": route}, histogram)
+        for (method, route), histogram in request_metrics.latency.items()
+    ])
+    out.histogram("http_request_phase_seconds", "Time spent per request in LLM calls, database work and JSON (de)serialization.", [
+        ({"method": method, "route": route, "phase": phase}, histogram)
+        for (method, route, phase), histogram in request_metrics.phases.items()
+    ])
+    out.histogram("http_response_size_bytes", "HTTP response body size.", [
+        ({"method": method, "route": route}, histogram)
+        for (method, route), histogram in request_metrics.response_bytes.items()
+    ])
+
+    out.metric("generations_total", "counter", "Generations attempted against Gemini.", [({}, key_scheduler.generations)])
+    out.metric("generation_retries_total", "counter", "Extra key attempts made after a failed Gemini call.", [({}, key_scheduler.retries)])
+    out.metric("generation_fallbacks_total", "counter", "Generations where every Gemini key failed.", [
+        ({"kind": kind}, count) for kind, count in key_scheduler.fallbacks.items()
+    ])
+    out.metric("generation_json_repairs_total", "counter", "Malformed card JSON by how it was resolved.", [
+        ({"outcome": outcome}, count) for outcome, count in key_scheduler.repairs.items()
+    ])
+    out.metric("gemini_tokens_total", "counter", "Gemini tokens by generation kind and direction.", [
+        ({"kind": kind, "direction": direction}, totals[direction])
+        for kind, totals in key_scheduler.tokens.items()
+        for direction in ("input", "output")
+    ])
+    out.metric("gemini_output_truncated_total", "counter", "Gemini replies cut off at max_output_tokens.", [
+        ({"kind": kind}, totals["truncated"]) for kind, totals in key_scheduler.tokens.items()
+    ])
+    out.metric("prompt_inputs_trimmed_total", "counter", "User inputs shortened to fit the prompt token budget.", [
+        ({"field": field}, count) for field, count in key_scheduler.prompt_trims.items()
+    ])
+    out.metric("generation_templates_total", "counter", "Generations answered from the local template corpus.", [
+        ({"kind": kind, "reason": reason}, count) for (kind, reason), count in key_scheduler.templates.items()
+    ])
+    out.metric("gemini_key_calls_total", "counter", "Gemini calls per key by outcome.", [
+        ({"key": state.name, "outcome": outcome}, count)
+        for state in key_scheduler.states
+        for outcome, count in (("success", state.successes), ("error", state.errors), ("throttled", state.throttled))
+    ])
+    out.metric("gemini_key_in_flight", "gauge", "Gemini calls currently in flight per key.", [
+        ({"key": state.name}, state.in_flight) for state in key_scheduler.states
+    ])
+    out.metric("gemini_key_breaker_open", "gauge", "1 when the key's circuit breaker is open.", [
+        ({"key": state.name}, int(state.breaker_state(now) == "open")) for state in key_scheduler.states
+    ])
+
+    out.metric("generation_cache_requests_total", "counter", "Generation cache lookups by result.", [
+        ({"result": "hit"}, generation_cache.hits),
+        ({"result": "db_hit"}, generation_cache.db_hits),
+        ({"result": "miss"}, generation_cache.misses),
+    ])
+    out.metric("generation_coalesced_total", "counter", "Generations that joined an identical in-flight call.", [({}, generation_flights.coalesced)])
+    out.metric("response_cache_requests_total", "counter", "Card/letter response cache lookups by result.", [
+        ({"result": "hit"}, response_cache.hits),
+        ({"result": "miss"}, response_cache.misses),
+    ])
+    out.metric("response_cache_bytes", "gauge", "Bytes held by the card/letter response cache.", [({}, response_cache.total_bytes)])
+    out.metric("http_compression_bytes_total", "counter", "API response bytes before and after compression.", [
+        ({"encoding": encoding, "stage": stage}, count)
+        for stage, counts in (("raw", response_compressor.raw_bytes), ("compressed", response_compressor.compressed_bytes))
+        for encoding, count in counts.items()
+    ])
+    out.histogram("http_compression_cpu_seconds", "CPU time spent compressing API responses.", [({}, response_compressor.cpu_seconds)])
+    out.metric("process_cpu_seconds_total", "counter", "Total user and system CPU time of this process.", [({}, time.process_time())])
+
+    if db_pool is not None:
+        out.metric("db_pool_connections", "gauge", "Database pool connections by state.", [
+            ({"state": "open"}, db_pool.get_size()),
+            ({"state": "idle"}, db_pool.get_idle_size()),
+        ])
+    out.histogram("db_acquire_wait_seconds", "Time spent waiting for a pooled connection.", [({}, db_metrics.acquire_wait)])
+    out.metric("db_acquire_timeouts_total", "counter", "Connection acquires that timed out.", [({}, db_metrics.acquire_timeouts)])
+    out.histogram("db_query_duration_seconds", "Hot statement latency.", [
+        ({"statement": name}, histogram) for name, histogram in db_metrics.queries.items()
+    ])
+    out.metric("db_query_errors_total", "counter", "Hot statement failures.", [
+        ({"statement": name}, count) for name, count in db_metrics.query_errors.items()
+    ])
+
+    out.metric("rate_limit_decisions_total", "counter", "Rate limit checks on generation endpoints by decision.", [
+        ({"decision": "allowed"}, rate_limiter.allowed),
+        ({"decision": "denied"}, rate_limiter.denied),
+    ])
+    out.metric("generations_in_flight", "gauge", "Generation requests currently admitted.", [({}, admission.in_flight)])
+    out.metric("generation_admission_rejected_total", "counter", "Generation requests rejected by the concurrency cap.", [({}, admission.rejected)])
+
+    out.metric("jobs_total", "counter", "Generation jobs by outcome.", [
+        ({"outcome": "enqueued"}, job_queue.enqueued),
+        ({"outcome": "completed"}, job_queue.completed),
+        ({"outcome": "retried"}, job_queue.retried),
+        ({"outcome": "failed"}, job_queue.failed),
+        ({"outcome": "rejected"}, job_queue.rejected),
+    ])
+    out.histogram("job_duration_seconds", "Generation job run time.", [({}, job_queue.duration)])
+    return out.render()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_prometheus_metrics():
+    return Response(content=render_prometheus_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 app.include_router(api_router)
 
 app.add_middleware(
@@ -457,14 +3770,240 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(BodyLimitMiddleware)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+STATIC_COMPRESSIBLE = {".html", ".js", ".css", ".json", ".map", ".svg", ".txt", ".ico", ".webmanifest"}
+STATIC_COMPRESS_MIN_BYTES = 1024
+STATIC_IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+INDEX_CACHE_CONTROL = "no-cache"
+
+
+def available_encodings() -> List[Tuple[str, str]]:
+    return [(encoding, suffix) for encoding, suffix in CONTENT_ENCODINGS if encoding != "br" or brotli is not None]
+
+
+class StaticAsset:
+    def __init__(self, path: Path, cache_control: str):
+        self.path = path
+        self.stat = path.stat()
+        self.media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        self.etag = f"{self.stat.st_size:x}-{self.stat.st_mtime_ns:x}"
+        self.cache_control = cache_control
+        self.encodings: Dict[str, Tuple[Path, os.stat_result]] = {}
+
+
+class StaticManifest:
+    def __init__(self, root: Path):
+        self.root = root
+        self.assets: Dict[str, StaticAsset] = {}
+        self.index_body: Optional[bytes] = None
+        self.index_encodings: Dict[str, bytes] = {}
+        self.index_etag = ""
+
+    def build(self):
+        files: Dict[str, Path] = {}
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = Path(directory) / name
+                if path.is_file() and not path.is_symlink():
+                    files[path.relative_to(self.root).as_posix()] = path
+
+        suffixes = tuple(suffix for _, suffix in CONTENT_ENCODINGS)
+        assets = {}
+        for relative, path in files.items():
+            if relative.endswith(suffixes) and relative[:relative.rindex(".")] in files:
+                continue
+            cache_control = STATIC_IMMUTABLE_CACHE_CONTROL if relative.startswith("static/") else f"public, max-age={STATIC_MAX_AGE}"
+            asset = StaticAsset(path, cache_control)
+            for encoding, suffix in CONTENT_ENCODINGS:
+                variant = files.get(relative + suffix)
+                if variant is not None:
+                    variant_stat = variant.stat()
+                    if variant_stat.st_mtime_ns >= asset.stat.st_mtime_ns:
+                        asset.encodings[encoding] = (variant, variant_stat)
+            assets[relative] = asset
+        self.assets = assets
+
+        index = self.root / "index.html"
+        if index.is_file():
+            self.index_body = index.read_bytes()
+            self.index_etag = hashlib.sha256(self.index_body).hexdigest()[:16]
+            self.index_encodings = {
+                encoding: compress(self.index_body, encoding) for encoding, _ in available_encodings()
+            }
+        logger.info(f"Indexed {len(self.assets)} frontend assets from {self.root}")
+
+    def index_response(self, request: Request) -> Response:
+        if self.index_body is None:
+            raise HTTPException(status_code=404, detail="Not Found")
+        encoding = negotiate_encoding(request, self.index_encodings)
+        etag = f'"{self.index_etag}-{encoding}"' if encoding else f'"{self.index_etag}"'
+        headers = {"ETag": etag, "Cache-Control": INDEX_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+            return Response(content=self.index_encodings[encoding], media_type="text/html", headers=headers)
+        return Response(content=self.index_body, media_type="text/html", headers=headers)
+
+    def response(self, request: Request, relative: str) -> Response:
+        asset = self.assets.get(relative)
+        if asset is None or relative == "index.html":
+            if relative.startswith(("static/", "api/")) or (asset is None and "." in relative.rsplit("/", 1)[-1]):
+                raise HTTPException(status_code=404, detail="Not Found")
+            return self.index_response(request)
+
+        encoding = negotiate_encoding(request, asset.encodings)
+        etag = f'"{asset.etag}-{encoding}"' if encoding else f'"{asset.etag}"'
+        headers = {"ETag": etag, "Cache-Control": asset.cache_control}
+        if asset.encodings:
+            headers["Vary"] = "Accept-Encoding"
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+
+        path, stat_result = asset.path, asset.stat
+        if encoding:
+            path, stat_result = asset.encodings[encoding]
+            headers["Content-Encoding"] = encoding
+        return FileResponse(path, media_type=asset.media_type, headers=headers, stat_result=stat_result)
+
+
+def precompress_static(root: Path) -> int:
+    written = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = Path(directory) / name
+            if path.suffix not in STATIC_COMPRESSIBLE or path.stat().st_size < STATIC_COMPRESS_MIN_BYTES:
+                continue
+            data = path.read_bytes()
+            for encoding, suffix in available_encodings():
+                compressed = compress(data, encoding)
+                if len(compressed) < len(data):
+                    path.with_name(name + suffix).write_bytes(compressed)
+                    written += 1
+    return written
+
+
+def share_snapshot(kind: str, document: bytes, resource: dict) -> bytes:
+    title, excerpt = share_summary(kind, resource)
+    description = " ".join(excerpt.split())
+    if len(description) > 200:
+        description = description[:200].rsplit(" ", 1)[0] + "..."
+    paragraphs = "".join(f"<p>{html.escape(paragraph)}</p>" for paragraph in excerpt.split("\n\n") if paragraph.strip())
+    inline = b'{"kind":"' + kind.encode() + b'","resource":' + document.replace(b"<", b"\\u003c") + b"}"
+    return json.dumps({
+        "title": title,
+        "description": description,
+        "inline": inline.decode(),
+        "noscript": f"<noscript><article><h1>{html.escape(title)}</h1>{paragraphs}</article></noscript>",
+    }).encode()
+
+
+def render_share_page(index: bytes, kind: str, resource_id: str, snapshot: dict, base_url: str) -> bytes:
+    title = html.escape(snapshot["title"])
+    description = html.escape(snapshot["description"])
+    meta = "".join(f'<meta property="{name}" content="{html.escape(value)}" />' for name, value in (
+        ("og:type", "article"),
+        ("og:title", snapshot["title"]),
+        ("og:description", snapshot["description"]),
+        ("og:url", f"{base_url}/{kind}/{resource_id}"),
+        ("og:image", f"{base_url}/api/{kind}s/{resource_id}/og.jpg"),
+        ("og:image:width", str(OG_IMAGE_SIZE[0])),
+        ("og:image:height", str(OG_IMAGE_SIZE[1])),
+    ))
+    meta += '<meta name="twitter:card" content="summary_large_image" />'
+    meta += f'<script>window.__INITIAL_DATA__={snapshot["inline"]}</script>'
+
+    page = index.decode()
+    page = re.sub(r"<title>.*?</title>", lambda match: f"<title>{title}</title>", page, count=1, flags=re.S)
+    page = re.sub(
+        r'<meta name="description" content="[^"]*"\s*/?>',
+        lambda match: f'<meta name="description" content="{description}" />', page, count=1
+    )
+    page = page.replace("</head>", meta + "</head>", 1)
+    page = re.sub(r"(<body[^>]*>)", lambda match: match.group(1) + snapshot["noscript"], page, count=1)
+    return page.encode()
+
+
+def public_base_url(request: Request) -> str:
+    return PUBLIC_BASE_URL or str(request.base_url).rstrip("/")
+
+
+async def share_page_response(kind: str, resource_id: str, request: Request) -> Response:
+    resource_id = canonical_id(resource_id)
+    if resource_id is None or db_pool is None or static_manifest.index_body is None:
+        return static_manifest.index_response(request)
+
+    base_url = public_base_url(request)
+    page_tag = hashlib.sha256(f"{kind}:{resource_id}:{static_manifest.index_etag}:{base_url}".encode()).hexdigest()[:24]
+    encoding = negotiate_encoding(request, dict(available_encodings()))
+    etag = f'"{page_tag}-{encoding}"' if encoding else f'"{page_tag}"'
+    headers = {"ETag": etag, "Cache-Control": INDEX_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    # Ready resources never change, so the rendered fragment is kept next to photos and
+    # only the cheap splice into the current index.html happens per request
+    snapshot_key = f"share.{kind}.{resource_id}"
+    snapshot = await blob_store.get(snapshot_key)
+    if snapshot is None:
+        loaded = await load_ready_resource(kind, resource_id)
+        if loaded is None:
+            return static_manifest.index_response(request)
+        snapshot = share_snapshot(kind, *loaded)
+        await blob_store.put(snapshot_key, snapshot)
+    body = render_share_page(static_manifest.index_body, kind, resource_id, json.loads(snapshot), base_url)
+    if encoding:
+        body = compress(body, encoding, API_GZIP_LEVEL, API_BROTLI_QUALITY)
+
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="text/html", headers=headers)
+
 
 frontend_build = Path(__file__).parent.parent / "frontend" / "build"
+static_manifest = StaticManifest(frontend_build)
 if frontend_build.exists():
-    app.mount("/static", StaticFiles(directory=str(frontend_build / "static")), name="static")
-
-    @app.get("/{full_path:path}")
-    async def serve_frontend(full_path: str):
-        file_path = frontend_build / full_path
-        if file_path.exists() and file_path.is_file():
-            return FileResponse(str(file_path))
-        return FileResponse(str(frontend_build / "index.html"))
+    @app.on_event("startup")
+    async def load_static_manifest():
+        await asyncio.to_thread(static_manifest.build)
+
+    @app.get("/card/{card_id}", include_in_schema=False)
+    async def serve_card_page(card_id: str, request: Request):
+        return await share_page_response("card", card_id, request)
+
+    @app.get("/letter/{letter_id}", include_in_schema=False)
+    async def serve_letter_page(letter_id: str, request: Request):
+        return await share_page_response("letter", letter_id, request)
+
+    @app.get("/{full_path:path}", include_in_schema=False)
+    async def serve_frontend(full_path: str, request: Request):
+        return static_manifest.response(request, full_path)
+
+
+async def migrate():
+    if not DATABASE_URL:
+        raise SystemExit("DATABASE_URL is not set")
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        version = await run_migrations(conn)
+        logger.info(f"Database schema is at version {version}")
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Valentine Card API management commands")
+    parser.add_argument("command", choices=["migrate", "precompress"])
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        asyncio.run(migrate())
+    elif args.command == "precompress":
+        if not frontend_build.exists():
+            raise SystemExit(f"{frontend_build} does not exist; build the frontend first")
+        logger.info(f"Wrote {precompress_static(frontend_build)} precompressed assets under {frontend_build}")
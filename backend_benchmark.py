@@ -0,0 +1,389 @@
+import argparse
+import asyncio
+import base64
+import io
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+KEY_NAMES = ["GOOGLE_API_KEY", "GOOGLE_API_KEY1", "GOOGLE_API_KEY2", "GOOGLE_API_KEY3", "GEMINI_API_KEY"]
+
+CARD_TEXT = json.dumps({
+    "poem": "Roses bloom where your laughter goes,\nEvery season soft as snow,\nIn your eyes the whole world glows,\nAnd in my heart, you always grow.",
+    "love_notes": [
+        "I love how you hum while you cook",
+        "My favorite thing about us is our Sunday walks",
+        "You make ordinary days feel like holidays",
+        "I still get butterflies when you text me",
+        "You are my favorite hello and hardest goodbye",
+    ],
+    "scratch_message": "Pack a bag, we're going to the coast this weekend!",
+})
+
+LETTER_TEXT = "\n\n".join([
+    "Every morning I wake up grateful that the world put you in my path. " * 4,
+    "I think about the little things: the way you laugh at your own jokes, the way you hold your coffee with both hands. " * 3,
+    "Wherever the next years take us, I want to walk there beside you, learning you a little more each day. " * 3,
+])
+
+
+def gemini_response(text: str) -> dict:
+    return {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP", "index": 0}],
+        "usageMetadata": {"promptTokenCount": 250, "candidatesTokenCount": len(text) // 4},
+    }
+
+
+def create_fake_gemini_app(latency: float, jitter: float, error_rate: float, throttle_rate: float):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+
+    app = FastAPI()
+
+    def injected_error():
+        roll = random.random()
+        if roll < throttle_rate:
+            return JSONResponse(status_code=429, content={
+                "error": {"code": 429, "message": "Resource has been exhausted.", "status": "RESOURCE_EXHAUSTED"}
+            })
+        if roll < throttle_rate + error_rate:
+            return JSONResponse(status_code=500, content={
+                "error": {"code": 500, "message": "Injected failure.", "status": "INTERNAL"}
+            })
+        return None
+
+    @app.post("/{path:path}")
+    async def generate(path: str, request: Request):
+        body = await request.json()
+        text = CARD_TEXT if "love_notes" in json.dumps(body.get("contents")) else LETTER_TEXT
+        await asyncio.sleep(max(0.0, random.gauss(latency, jitter)))
+
+        error = injected_error()
+        if error is not None:
+            return error
+
+        if path.endswith(":streamGenerateContent"):
+            words = text.split(" ")
+            chunk_size = max(1, len(words) // 8)
+
+            async def events():
+                for start in range(0, len(words), chunk_size):
+                    chunk = " ".join(words[start:start + chunk_size]) + " "
+                    yield f"data: {json.dumps(gemini_response(chunk))}\r\n\r\n"
+                    await asyncio.sleep(latency / 20)
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+        return gemini_response(text)
+
+    return app
+
+
+def run_fake_gemini(args):
+    import uvicorn
+
+    app = create_fake_gemini_app(args.llm_latency, args.llm_jitter, args.llm_error_rate, args.llm_throttle_rate)
+    uvicorn.run(app, host="127.0.0.1", port=args.gemini_port, log_level="warning")
+
+
+def make_photo(size_kb: int) -> str:
+    from PIL import Image
+
+    side = 256
+    data = b""
+    while True:
+        image = Image.effect_noise((side, side), 48).convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=90)
+        data = buffer.getvalue()
+        if len(data) >= size_kb * 1024 or side >= 4096:
+            break
+        side = int(side * 1.4)
+    return "data:image/jpeg;base64," + base64.b64encode(data).decode()
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values), max(1, math.ceil(fraction * len(sorted_values))))
+    return sorted_values[index - 1]
+
+
+class Workload:
+    def __init__(self, base_url: str, args):
+        self.api_url = f"{base_url}/api"
+        self.args = args
+        self.photos = [make_photo(args.photo_kb) for _ in range(args.photos_per_card)]
+        self.card_ids = []
+        self.letter_ids = []
+        self.samples = {}
+        self.errors = {}
+        self.wire_bytes = {}
+
+    def record(self, operation: str, elapsed: float, ok: bool, wire_bytes: int = 0):
+        self.samples.setdefault(operation, []).append(elapsed)
+        self.wire_bytes[operation] = self.wire_bytes.get(operation, 0) + wire_bytes
+        if not ok:
+            self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    def card_payload(self) -> dict:
+        return {
+            "girlfriend_name": "Alex",
+            "sender_name": "Sam",
+            "description": f"Loves hiking, old films and terrible puns ({uuid.uuid4().hex[:8]})",
+            "photos": self.photos,
+            "use_cache": False,
+        }
+
+    def letter_payload(self) -> dict:
+        return {
+            "letter_type": random.choice(["love", "anniversary", "miss-you"]),
+            "recipient_name": "Alex",
+            "sender_name": "Sam",
+            "context": f"Together five years, met at a bookshop ({uuid.uuid4().hex[:8]})",
+            "tone": random.choice(["romantic", "poetic", "funny"]),
+            "photos": self.photos[:1],
+            "use_cache": False,
+        }
+
+    async def request(self, client: httpx.AsyncClient, operation: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            response, ok = None, False
+        wire_bytes = response.num_bytes_downloaded if response is not None else 0
+        self.record(operation, time.perf_counter() - start, ok, wire_bytes)
+        return response if ok else None
+
+    async def create(self, client: httpx.AsyncClient, kind: str):
+        payload = self.card_payload() if kind == "card" else self.letter_payload()
+        response = await self.request(client, f"POST /{kind}s", "POST", f"{self.api_url}/{kind}s", json=payload)
+        if response is not None:
+            (self.card_ids if kind == "card" else self.letter_ids).append(response.json()["id"])
+
+    async def view(self, client: httpx.AsyncClient, kind: str):
+        ids = self.card_ids if kind == "card" else self.letter_ids
+        if not ids:
+            await self.create(client, kind)
+            return
+        await self.request(client, f"GET /{kind}s/:id", "GET", f"{self.api_url}/{kind}s/{random.choice(ids)}")
+
+    async def step(self, client: httpx.AsyncClient):
+        kind = "card" if random.random() < 0.5 else "letter"
+        if random.random() < self.args.post_ratio:
+            await self.create(client, kind)
+        else:
+            await self.view(client, kind)
+
+    async def seed(self, client: httpx.AsyncClient):
+        await asyncio.gather(*[self.create(client, kind) for kind in ("card", "letter") for _ in range(self.args.seed)])
+        self.samples.clear()
+        self.errors.clear()
+        self.wire_bytes.clear()
+
+    async def run(self) -> float:
+        limits = httpx.Limits(max_connections=self.args.concurrency, max_keepalive_connections=self.args.concurrency)
+        headers = {"Accept-Encoding": self.args.accept_encoding}
+        async with httpx.AsyncClient(timeout=self.args.timeout, limits=limits, headers=headers) as client:
+            await self.seed(client)
+            deadline = time.perf_counter() + self.args.duration
+            remaining = self.args.requests
+
+            async def user():
+                nonlocal remaining
+                while time.perf_counter() < deadline and (remaining is None or remaining > 0):
+                    if remaining is not None:
+                        remaining -= 1
+                    await self.step(client)
+
+            start = time.perf_counter()
+            await asyncio.gather(*[user() for _ in range(self.args.concurrency)])
+            return time.perf_counter() - start
+
+    def report(self, elapsed: float) -> dict:
+        operations = {}
+        for operation, values in sorted(self.samples.items()):
+            values = sorted(values)
+            operations[operation] = {
+                "count": len(values),
+                "errors": self.errors.get(operation, 0),
+                "mean_ms": round(sum(values) / len(values) * 1000, 1),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1),
+                "wire_kb": round(self.wire_bytes.get(operation, 0) / len(values) / 1024, 2),
+            }
+        total = sum(len(values) for values in self.samples.values())
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "requests": total,
+            "errors": sum(self.errors.values()),
+            "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0,
+            "operations": operations,
+        }
+
+
+def print_report(report: dict):
+    print(f"\n📊 {report['requests']} requests in {report['elapsed_s']}s "
+          f"({report['throughput_rps']} req/s, {report['errors']} errors)\n")
+    print(f"{'operation':<20}{'count':>8}{'errors':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}{'KB/req':>10}")
+    for operation, stats in report["operations"].items():
+        print(f"{operation:<20}{stats['count']:>8}{stats['errors']:>8}"
+              f"{stats['mean_ms']:>10}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}"
+              f"{stats['wire_kb']:>10}")
+    print("\n(latencies in ms, KB/req is the mean response body size on the wire)")
+
+
+def wait_for(url: str, process: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Process for {url} exited with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise SystemExit(f"Timed out waiting for {url}")
+
+
+def start_embedded_postgres(data_dir: str) -> str:
+    try:
+        import pgserver
+    except ImportError:
+        raise SystemExit("No --database-url given and pgserver is not installed (pip install pgserver).")
+    server = pgserver.get_server(data_dir, cleanup_mode="stop")
+    return server.get_uri()
+
+
+def server_env(args, database_url: str, workdir: str) -> dict:
+    env = {
+        **os.environ,
+        "DATABASE_URL": database_url,
+        "RUN_MIGRATIONS_ON_STARTUP": "true",
+        "GEMINI_BASE_URL": f"http://127.0.0.1:{args.gemini_port}",
+        "BLOB_STORE_DIR": os.path.join(workdir, "blobs"),
+    }
+    # Every simulated user shares 127.0.0.1, so the per-client limiter would turn most POSTs into 429s
+    if not args.rate_limit:
+        env["RATE_LIMIT_BACKEND"] = "off"
+    for index, key_name in enumerate(KEY_NAMES):
+        env.pop(key_name, None)
+        if index < args.keys:
+            env[key_name] = f"bench-key-{index}"
+    return env
+
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix="valentine-bench-")
+    processes = []
+    try:
+        database_url = args.database_url or os.environ.get("BENCH_DATABASE_URL")
+        if not database_url:
+            print("🐘 Starting embedded Postgres...")
+            database_url = start_embedded_postgres(os.path.join(workdir, "pgdata"))
+
+        base_url = args.target
+        if not base_url:
+            gemini = subprocess.Popen([
+                sys.executable, os.path.abspath(__file__), "fake-gemini",
+                "--gemini-port", str(args.gemini_port),
+                "--llm-latency", str(args.llm_latency),
+                "--llm-jitter", str(args.llm_jitter),
+                "--llm-error-rate", str(args.llm_error_rate),
+                "--llm-throttle-rate", str(args.llm_throttle_rate),
+            ])
+            processes.append(gemini)
+            wait_for(f"http://127.0.0.1:{args.gemini_port}/docs", gemini)
+
+            env = server_env(args, database_url, workdir)
+            server_log = open(args.server_log, "w") if args.server_log else subprocess.DEVNULL
+            server = subprocess.Popen([
+                sys.executable, "-m", "uvicorn", "backend.server:app",
+                "--host", "127.0.0.1", "--port", str(args.port),
+                "--workers", str(args.workers), "--log-level", "warning",
+            ], cwd=ROOT_DIR, env=env, stdout=server_log, stderr=subprocess.STDOUT)
+            processes.append(server)
+            base_url = f"http://127.0.0.1:{args.port}"
+            wait_for(f"{base_url}/api/", server)
+
+        print(f"🚀 {args.concurrency} users for {args.duration}s against {base_url} "
+              f"({int(args.post_ratio * 100)}% POST, {args.photos_per_card}x{args.photo_kb}KB photos)")
+        workload = Workload(base_url, args)
+        report = workload.report(asyncio.run(workload.run()))
+        print_report(report)
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+
+        failed = False
+        for operation, stats in report["operations"].items():
+            if args.max_p95_ms and stats["p95_ms"] > args.max_p95_ms:
+                print(f"❌ {operation} p95 {stats['p95_ms']}ms exceeds {args.max_p95_ms}ms")
+                failed = True
+        if args.max_error_rate is not None and report["requests"]:
+            error_rate = report["errors"] / report["requests"]
+            if error_rate > args.max_error_rate:
+                print(f"❌ Error rate {error_rate:.2%} exceeds {args.max_error_rate:.2%}")
+                failed = True
+        return 1 if failed else 0
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Valentine API against a fake Gemini and local Postgres")
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "fake-gemini"])
+    parser.add_argument("--target", help="Benchmark an already running server instead of starting one")
+    parser.add_argument("--database-url", help="Postgres URL (default: BENCH_DATABASE_URL or an embedded pgserver)")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--keys", type=int, default=2, choices=range(1, len(KEY_NAMES) + 1), help="Number of fake Gemini API keys")
+    parser.add_argument("--gemini-port", type=int, default=8798)
+    parser.add_argument("--rate-limit", action="store_true", help="Keep the API's per-client rate limiter on (off by default)")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="Mean fake Gemini latency in seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.2)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Fraction of Gemini calls failing with 500")
+    parser.add_argument("--llm-throttle-rate", type=float, default=0.0, help="Fraction of Gemini calls failing with 429")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to run the workload")
+    parser.add_argument("--requests", type=int, default=None, help="Stop after this many requests")
+    parser.add_argument("--post-ratio", type=float, default=0.1, help="Fraction of requests that create a card/letter")
+    parser.add_argument("--photo-kb", type=int, default=400, help="Approximate size of each uploaded JPEG")
+    parser.add_argument("--photos-per-card", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=5, help="Cards and letters created before measuring")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--accept-encoding", default="gzip, br", help="Accept-Encoding sent by the load generator (e.g. identity)")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--server-log", help="Write the API server's log to this file (default: discard)")
+    parser.add_argument("--max-p95-ms", type=float, default=None, help="Exit non-zero if any operation's p95 exceeds this")
+    parser.add_argument("--max-error-rate", type=float, default=None, help="Exit non-zero if the error rate exceeds this")
+    args = parser.parse_args()
+
+    if args.command == "fake-gemini":
+        run_fake_gemini(args)
+        return 0
+    return run_benchmark(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
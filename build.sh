@@ -3,3 +3,5 @@ pip install -r /home/runner/workspace/backend/requirements.txt
 cd /home/runner/workspace/frontend
 npm install
 npm run build
+cd /home/runner/workspace
+python -m backend.server precompress
@@ -4,3 +4,16 @@ import { twMerge } from "tailwind-merge"
 export function cn(...inputs) {
   return twMerge(clsx(inputs));
 }
+
+export function photoVariant(photo, variant) {
+  return photo && photo.startsWith("/api/photos/") ? `${photo}?variant=${variant}` : photo;
+}
+
+export function takeInitialData(kind, id) {
+  const initial = window.__INITIAL_DATA__;
+  delete window.__INITIAL_DATA__;
+  if (initial && initial.kind === kind && initial.resource.id === String(id).toLowerCase()) {
+    return initial.resource;
+  }
+  return null;
+}
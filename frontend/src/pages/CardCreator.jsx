@@ -1,4 +1,4 @@
-import { useState, useRef } from "react";
+import { useState, useRef, useEffect } from "react";
 import { useNavigate } from "react-router-dom";
 import { motion, AnimatePresence } from "framer-motion";
 import { Heart, Upload, X, ArrowLeft, Loader2, Sparkles, Camera } from "lucide-react";
@@ -10,11 +10,23 @@ import axios from "axios";
 
 const API = "/api";
 
+const newIdempotencyKey = () =>
+  window.crypto?.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+
+const uploadPhotos = async (files) => {
+  const body = new FormData();
+  files.forEach((file) => body.append("photo", file, file.name));
+  const response = await axios.post(`${API}/photos`, body);
+  return response.data.photos;
+};
+
 const CardCreator = () => {
   const navigate = useNavigate();
   const fileInputRef = useRef(null);
+  const idempotencyKey = useRef(null);
   const [step, setStep] = useState(1);
   const [loading, setLoading] = useState(false);
+  const [uploading, setUploading] = useState(false);
   const [formData, setFormData] = useState({
     girlfriend_name: "",
     sender_name: "",
@@ -22,23 +34,35 @@ const CardCreator = () => {
     photos: [],
   });
 
-  const handlePhotoUpload = (e) => {
+  useEffect(() => {
+    idempotencyKey.current = null;
+  }, [formData]);
+
+  const handlePhotoUpload = async (e) => {
     const files = Array.from(e.target.files);
     if (formData.photos.length + files.length > 5) {
       toast.error("Maximum 5 photos allowed");
       return;
     }
+    if (files.length === 0) return;
 
-    files.forEach((file) => {
-      const reader = new FileReader();
-      reader.onload = (e) => {
-        setFormData((prev) => ({
-          ...prev,
-          photos: [...prev.photos, e.target.result],
-        }));
-      };
-      reader.readAsDataURL(file);
-    });
+    setUploading(true);
+    try {
+      const photos = await uploadPhotos(files);
+      setFormData((prev) => ({
+        ...prev,
+        photos: [...prev.photos, ...photos],
+      }));
+    } catch (error) {
+      console.error("Error uploading photos:", error);
+      if (error.response?.status === 413) {
+        toast.error("Those photos are too large. Please choose smaller ones.");
+      } else {
+        toast.error("Failed to upload photos. Please try again.");
+      }
+    } finally {
+      setUploading(false);
+    }
   };
 
   const removePhoto = (index) => {
@@ -59,14 +83,28 @@ const CardCreator = () => {
       return;
     }
 
+    if (uploading) {
+      toast.error("Please wait for your photos to finish uploading");
+      return;
+    }
+
     setLoading(true);
     try {
-      const response = await axios.post(`${API}/cards`, formData);
+      if (!idempotencyKey.current) {
+        idempotencyKey.current = newIdempotencyKey();
+      }
+      const response = await axios.post(`${API}/cards?async=1`, formData, {
+        headers: { "Idempotency-Key": idempotencyKey.current },
+      });
       toast.success("Valentine's card created!");
       navigate(`/card/${response.data.id}`);
     } catch (error) {
       console.error("Error creating card:", error);
-      toast.error("Failed to create card. Please try again.");
+      if (error.response?.status === 429) {
+        toast.error("Lots of love going around right now! Please wait a moment and try again.");
+      } else {
+        toast.error("Failed to create card. Please try again.");
+      }
     } finally {
       setLoading(false);
     }
@@ -361,7 +399,7 @@ const CardCreator = () => {
               <Button
                 data-testid="create-card-button"
                 onClick={handleSubmit}
-                disabled={loading}
+                disabled={loading || uploading}
                 className="w-full rounded-full py-6 bg-valentine-primary text-white font-playfair font-bold shadow-lg hover:bg-valentine-primary-hover hover:shadow-xl transition-all disabled:opacity-70"
               >
                 {loading ? (
@@ -1,4 +1,4 @@
-import { useState, useRef } from "react";
+import { useState, useRef, useEffect } from "react";
 import { useNavigate } from "react-router-dom";
 import { motion, AnimatePresence } from "framer-motion";
 import {
@@ -13,6 +13,16 @@ import axios from "axios";
 
 const API = "/api";
 
+const newIdempotencyKey = () =>
+  window.crypto?.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+
+const uploadPhotos = async (files) => {
+  const body = new FormData();
+  files.forEach((file) => body.append("photo", file, file.name));
+  const response = await axios.post(`${API}/photos`, body);
+  return response.data.photos;
+};
+
 const LETTER_TYPES = [
   { id: "love", label: "Love Letter", emoji: "💕", desc: "Express your deepest feelings" },
   { id: "sorry", label: "Apology Letter", emoji: "🥺", desc: "Make things right again" },
@@ -73,8 +83,10 @@ const CONTEXT_PROMPTS = {
 const LetterCreator = () => {
   const navigate = useNavigate();
   const fileInputRef = useRef(null);
+  const idempotencyKey = useRef(null);
   const [step, setStep] = useState(1);
   const [loading, setLoading] = useState(false);
+  const [uploading, setUploading] = useState(false);
   const [formData, setFormData] = useState({
     letter_type: "",
     recipient_name: "",
@@ -88,28 +100,43 @@ const LetterCreator = () => {
     color_scheme: "romantic-red",
   });
 
+  useEffect(() => {
+    idempotencyKey.current = null;
+  }, [formData]);
+
   const totalSteps = 5;
 
-  const handlePhotoUpload = (e) => {
-    const files = Array.from(e.target.files);
+  const handlePhotoUpload = async (e) => {
+    const files = Array.from(e.target.files).filter((file) => {
+      if (file.size > 10 * 1024 * 1024) {
+        toast.error(`${file.name} is too large (max 10MB)`);
+        return false;
+      }
+      return true;
+    });
     if (formData.photos.length + files.length > 6) {
       toast.error("Maximum 6 images allowed");
       return;
     }
-    files.forEach((file) => {
-      if (file.size > 10 * 1024 * 1024) {
-        toast.error(`${file.name} is too large (max 10MB)`);
-        return;
+    if (files.length === 0) return;
+
+    setUploading(true);
+    try {
+      const photos = await uploadPhotos(files);
+      setFormData((prev) => ({
+        ...prev,
+        photos: [...prev.photos, ...photos],
+      }));
+    } catch (error) {
+      console.error("Error uploading photos:", error);
+      if (error.response?.status === 413) {
+        toast.error("Those photos are too large. Please choose smaller ones.");
+      } else {
+        toast.error("Failed to upload photos. Please try again.");
       }
-      const reader = new FileReader();
-      reader.onload = (e) => {
-        setFormData((prev) => ({
-          ...prev,
-          photos: [...prev.photos, e.target.result],
-        }));
-      };
-      reader.readAsDataURL(file);
-    });
+    } finally {
+      setUploading(false);
+    }
   };
 
   const removePhoto = (index) => {
@@ -128,15 +155,28 @@ const LetterCreator = () => {
       toast.error("Please add some details");
       return;
     }
+    if (uploading) {
+      toast.error("Please wait for your photos to finish uploading");
+      return;
+    }
 
     setLoading(true);
     try {
-      const response = await axios.post(`${API}/letters`, formData);
+      if (!idempotencyKey.current) {
+        idempotencyKey.current = newIdempotencyKey();
+      }
+      const response = await axios.post(`${API}/letters?async=1`, formData, {
+        headers: { "Idempotency-Key": idempotencyKey.current },
+      });
       toast.success("Your letter has been created!");
       navigate(`/letter/${response.data.id}`);
     } catch (error) {
       console.error("Error creating letter:", error);
-      toast.error("Failed to create letter. Please try again.");
+      if (error.response?.status === 429) {
+        toast.error("Lots of love going around right now! Please wait a moment and try again.");
+      } else {
+        toast.error("Failed to create letter. Please try again.");
+      }
     } finally {
       setLoading(false);
     }
@@ -526,7 +566,7 @@ const LetterCreator = () => {
 
               <Button
                 onClick={handleSubmit}
-                disabled={loading}
+                disabled={loading || uploading}
                 className="w-full rounded-full py-6 bg-valentine-primary text-white font-playfair font-bold shadow-lg hover:bg-valentine-primary-hover transition-all disabled:opacity-70"
               >
                 {loading ? (
@@ -10,14 +10,17 @@ import FloatingHearts from "../components/FloatingHearts";
 import ScratchCard from "../components/ScratchCard";
 import FlipCard from "../components/FlipCard";
 import LoveNoteReveal from "../components/LoveNoteReveal";
+import { photoVariant, takeInitialData } from "../lib/utils";
 
 const API = "/api";
+const POLL_INTERVAL_MS = 2000;
 
 const ViewCard = () => {
   const { cardId } = useParams();
   const navigate = useNavigate();
   const [card, setCard] = useState(null);
   const [loading, setLoading] = useState(true);
+  const pollTimer = useRef(null);
   const [showIntro, setShowIntro] = useState(true);
   const [currentSection, setCurrentSection] = useState(0);
   const [copied, setCopied] = useState(false);
@@ -27,17 +30,36 @@ const ViewCard = () => {
 
   useEffect(() => {
     fetchCard();
+    return () => clearTimeout(pollTimer.current);
   }, [cardId]);
 
   const fetchCard = async () => {
+    const initial = takeInitialData("card", cardId);
+    if (initial) {
+      setCard(initial);
+      setLoading(false);
+      return;
+    }
     try {
       const response = await axios.get(`${API}/cards/${cardId}`);
+      if (response.data.status === "pending") {
+        pollTimer.current = setTimeout(fetchCard, POLL_INTERVAL_MS);
+        return;
+      }
+      if (response.data.status === "failed") {
+        toast.error("We couldn't write this card. Please try again.");
+        navigate("/");
+        return;
+      }
       setCard(response.data);
+      setLoading(false);
+      if (response.data.status === "draft") {
+        pollTimer.current = setTimeout(fetchCard, POLL_INTERVAL_MS);
+      }
     } catch (error) {
       console.error("Error fetching card:", error);
       toast.error("Card not found");
       navigate("/");
-    } finally {
       setLoading(false);
     }
   };
@@ -290,7 +312,7 @@ const ViewCard = () => {
                       {card.photos.map((photo, index) => (
                         <FlipCard
                           key={index}
-                          photo={photo}
+                          photo={photoVariant(photo, "thumb")}
                           message={card.love_notes[index % card.love_notes.length]}
                           isFlipped={flippedCards.includes(index)}
                           onFlip={() => handleFlipCard(index)}
@@ -8,8 +8,10 @@ import axios from "axios";
 import html2canvas from "html2canvas";
 import { jsPDF } from "jspdf";
 import FloatingHearts from "../components/FloatingHearts";
+import { photoVariant, takeInitialData } from "../lib/utils";
 
 const API = "/api";
+const POLL_INTERVAL_MS = 2000;
 
 const TEMPLATE_STYLES = {
   classic: {
@@ -91,23 +93,43 @@ const ViewLetter = () => {
   const letterRef = useRef(null);
   const [letter, setLetter] = useState(null);
   const [loading, setLoading] = useState(true);
+  const pollTimer = useRef(null);
   const [copied, setCopied] = useState(false);
   const [downloading, setDownloading] = useState(false);
   const [showLetter, setShowLetter] = useState(false);
 
   useEffect(() => {
     fetchLetter();
+    return () => clearTimeout(pollTimer.current);
   }, [letterId]);
 
   const fetchLetter = async () => {
+    const initial = takeInitialData("letter", letterId);
+    if (initial) {
+      setLetter(initial);
+      setLoading(false);
+      return;
+    }
     try {
       const response = await axios.get(`${API}/letters/${letterId}`);
+      if (response.data.status === "pending") {
+        pollTimer.current = setTimeout(fetchLetter, POLL_INTERVAL_MS);
+        return;
+      }
+      if (response.data.status === "failed") {
+        toast.error("We couldn't write this letter. Please try again.");
+        navigate("/");
+        return;
+      }
       setLetter(response.data);
+      setLoading(false);
+      if (response.data.status === "draft") {
+        pollTimer.current = setTimeout(fetchLetter, POLL_INTERVAL_MS);
+      }
     } catch (error) {
       console.error("Error fetching letter:", error);
       toast.error("Letter not found");
       navigate("/");
-    } finally {
       setLoading(false);
     }
   };
@@ -314,7 +336,7 @@ const ViewLetter = () => {
                           className="rounded-xl overflow-hidden shadow-lg"
                         >
                           <img
-                            src={photo}
+                            src={photoVariant(photo, letter.photos.length === 1 ? "display" : "thumb")}
                             alt={`Memory ${index + 1}`}
                             className="w-full h-48 object-cover"
                           />
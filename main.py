@@ -1,5 +1,93 @@
+import asyncio
+import logging
+import math
+import os
+from pathlib import Path
+from typing import Optional
+
+import asyncpg
+import uvicorn
+from dotenv import load_dotenv
+
+load_dotenv(Path(__file__).parent / "backend" / ".env")
+
+logger = logging.getLogger("launcher")
+
+# Instance-wide budgets that each worker process would otherwise apply on its own
+PER_INSTANCE_SETTINGS = {
+    "GEMINI_MAX_CONCURRENCY": "8",
+    "GENERATION_MAX_IN_FLIGHT": "32",
+    "JOB_WORKERS": "4",
+    "IMAGE_WORKERS": str(min(2, os.cpu_count() or 1)),
+}
+
+
+def available_cpus() -> int:
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+async def connection_budget(database_url: str) -> int:
+    conn = await asyncpg.connect(database_url)
+    try:
+        max_connections = int(await conn.fetchval("SHOW max_connections"))
+        reserved = int(await conn.fetchval("SHOW superuser_reserved_connections"))
+    finally:
+        await conn.close()
+    available = max_connections - reserved - int(os.environ.get("DB_RESERVED_CONNECTIONS", "10"))
+    return max(available // int(os.environ.get("DB_MAX_INSTANCES", "1")), 1)
+
+
+def split(total: int, workers: int) -> int:
+    return max(1, math.ceil(total / workers)) if total > 0 else 0
+
+
+def configure(workers: int, budget: Optional[int]) -> int:
+    if budget is not None:
+        # Each worker holds its pool plus one LISTEN connection for cluster events
+        workers = max(1, min(workers, budget // 3))
+        pool_size = max(1, min(int(os.environ.get("DB_POOL_MAX_SIZE", "10")), budget // workers - 1))
+        os.environ["DB_POOL_MAX_SIZE"] = str(pool_size)
+        os.environ["DB_POOL_MIN_SIZE"] = str(min(int(os.environ.get("DB_POOL_MIN_SIZE", "1")), pool_size))
+        logger.info(f"Postgres budget of {budget} connections: {workers} workers x {pool_size} pooled")
+
+    for name, default in PER_INSTANCE_SETTINGS.items():
+        os.environ[name] = str(split(int(os.environ.get(name, default)), workers))
+    if workers > 1 and budget is not None:
+        os.environ.setdefault("RATE_LIMIT_BACKEND", "postgres")
+        os.environ.setdefault("GENERATION_CACHE_DB", "true")
+    os.environ["RUN_MIGRATIONS_ON_STARTUP"] = "false"
+    return workers
+
+
 def main():
-    print("Hello from repl-nix-workspace!")
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    database_url = os.environ.get("DATABASE_URL", "")
+    workers = int(os.environ.get("WEB_CONCURRENCY") or available_cpus())
+    workers = configure(workers, asyncio.run(connection_budget(database_url)) if database_url else None)
+
+    # backend.server reads its settings at import, and a single worker reuses this process's module,
+    # so it is only imported once the environment above is final
+    from backend import server
+
+    if database_url and os.environ.get("MIGRATE_ON_LAUNCH", "true").lower() in ("1", "true", "yes"):
+        asyncio.run(server.migrate())
+
+    logger.info(f"Starting {workers} workers on {available_cpus()} CPUs")
+    uvicorn.run(
+        "backend.server:app",
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "5000")),
+        workers=workers,
+    )
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 #!/bin/bash
 cd /home/runner/workspace
+python -m backend.server migrate
 python -m uvicorn backend.server:app --host localhost --port 8000 &
 BACKEND_PID=$!
 
@@ -0,0 +1,128 @@
+import asyncio
+import os
+import tempfile
+import types
+
+import pytest
+
+# Module-level config in backend.server is read once at import, so the test defaults go in first.
+# Postgres-backed tests run only when TEST_DATABASE_URL points at a throwaway database: its public
+# schema is dropped and re-migrated for every such test.
+os.environ["DATABASE_URL"] = ""
+os.environ["BLOB_STORE_DIR"] = tempfile.mkdtemp(prefix="valentine-test-blobs-")
+os.environ["CLUSTER_EVENTS"] = "false"
+os.environ["RUN_MIGRATIONS_ON_STARTUP"] = "true"
+os.environ["JOB_WORKERS"] = "0"
+os.environ["UPLOAD_ORPHAN_HOURS"] = "0"
+os.environ.pop("RETENTION_DAYS", None)
+for name in ("GOOGLE_API_KEY", "GOOGLE_API_KEY1", "GOOGLE_API_KEY2", "GOOGLE_API_KEY3", "GEMINI_API_KEY"):
+    os.environ.pop(name, None)
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from backend import server  # noqa: E402
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL", "")
+
+CARD_JSON = '{"poem": "Roses are red", "love_notes": ["You are kind"], "scratch_message": "Be mine"}'
+
+
+class FakeModels:
+    def __init__(self, text: str = CARD_JSON, delay: float = 0.0, error: Exception = None):
+        self.text = text
+        self.delay = delay
+        self.error = error
+        self.calls = []
+
+    async def generate_content(self, model, contents, config=None):
+        self.calls.append((contents, config))
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return types.SimpleNamespace(text=self.text, usage_metadata=None, candidates=None)
+
+    async def generate_content_stream(self, model, contents, config=None):
+        self.calls.append((contents, config))
+        if self.error is not None:
+            raise self.error
+
+        async def chunks():
+            for word in self.text.split(" "):
+                await asyncio.sleep(self.delay)
+                yield types.SimpleNamespace(text=word + " ", usage_metadata=None, candidates=None)
+        return chunks()
+
+
+class FakeGemini:
+    def __init__(self, **kwargs):
+        self.models = FakeModels(**kwargs)
+        self.aio = types.SimpleNamespace(models=self.models, aclose=self.aclose)
+        self.closed = False
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    fake = FakeGemini()
+    monkeypatch.setattr(server, "init_gemini_clients", lambda: setattr(
+        server, "key_scheduler", server.KeyScheduler([server.KeyState("TEST_KEY", fake)])
+    ))
+    server.init_gemini_clients()
+    return fake
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(server, "db_pool", None)
+    monkeypatch.setattr(server, "response_cache", server.ResponseCache(1024 * 1024, 64 * 1024))
+    monkeypatch.setattr(server, "generation_cache", server.GenerationCache(128, 60.0, 65536, False))
+    monkeypatch.setattr(server, "generation_flights", server.SingleFlight())
+    monkeypatch.setattr(server, "request_flights", server.SingleFlight())
+    monkeypatch.setattr(server, "rate_limiter", server.RateLimiter("memory", 6, 10, 1000))
+    monkeypatch.setattr(server, "admission", server.AdmissionControl(32))
+    monkeypatch.setattr(server, "job_queue", server.JobQueue(0))
+    monkeypatch.setattr(server, "retention_job", server.RetentionJob(0))
+    monkeypatch.setattr(server, "gemini_semaphore", asyncio.Semaphore(8))
+    monkeypatch.setattr(server, "key_scheduler", server.KeyScheduler([]))
+
+
+@pytest.fixture
+def client(gemini):
+    with TestClient(server.app) as test_client:
+        yield test_client
+
+
+async def reset_schema(url: str):
+    conn = await server.asyncpg.connect(url)
+    try:
+        await conn.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+    finally:
+        await conn.close()
+
+
+@pytest.fixture
+def database_url(monkeypatch):
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    asyncio.run(reset_schema(TEST_DATABASE_URL))
+    monkeypatch.setattr(server, "DATABASE_URL", TEST_DATABASE_URL)
+    return TEST_DATABASE_URL
+
+
+@pytest.fixture
+def db_client(database_url, gemini):
+    with TestClient(server.app) as test_client:
+        yield test_client
+
+
+def card_payload(**overrides) -> dict:
+    return {"girlfriend_name": "Ana", "description": "Loves hiking", "photos": [], "sender_name": "Ben", **overrides}
+
+
+def letter_payload(**overrides) -> dict:
+    return {
+        "letter_type": "love", "recipient_name": "Zoe", "sender_name": "Al",
+        "context": "We met in Paris", "tone": "romantic", "photos": [], **overrides,
+    }
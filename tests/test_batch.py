@@ -0,0 +1,46 @@
+import json
+
+from backend import server
+from tests.conftest import card_payload, letter_payload
+
+UNKNOWN_PHOTO = server.PHOTO_URL_PREFIX + "0" * 64
+
+
+def ndjson(response) -> list:
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_letter_batch_streams_one_line_per_item(db_client):
+    letters = [letter_payload(recipient_name=f"R{i}") for i in range(3)]
+    response = db_client.post("/api/letters/batch", json={"letters": letters})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+
+    *items, summary = ndjson(response)
+    assert summary == {"done": True, "succeeded": 3, "failed": 0}
+    assert sorted(item["index"] for item in items) == [0, 1, 2]
+    for item in items:
+        letter = item["letter"]
+        assert letter["recipient_name"] == f"R{item['index']}"
+        stored = db_client.get(f"/api/letters/{letter['id']}")
+        assert stored.status_code == 200
+        assert stored.json()["content"] == letter["content"]
+
+
+def test_failed_items_do_not_abort_the_batch(db_client):
+    cards = [card_payload(), card_payload(photos=[UNKNOWN_PHOTO]), card_payload()]
+    *items, summary = ndjson(db_client.post("/api/cards/batch", json={"cards": cards}))
+    assert summary == {"done": True, "succeeded": 2, "failed": 1}
+    assert [item for item in items if item["status"] == "error"] == [
+        {"index": 1, "status": "error", "error": "Unknown photo reference"}
+    ]
+
+
+def test_batch_size_is_validated(db_client):
+    assert db_client.post("/api/cards/batch", json={"cards": []}).status_code == 422
+    too_many = {"letters": [letter_payload()] * (server.BATCH_MAX_ITEMS + 1)}
+    assert db_client.post("/api/letters/batch", json=too_many).status_code == 422
+
+
+def test_batch_needs_a_database(client):
+    assert client.post("/api/cards/batch", json={"cards": [card_payload()]}).status_code == 503
@@ -0,0 +1,35 @@
+import argparse
+
+import backend_benchmark
+
+
+def bench_args(**overrides) -> argparse.Namespace:
+    return argparse.Namespace(**{"gemini_port": 8798, "keys": 2, "rate_limit": False, **overrides})
+
+
+def test_spawned_server_runs_without_the_rate_limiter(monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_BACKEND", "memory")
+    env = backend_benchmark.server_env(bench_args(), "postgresql://bench", "/tmp/bench")
+    assert env["RATE_LIMIT_BACKEND"] == "off"
+    assert env["DATABASE_URL"] == "postgresql://bench"
+    assert env["GEMINI_BASE_URL"] == "http://127.0.0.1:8798"
+
+
+def test_rate_limit_flag_keeps_the_callers_limiter_settings(monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_BACKEND", "memory")
+    env = backend_benchmark.server_env(bench_args(rate_limit=True), "postgresql://bench", "/tmp/bench")
+    assert env["RATE_LIMIT_BACKEND"] == "memory"
+
+
+def test_only_the_requested_number_of_fake_keys_is_set(monkeypatch):
+    monkeypatch.setenv("GEMINI_API_KEY", "real-key")
+    env = backend_benchmark.server_env(bench_args(keys=1), "postgresql://bench", "/tmp/bench")
+    assert env["GOOGLE_API_KEY"] == "bench-key-0"
+    assert "GOOGLE_API_KEY1" not in env
+    assert "GEMINI_API_KEY" not in env
+
+
+def test_percentile_uses_nearest_rank():
+    assert backend_benchmark.percentile([1.0, 2.0, 3.0, 4.0], 0.5) == 2.0
+    assert backend_benchmark.percentile([1.0, 2.0, 3.0, 4.0], 0.99) == 4.0
+    assert backend_benchmark.percentile([], 0.5) == 0.0
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from backend import server
+from tests.test_retention import upload
+
+
+def test_blob_store_subclasses_must_implement_every_operation():
+    class ReadOnlyStore(server.BlobStore):
+        async def get(self, digest):
+            return None
+
+        async def exists(self, digest):
+            return False
+
+    with pytest.raises(TypeError, match="delete, put"):
+        ReadOnlyStore()
+    with pytest.raises(TypeError):
+        server.BlobStore()
+
+
+def test_local_blob_store_round_trip(tmp_path):
+    store = server.LocalBlobStore(tmp_path)
+    digest = "ab" + "0" * 62
+
+    async def round_trip():
+        assert await store.get(digest) is None
+        await store.put(digest, b"first")
+        await store.put(digest, b"second")
+        assert await store.exists(digest)
+        data = await store.get(digest)
+        await store.delete(digest)
+        await store.delete(digest)
+        return data, await store.exists(digest)
+
+    assert asyncio.run(round_trip()) == (b"first", False)
+    assert (tmp_path / "ab").is_dir()
+    assert not list(tmp_path.rglob("*.tmp"))
+
+
+def test_postgres_blob_store_round_trip(db_client):
+    store = server.PostgresBlobStore()
+    digest = "cd" + "0" * 62
+
+    async def round_trip():
+        assert await store.get(digest) is None
+        await store.put(digest, b"first")
+        await store.put(digest, b"second")
+        assert await store.exists(digest)
+        data = await store.get(digest)
+        await store.delete(digest)
+        return data, await store.exists(digest)
+
+    assert db_client.portal.call(round_trip) == (b"first", False)
+
+
+def test_photos_are_served_from_the_postgres_blob_store(db_client, monkeypatch):
+    monkeypatch.setattr(server, "blob_store", server.PostgresBlobStore())
+    url = upload(db_client, (40, 80, 120))
+    digest = url.removeprefix(server.PHOTO_URL_PREFIX)
+
+    assert db_client.get(url).headers["content-type"] == "image/webp"
+    assert db_client.portal.call(server.blob_store.exists, server.variant_key(digest, "thumb"))
+    assert not list(server.BLOB_STORE_DIR.rglob(f"{digest}*"))
+
+
+def test_postgres_blob_store_needs_a_database(client):
+    with pytest.raises(server.HTTPException) as raised:
+        asyncio.run(server.PostgresBlobStore().get("0" * 64))
+    assert raised.value.status_code == 503
+
+
+def test_blob_store_backend_is_chosen_by_name():
+    assert isinstance(server.make_blob_store("postgres"), server.PostgresBlobStore)
+    assert server.make_blob_store("local").root == server.BLOB_STORE_DIR
+    with pytest.raises(ValueError, match="BLOB_STORE_BACKEND"):
+        server.make_blob_store("s3")
+
+
+def test_local_blob_store_on_an_ephemeral_host_is_reported(gemini, monkeypatch, caplog):
+    monkeypatch.setenv("K_SERVICE", "valentine")
+    with TestClient(server.app):
+        pass
+    assert "BLOB_STORE_BACKEND=postgres" in caplog.text
@@ -0,0 +1,58 @@
+import gzip
+
+import brotli
+import pytest
+
+from backend import server
+from tests.conftest import card_payload
+
+LONG_DESCRIPTION = "Loves hiking and sunsets by the lake. " * 60
+
+
+@pytest.mark.parametrize("encoding, decompress", [("br", brotli.decompress), ("gzip", gzip.decompress)])
+def test_large_api_responses_are_compressed(db_client, encoding, decompress):
+    card = db_client.post("/api/cards", json=card_payload(description=LONG_DESCRIPTION)).json()
+    response = db_client.get(f"/api/cards/{card['id']}", headers={"Accept-Encoding": encoding})
+
+    assert response.headers["content-encoding"] == encoding
+    assert response.headers["etag"].startswith("W/")
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert int(response.headers["content-length"]) < len(response.content)
+    assert response.json()["description"] == LONG_DESCRIPTION
+
+    revalidated = db_client.get(
+        f"/api/cards/{card['id']}", headers={"Accept-Encoding": encoding, "If-None-Match": response.headers["etag"]}
+    )
+    assert revalidated.status_code == 304
+
+
+def test_compressed_bodies_are_reused_per_etag(db_client, monkeypatch):
+    monkeypatch.setattr(server, "response_compressor", server.ResponseCompressor(server.ResponseCache(1 << 20, 1 << 20)))
+    card = db_client.post(
+        "/api/cards", json=card_payload(description=LONG_DESCRIPTION), headers={"Accept-Encoding": "identity"}
+    ).json()
+    for _ in range(3):
+        db_client.get(f"/api/cards/{card['id']}", headers={"Accept-Encoding": "gzip"})
+    assert server.response_compressor.cpu_seconds.snapshot()["count"] == 1
+    assert server.response_compressor.cache.hits == 2
+
+
+def test_small_and_unaccepted_responses_are_sent_as_is(client):
+    small = client.get("/api/", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+    assert small.headers["vary"] == "Accept-Encoding"
+
+    metrics = client.get("/api/metrics/keys", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in metrics.headers
+
+
+def test_accept_encoding_negotiation():
+    def negotiate(header):
+        request = server.Request({"type": "http", "headers": [(b"accept-encoding", header.encode())]})
+        return server.negotiate_encoding(request, {"br": 1, "gzip": 1})
+
+    assert negotiate("gzip, br") == "br"
+    assert negotiate("br;q=0, gzip") == "gzip"
+    assert negotiate("*") == "br"
+    assert negotiate("identity") is None
+    assert negotiate("gzip;q=bogus") is None
@@ -0,0 +1,68 @@
+import asyncpg
+import pytest
+from fastapi.testclient import TestClient
+
+from backend import server
+from tests.conftest import card_payload
+from tests.test_documents import LEGACY_SCHEMA
+from tests.test_retention import run_sql
+
+
+@pytest.fixture(autouse=True)
+def fresh_db_metrics(monkeypatch):
+    monkeypatch.setattr(server, "db_metrics", server.DatabaseMetrics())
+
+
+def test_pool_uses_the_configured_size_and_statement_timeout(database_url, gemini, monkeypatch):
+    monkeypatch.setattr(server, "DB_POOL_MAX_SIZE", 3)
+    monkeypatch.setattr(server, "DB_STATEMENT_TIMEOUT_MS", 1234)
+    with TestClient(server.app) as client:
+        assert server.db_pool.get_max_size() == 3
+        assert client.portal.call(server.db_pool.fetchval, "SHOW statement_timeout") == "1234ms"
+        assert client.get("/api/metrics/db").json()["pool"]["max_size"] == 3
+
+
+def test_exhausted_pool_answers_503(database_url, gemini, monkeypatch):
+    monkeypatch.setattr(server, "DB_POOL_MIN_SIZE", 1)
+    monkeypatch.setattr(server, "DB_POOL_MAX_SIZE", 1)
+    monkeypatch.setattr(server, "DB_ACQUIRE_TIMEOUT", 0.05)
+    with TestClient(server.app) as client:
+        card = client.post("/api/cards", json=card_payload()).json()
+        server.response_cache.discard(f"card:{card['id']}")
+        held = client.portal.call(server.db_pool.acquire)
+        try:
+            response = client.get(f"/api/cards/{card['id']}")
+        finally:
+            client.portal.call(server.db_pool.release, held)
+
+        assert response.status_code == 503
+        assert response.json()["detail"] == "Database is busy, please retry."
+        assert server.db_metrics.acquire_timeouts == 1
+        assert client.get(f"/api/cards/{card['id']}").status_code == 200
+
+
+def test_hot_statements_are_timed_and_failures_counted(db_client):
+    db_client.post("/api/cards", json=card_payload())
+    assert server.db_metrics.queries["insert_card"].count == 1
+
+    async def insert_duplicate():
+        async with server.acquire_connection() as conn:
+            row = await conn.fetchrow("SELECT * FROM valentine_cards")
+            await server.run_statement(
+                conn, "insert_card", "execute", str(row["id"]), "A", "B", "C", [], "", [], "", row["created_at"], "ready"
+            )
+
+    with pytest.raises(asyncpg.UniqueViolationError):
+        db_client.portal.call(insert_duplicate)
+    assert server.db_metrics.query_errors["insert_card"] == 1
+    assert server.db_metrics.queries["insert_card"].count == 2
+
+
+def test_unmigrated_columns_do_not_stop_the_pool(database_url, gemini, monkeypatch, caplog):
+    monkeypatch.setattr(server, "RUN_MIGRATIONS_ON_STARTUP", False)
+    run_sql(database_url, LEGACY_SCHEMA)
+    run_sql(database_url, "CREATE TABLE schema_version (version INTEGER PRIMARY KEY, description TEXT NOT NULL)")
+    with TestClient(server.app):
+        assert server.db_pool is not None
+    assert "Could not pre-prepare insert_card" in caplog.text
+    assert f"Database schema is at version 0, expected {server.SCHEMA_VERSION}" in caplog.text
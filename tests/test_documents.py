@@ -0,0 +1,77 @@
+import uuid
+
+from fastapi.testclient import TestClient
+
+from backend import server
+from tests.conftest import card_payload, letter_payload
+from tests.test_migrations import column_type, fetch
+from tests.test_retention import run_sql, upload
+
+LEGACY_SCHEMA = """
+    CREATE TABLE valentine_cards (
+        id VARCHAR(36) PRIMARY KEY, girlfriend_name VARCHAR(255) NOT NULL, sender_name VARCHAR(255) NOT NULL,
+        description TEXT NOT NULL, photos TEXT NOT NULL DEFAULT '[]', poem TEXT NOT NULL DEFAULT '',
+        love_notes TEXT NOT NULL DEFAULT '[]', scratch_message TEXT NOT NULL DEFAULT '',
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    );
+    CREATE TABLE love_letters (
+        id VARCHAR(36) PRIMARY KEY, letter_type VARCHAR(50) NOT NULL, recipient_name VARCHAR(255) NOT NULL,
+        sender_name VARCHAR(255) NOT NULL, context TEXT NOT NULL DEFAULT '', custom_prompt TEXT,
+        tone VARCHAR(50) NOT NULL DEFAULT 'romantic', photos TEXT NOT NULL DEFAULT '[]', content TEXT NOT NULL DEFAULT '',
+        template VARCHAR(50) NOT NULL DEFAULT 'classic', font VARCHAR(50) NOT NULL DEFAULT 'playfair',
+        color_scheme VARCHAR(50) NOT NULL DEFAULT 'romantic-red', created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    );
+"""
+DATA_URL = "data:image/png;base64,iVBORw0KGgo="
+
+
+def test_read_documents_built_in_sql_match_the_created_resources(db_client):
+    photo = upload(db_client, (90, 10, 10))
+    card = db_client.post("/api/cards", json=card_payload(photos=[photo])).json()
+    letter = db_client.post("/api/letters", json=letter_payload(photos=[photo], custom_prompt='Say "hi"\n')).json()
+    server.response_cache.discard(f"card:{card['id']}")
+    server.response_cache.discard(f"letter:{letter['id']}")
+
+    assert db_client.get(f"/api/cards/{card['id']}").json() == card
+    assert db_client.get(f"/api/letters/{letter['id']}").json() == letter
+    assert card["photos"] == [photo]
+
+
+def test_legacy_text_columns_are_converted_to_jsonb(database_url, gemini):
+    run_sql(database_url, LEGACY_SCHEMA)
+    card_id = str(uuid.uuid4())
+    run_sql(
+        database_url,
+        "INSERT INTO valentine_cards (id, girlfriend_name, sender_name, description, photos, love_notes) VALUES ($1, 'Ana', 'Ben', 'd', $2, $3)",
+        card_id, f'["{DATA_URL}"]', '["one", "two"]'
+    )
+
+    with TestClient(server.app) as client:
+        for table, column in server.JSON_COLUMNS:
+            rows = fetch(database_url, "SELECT data_type FROM information_schema.columns WHERE table_name = $1 AND column_name = $2", table, column)
+            assert rows[0]["data_type"] == "jsonb"
+        assert column_type(database_url, "valentine_cards") == "uuid"
+
+        card = client.get(f"/api/cards/{card_id}").json()
+        assert card["photos"] == [DATA_URL]
+        assert card["love_notes"] == ["one", "two"]
+        assert card["status"] == "ready"
+
+
+def test_empty_custom_prompt_reads_the_same_from_cache_and_database(db_client):
+    for custom_prompt in ("", None):
+        letter = db_client.post("/api/letters", json=letter_payload(recipient_name="Zoë", custom_prompt=custom_prompt)).json()
+        assert letter["custom_prompt"] is None
+        cached = db_client.get(f"/api/letters/{letter['id']}")
+        server.response_cache.discard(f"letter:{letter['id']}")
+        cold = db_client.get(f"/api/letters/{letter['id']}")
+        assert cold.content == cached.content
+        assert cold.headers["etag"] == cached.headers["etag"]
+        assert cold.json() == letter
+
+
+def test_card_bodies_are_byte_identical_from_cache_and_database(db_client):
+    card = db_client.post("/api/cards", json=card_payload(description="Café ☕")).json()
+    cached = db_client.get(f"/api/cards/{card['id']}").content
+    server.response_cache.discard(f"card:{card['id']}")
+    assert db_client.get(f"/api/cards/{card['id']}").content == cached
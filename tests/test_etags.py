@@ -0,0 +1,32 @@
+from tests.conftest import card_payload, letter_payload
+
+MISSING_ID = "01890a5d-ac96-774b-bcce-b302099a8057"
+
+
+def test_wildcard_if_none_match_does_not_hide_missing_resources(db_client):
+    for path in (f"/api/cards/{MISSING_ID}", f"/api/letters/{MISSING_ID}", f"/api/cards/{MISSING_ID}/og.jpg"):
+        assert db_client.get(path, headers={"If-None-Match": "*"}).status_code == 404
+
+
+def test_ready_card_revalidates_with_its_etag(db_client):
+    card = db_client.post("/api/cards", json=card_payload()).json()
+    first = db_client.get(f"/api/cards/{card['id']}")
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    assert "immutable" in first.headers["cache-control"]
+
+    assert db_client.get(f"/api/cards/{card['id']}", headers={"If-None-Match": etag}).status_code == 304
+    assert db_client.get(f"/api/cards/{card['id']}", headers={"If-None-Match": f'"other", W/{etag}'}).status_code == 304
+    assert db_client.get(f"/api/cards/{card['id']}", headers={"If-None-Match": "*"}).status_code == 200
+
+
+def test_letter_etag_is_stable_across_reads(db_client):
+    letter = db_client.post("/api/letters", json=letter_payload()).json()
+    first = db_client.get(f"/api/letters/{letter['id']}")
+    second = db_client.get(f"/api/letters/{letter['id']}")
+    assert first.headers["etag"] == second.headers["etag"]
+    assert first.json()["content"] == letter["content"]
+
+
+def test_invalid_ids_are_404_without_a_database(client):
+    assert client.get("/api/cards/not-a-uuid", headers={"If-None-Match": "*"}).status_code == 404
@@ -0,0 +1,50 @@
+import asyncio
+import logging
+
+from backend import server
+from tests.conftest import FakeGemini
+
+
+def test_one_client_per_key_with_the_configured_base_url(monkeypatch):
+    created = []
+
+    def client(api_key, http_options=None):
+        created.append((api_key, http_options))
+        return FakeGemini()
+    monkeypatch.setattr(server.genai, "Client", client)
+    monkeypatch.setattr(server, "API_KEY_NAMES", ["GOOGLE_API_KEY", "GOOGLE_API_KEY2"])
+    monkeypatch.setattr(server, "API_KEYS", ["first-key", "second-key"])
+    monkeypatch.setattr(server, "GEMINI_BASE_URL", "http://127.0.0.1:9")
+
+    server.init_gemini_clients()
+    assert [state.name for state in server.key_scheduler.states] == ["GOOGLE_API_KEY", "GOOGLE_API_KEY2"]
+    assert [api_key for api_key, _ in created] == ["first-key", "second-key"]
+    assert all(options.base_url == "http://127.0.0.1:9" for _, options in created)
+
+    clients = [state.client for state in server.key_scheduler.states]
+    asyncio.run(server.close_gemini_clients())
+    assert all(client.closed for client in clients)
+    assert server.key_scheduler.states == []
+
+
+def test_close_logs_client_errors_and_closes_the_rest(monkeypatch, caplog):
+    broken, healthy = FakeGemini(), FakeGemini()
+
+    async def fail():
+        raise RuntimeError("socket already closed")
+    broken.aio.aclose = fail
+    monkeypatch.setattr(server, "key_scheduler", server.KeyScheduler([
+        server.KeyState("BROKEN", broken), server.KeyState("HEALTHY", healthy),
+    ]))
+
+    with caplog.at_level(logging.WARNING, logger=server.logger.name):
+        asyncio.run(server.close_gemini_clients())
+    assert healthy.closed
+    assert "Failed to close Gemini client BROKEN" in caplog.text
+
+
+def test_generations_go_through_the_async_client(gemini):
+    for _ in range(2):
+        asyncio.run(server.generate_romantic_content("Ana", "Loves hiking", "Ben", use_cache=False))
+    assert len(gemini.models.calls) == 2
+    assert server.key_scheduler.states[0].successes == 2
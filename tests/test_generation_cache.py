@@ -0,0 +1,61 @@
+import asyncio
+
+import asyncpg
+
+from backend import server
+
+
+def test_cache_key_ignores_whitespace_differences():
+    first = server.generation_cache_key("card", girlfriend_name="Ana", description="loves  hiking\n")
+    second = server.generation_cache_key("card", girlfriend_name=" Ana", description="loves hiking")
+    assert first == second
+    assert first != server.generation_cache_key("card", girlfriend_name="Ana", description="loves biking")
+
+
+def test_memory_tier_expires_and_evicts():
+    cache = server.GenerationCache(2, 60.0, 1024, False)
+
+    async def exercise():
+        await cache.set("a", "1")
+        await cache.set("b", "2")
+        await cache.set("c", "3")
+        assert await cache.get("a") is None
+        assert await cache.get("c") == "3"
+        cache.entries["c"] = (0.0, "3")
+        assert await cache.get("c") is None
+        await cache.set("big", "x" * 2048)
+        assert await cache.get("big") is None
+
+    asyncio.run(exercise())
+    assert cache.rejected == 1
+
+
+def test_sweep_deletes_expired_database_entries(db_client, database_url, monkeypatch):
+    monkeypatch.setattr(server, "RETENTION_BATCH_SIZE", 2)
+    monkeypatch.setattr(server, "RETENTION_BATCH_PAUSE", 0)
+
+    async def seed():
+        conn = await asyncpg.connect(database_url)
+        try:
+            await conn.executemany(
+                "INSERT INTO generation_cache (key, value, expires_at) VALUES ($1, 'v', NOW() + make_interval(secs => $2))",
+                [(f"expired{i}", -60.0) for i in range(5)] + [("live", 3600.0)]
+            )
+            assert await conn.fetchval(
+                "SELECT count(*) FROM pg_indexes WHERE indexname = 'generation_cache_expires_at_idx'"
+            ) == 1
+        finally:
+            await conn.close()
+
+    async def remaining():
+        conn = await asyncpg.connect(database_url)
+        try:
+            return [row["key"] for row in await conn.fetch("SELECT key FROM generation_cache")]
+        finally:
+            await conn.close()
+
+    asyncio.run(seed())
+    db_client.portal.call(server.retention_job.sweep)
+
+    assert asyncio.run(remaining()) == ["live"]
+    assert server.retention_job.cache_entries == 5
@@ -0,0 +1,58 @@
+from fastapi.testclient import TestClient
+
+from backend import server
+from tests.conftest import card_payload, letter_payload
+
+
+def slow_gemini(monkeypatch, gemini):
+    monkeypatch.setattr(server, "GENERATION_BUDGET_SECONDS", 0.05)
+    gemini.models.delay = 5
+
+
+def test_sync_post_gets_template_content_as_a_finished_resource(db_client, gemini, monkeypatch):
+    slow_gemini(monkeypatch, gemini)
+    for path, payload in (("/api/cards", card_payload()), ("/api/letters", letter_payload())):
+        response = db_client.post(path, json=payload)
+        assert response.status_code == 200
+        assert response.json()["status"] == "ready"
+        assert db_client.get(f"{path}/{response.json()['id']}").json()["status"] == "ready"
+
+
+def test_prefer_respond_async_gets_a_draft(db_client, gemini, monkeypatch):
+    slow_gemini(monkeypatch, gemini)
+    for path, payload in (("/api/cards", card_payload()), ("/api/letters", letter_payload())):
+        response = db_client.post(path, json=payload, headers={"Prefer": "respond-async, wait=10"})
+        assert response.status_code == 202
+        assert response.json()["status"] == "draft"
+        assert response.headers["cache-control"] == "no-store"
+
+
+def test_async_query_queues_the_resource(db_client):
+    response = db_client.post("/api/cards?async=1", json=card_payload())
+    assert response.status_code == 202
+    assert response.json()["status"] == "pending"
+
+
+def test_generated_content_is_ready_even_when_async_is_preferred(db_client):
+    response = db_client.post("/api/cards", json=card_payload(), headers={"Prefer": "respond-async"})
+    assert response.status_code == 200
+    assert response.json()["poem"] == "Roses are red"
+
+
+def test_shutdown_cancels_generations_before_closing_clients(database_url, gemini, monkeypatch):
+    slow_gemini(monkeypatch, gemini)
+    closed_with_pending = []
+
+    async def aclose():
+        closed_with_pending.append([not task.done() for task in flights])
+        gemini.closed = True
+    gemini.aio.aclose = aclose
+
+    with TestClient(server.app) as client:
+        assert client.post("/api/cards", json=card_payload()).status_code == 200
+        flights = list(server.generation_flights.calls.values())
+        assert flights
+
+    assert all(task.cancelled() for task in flights)
+    assert closed_with_pending == [[False] * len(flights)]
+    assert gemini.closed
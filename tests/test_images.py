@@ -0,0 +1,70 @@
+import io
+
+import pytest
+from PIL import Image
+
+from backend import server
+
+
+def png_bytes(image: Image.Image, **params) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format="PNG", **params)
+    return output.getvalue()
+
+
+def half_transparent(mode: str) -> bytes:
+    image = Image.new("RGBA", (40, 20), (200, 30, 40, 255))
+    image.paste((0, 0, 0, 0), (20, 0, 40, 20))
+    if mode == "P":
+        return png_bytes(image.convert("P"), transparency=0)
+    return png_bytes(image.convert(mode))
+
+
+def decode(data: bytes) -> Image.Image:
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "LA", "P"])
+def test_transparent_uploads_are_flattened_onto_white_for_jpeg(mode):
+    variants = server.process_image(half_transparent(mode), "JPEG", 1_000_000)
+    assert set(variants) == set(server.IMAGE_VARIANTS)
+    for data in variants.values():
+        image = decode(data)
+        assert (image.format, image.mode) == ("JPEG", "RGB")
+        assert min(image.getpixel((35, 10))) > 240
+
+
+def test_palette_uploads_without_transparency_save_as_jpeg():
+    data = png_bytes(Image.new("RGB", (30, 30), (10, 120, 200)).convert("P"))
+    assert decode(server.process_image(data, "JPEG", 1_000_000)["thumb"]).mode == "RGB"
+
+
+def test_webp_keeps_the_alpha_channel():
+    image = decode(server.process_image(half_transparent("RGBA"), "WEBP", 1_000_000)["display"])
+    assert image.mode == "RGBA"
+    assert image.getpixel((35, 10))[3] == 0
+
+
+def test_oversized_and_unsupported_images_are_rejected():
+    with pytest.raises(ValueError, match="too large"):
+        server.process_image(half_transparent("RGBA"), "JPEG", 100)
+    with pytest.raises(ValueError, match="Invalid image"):
+        server.process_image(b"not an image", "JPEG", 1_000_000)
+
+
+def test_uploads_are_served_in_size_bucketed_variants(client):
+    output = io.BytesIO()
+    Image.new("RGB", (2000, 1000), (30, 60, 90)).save(output, format="JPEG")
+    upload = client.post("/api/photos", files=[("photo", ("big.jpg", output.getvalue(), "image/jpeg"))])
+    url = upload.json()["photos"][0]
+
+    sizes = {}
+    for variant in server.IMAGE_VARIANTS:
+        response = client.get(url, params={"variant": variant})
+        assert response.headers["content-type"] == "image/webp"
+        assert response.headers["etag"].endswith(f'-{variant}"')
+        sizes[variant] = decode(response.content).size
+    assert sizes == {"thumb": (480, 240), "display": (1600, 800), "original": (2000, 1000)}
+    assert decode(client.get(url).content).size == sizes[server.DEFAULT_IMAGE_VARIANT]
@@ -0,0 +1,97 @@
+from backend import server
+from tests.conftest import card_payload, letter_payload
+from tests.test_retention import run_sql
+
+
+def drain(client) -> int:
+    async def run_ready_jobs():
+        ran = 0
+        while (job := await server.job_queue.claim()) is not None:
+            await server.job_queue.run(job)
+            ran += 1
+        return ran
+    return client.portal.call(run_ready_jobs)
+
+
+def test_async_card_is_pending_until_its_job_runs(db_client):
+    card = db_client.post("/api/cards?async=1", json=card_payload()).json()
+    pending = db_client.get(f"/api/cards/{card['id']}")
+    assert pending.json()["status"] == "pending"
+    assert pending.headers["cache-control"] == "no-store"
+    assert "etag" not in pending.headers
+
+    assert drain(db_client) == 1
+    ready = db_client.get(f"/api/cards/{card['id']}")
+    assert ready.json()["status"] == "ready"
+    assert ready.json()["poem"] == "Roses are red"
+    assert "etag" in ready.headers
+    assert server.job_queue.completed == 1
+
+
+def test_async_letter_is_generated_by_the_queue(db_client, gemini):
+    gemini.models.text = "Dear Zoe, you are my favourite person."
+    letter = db_client.post("/api/letters?async=1", json=letter_payload()).json()
+    assert letter["status"] == "pending"
+
+    drain(db_client)
+    assert db_client.get(f"/api/letters/{letter['id']}").json()["content"] == "Dear Zoe, you are my favourite person."
+
+
+def test_draft_is_upgraded_with_generated_content(db_client, gemini, monkeypatch):
+    monkeypatch.setattr(server, "GENERATION_BUDGET_SECONDS", 0.05)
+    gemini.models.delay = 5
+    draft = db_client.post("/api/cards", json=card_payload(), headers={"Prefer": "respond-async"}).json()
+    assert draft["status"] == "draft"
+    assert draft["poem"]
+
+    gemini.models.delay = 0
+    drain(db_client)
+    upgraded = db_client.get(f"/api/cards/{draft['id']}").json()
+    assert upgraded["status"] == "ready"
+    assert upgraded["poem"] == "Roses are red"
+
+
+def test_failed_generation_is_retried_later(db_client, database_url, gemini):
+    gemini.models.error = RuntimeError("boom")
+    card = db_client.post("/api/cards?async=1", json=card_payload()).json()
+
+    assert drain(db_client) == 1
+    assert server.job_queue.retried == 1
+    assert db_client.get(f"/api/cards/{card['id']}").json()["status"] == "pending"
+
+    gemini.models.error = None
+    run_sql(database_url, "UPDATE generation_jobs SET run_after = NOW()")
+    drain(db_client)
+    assert db_client.get(f"/api/cards/{card['id']}").json()["status"] == "ready"
+
+
+def test_last_attempt_falls_back_to_template_content(db_client, gemini, monkeypatch):
+    monkeypatch.setattr(server, "JOB_MAX_ATTEMPTS", 1)
+    gemini.models.error = RuntimeError("boom")
+    card = db_client.post("/api/cards?async=1", json=card_payload()).json()
+
+    drain(db_client)
+    ready = db_client.get(f"/api/cards/{card['id']}").json()
+    assert ready["status"] == "ready"
+    assert "Ana" in ready["poem"]
+
+
+def test_job_that_keeps_crashing_marks_the_resource_failed(db_client, monkeypatch):
+    async def crash(job):
+        raise RuntimeError("handler bug")
+    monkeypatch.setattr(server, "JOB_MAX_ATTEMPTS", 1)
+    monkeypatch.setitem(server.JOB_HANDLERS, "card", crash)
+    card = db_client.post("/api/cards?async=1", json=card_payload()).json()
+
+    drain(db_client)
+    assert db_client.get(f"/api/cards/{card['id']}").json()["status"] == "failed"
+    assert server.job_queue.failed == 1
+
+
+def test_full_queue_rejects_async_requests(db_client, monkeypatch):
+    monkeypatch.setattr(server, "JOB_QUEUE_CAPACITY", 1)
+    assert db_client.post("/api/cards?async=1", json=card_payload()).status_code == 202
+    rejected = db_client.post("/api/letters?async=1", json=letter_payload())
+    assert rejected.status_code == 429
+    assert rejected.headers["retry-after"] == "5"
+    assert server.job_queue.rejected == 1
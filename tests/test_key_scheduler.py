@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+import pytest
+
+from backend import server
+from tests.conftest import FakeGemini
+
+
+class Throttled(Exception):
+    code = 429
+
+
+def schedule(monkeypatch, **clients):
+    scheduler = server.KeyScheduler([server.KeyState(name, client) for name, client in clients.items()])
+    monkeypatch.setattr(server, "key_scheduler", scheduler)
+    return scheduler
+
+
+def generate_card():
+    return asyncio.run(server.generate_romantic_content("Ana", "Loves hiking", "Ben", use_cache=False))
+
+
+def test_throttled_key_cools_down_and_the_next_key_answers(monkeypatch):
+    throttled, healthy = FakeGemini(error=Throttled("RESOURCE_EXHAUSTED")), FakeGemini()
+    scheduler = schedule(monkeypatch, A=throttled, B=healthy)
+
+    assert generate_card().poem == "Roses are red"
+    state = scheduler.states[0]
+    assert state.throttled == 1
+    assert state.breaker_state(time.monotonic()) == "open"
+    assert [s.name for s in scheduler.candidates()] == ["B"]
+
+
+def test_breaker_opens_after_consecutive_failures_and_recovers_through_one_trial(monkeypatch):
+    monkeypatch.setattr(server, "KEY_BREAKER_THRESHOLD", 2)
+    flaky = FakeGemini(error=RuntimeError("500"))
+    scheduler = schedule(monkeypatch, A=flaky)
+    state = scheduler.states[0]
+
+    for _ in range(2):
+        with pytest.raises(server.GenerationUnavailable):
+            generate_card()
+    assert state.breaker_state(time.monotonic()) == "open"
+    assert not scheduler.available()
+
+    state.open_until = time.monotonic() - 1
+    assert scheduler.available()
+    state.trial_in_flight = True
+    assert not scheduler.available()
+    state.trial_in_flight = False
+
+    flaky.models.error = None
+    assert generate_card().poem == "Roses are red"
+    assert state.breaker_state(time.monotonic()) == "closed"
+    assert state.consecutive_failures == 0
+
+
+def test_failed_trial_reopens_the_breaker(monkeypatch):
+    scheduler = schedule(monkeypatch, A=FakeGemini(error=RuntimeError("500")))
+    state = scheduler.states[0]
+    state.open_until = time.monotonic() - 1
+
+    with pytest.raises(server.GenerationUnavailable):
+        generate_card()
+    assert state.breaker_state(time.monotonic()) == "open"
+    assert not state.trial_in_flight
+
+
+def test_open_breakers_skip_straight_to_templates(monkeypatch):
+    scheduler = schedule(monkeypatch, A=FakeGemini())
+    scheduler.states[0].open_until = time.monotonic() + 60
+
+    assert asyncio.run(server.generate_within_budget("card", generate_card)) is None
+    assert scheduler.templates == {("card", "breaker_open"): 1}
+
+
+def test_candidates_rotate_and_prefer_idle_keys(monkeypatch):
+    scheduler = schedule(monkeypatch, A=FakeGemini(), B=FakeGemini(), C=FakeGemini())
+    assert [s.name for s in scheduler.candidates()] == ["A", "B", "C"]
+    assert [s.name for s in scheduler.candidates()] == ["B", "C", "A"]
+    scheduler.states[2].in_flight = 3
+    assert [s.name for s in scheduler.candidates()][-1] == "C"
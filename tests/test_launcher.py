@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import main
+
+ROOT = Path(__file__).parent.parent
+LAUNCHER_SETTINGS = [
+    "DB_POOL_MAX_SIZE", "DB_POOL_MIN_SIZE", "RATE_LIMIT_BACKEND", "GENERATION_CACHE_DB", "RUN_MIGRATIONS_ON_STARTUP",
+    *main.PER_INSTANCE_SETTINGS,
+]
+
+
+@pytest.fixture
+def launcher_env(monkeypatch):
+    for name in LAUNCHER_SETTINGS:
+        monkeypatch.delenv(name, raising=False)
+
+
+def run_python(code: str, **env) -> str:
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True,
+        env={**os.environ, "DATABASE_URL": "", **env},
+    )
+    return result.stdout.strip()
+
+
+def test_launcher_does_not_import_the_server_at_import_time():
+    assert run_python("import sys, main; print('backend.server' in sys.modules)") == "False"
+
+
+def test_single_worker_server_sees_launcher_settings():
+    code = (
+        "import main, uvicorn\n"
+        "uvicorn.run = lambda *args, **kwargs: None\n"
+        "main.main()\n"
+        "from backend import server\n"
+        "print(server.RUN_MIGRATIONS_ON_STARTUP, server.GEMINI_MAX_CONCURRENCY)"
+    )
+    output = run_python(code, WEB_CONCURRENCY="1", RUN_MIGRATIONS_ON_STARTUP="true", GEMINI_MAX_CONCURRENCY="3")
+    assert output.splitlines()[-1] == "False 3"
+
+
+def test_configure_sizes_workers_and_pools_to_the_connection_budget(launcher_env):
+    assert main.configure(8, 30) == 8
+    assert os.environ["DB_POOL_MAX_SIZE"] == "2"
+    assert os.environ["DB_POOL_MIN_SIZE"] == "1"
+    assert os.environ["GEMINI_MAX_CONCURRENCY"] == "1"
+    assert os.environ["GENERATION_MAX_IN_FLIGHT"] == "4"
+    assert os.environ["RATE_LIMIT_BACKEND"] == "postgres"
+    assert os.environ["GENERATION_CACHE_DB"] == "true"
+    assert os.environ["RUN_MIGRATIONS_ON_STARTUP"] == "false"
+
+
+def test_configure_caps_workers_when_connections_are_scarce(launcher_env):
+    assert main.configure(16, 9) == 3
+    assert os.environ["DB_POOL_MAX_SIZE"] == "2"
+
+
+def test_configure_without_database_keeps_local_backends(launcher_env):
+    assert main.configure(4, None) == 4
+    assert "DB_POOL_MAX_SIZE" not in os.environ
+    assert "RATE_LIMIT_BACKEND" not in os.environ
+    assert os.environ["JOB_WORKERS"] == "1"
@@ -0,0 +1,99 @@
+import json
+import time
+import types
+
+from backend import server
+from tests.conftest import FakeGemini, letter_payload
+
+LETTER = "Dear Zoe, you light up every room."
+
+
+def events(response) -> list:
+    parsed = []
+    for block in response.text.strip().split("\n\n"):
+        event, data = block.split("\n")
+        parsed.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return parsed
+
+
+def stream(client):
+    response = client.post("/api/letters/stream", json=letter_payload())
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    return events(response)
+
+
+def test_letter_streams_chunks_then_the_saved_letter(db_client, gemini):
+    gemini.models.text = LETTER
+    received = stream(db_client)
+
+    chunks = [data["text"] for event, data in received if event == "chunk"]
+    assert len(chunks) == len(LETTER.split(" "))
+    event, letter = received[-1]
+    assert event == "done"
+    assert letter["content"] == LETTER
+    assert db_client.get(f"/api/letters/{letter['id']}").json()["content"] == LETTER
+    assert server.admission.in_flight == 0
+
+
+def test_key_failing_mid_stream_resets_and_continues_on_the_next_key(db_client, gemini, monkeypatch):
+    async def break_after_one_chunk(model, contents, config=None):
+        async def chunks():
+            yield types.SimpleNamespace(text="Half a ", usage_metadata=None, candidates=None)
+            raise RuntimeError("connection reset")
+        return chunks()
+
+    broken = FakeGemini()
+    broken.models.generate_content_stream = break_after_one_chunk
+    gemini.models.text = LETTER
+    monkeypatch.setattr(server, "key_scheduler", server.KeyScheduler([
+        server.KeyState("BROKEN", broken), server.KeyState("TEST_KEY", gemini),
+    ]))
+
+    received = stream(db_client)
+    assert [event for event, _ in received[:3]] == ["chunk", "reset", "chunk"]
+    assert received[-1][1]["content"] == LETTER
+
+
+def test_open_breakers_stream_a_template_letter(db_client, gemini):
+    server.key_scheduler.states[0].open_until = time.monotonic() + 60
+    received = stream(db_client)
+
+    assert [event for event, _ in received] == ["chunk", "done"]
+    assert "Zoe" in received[-1][1]["content"]
+    assert gemini.models.calls == []
+    assert server.key_scheduler.templates == {("letter_stream", "breaker_open"): 1}
+
+
+def test_cached_letter_is_replayed_in_one_chunk(db_client, gemini):
+    gemini.models.text = LETTER
+    stream(db_client)
+    received = stream(db_client)
+
+    assert [event for event, _ in received] == ["chunk", "done"]
+    assert received[0][1]["text"] == LETTER
+    assert len(gemini.models.calls) == 1
+
+
+def test_unsent_stream_does_not_hold_a_generation_slot(db_client, gemini, monkeypatch):
+    monkeypatch.setattr(server, "admission", server.AdmissionControl(2))
+    request = server.Request({"type": "http", "method": "POST", "headers": [], "client": ("203.0.113.7", 1234)})
+    letter_data = server.LetterCreate(**letter_payload())
+    for _ in range(server.admission.limit + 1):
+        response = db_client.portal.call(server.create_letter_stream, letter_data, request)
+        assert isinstance(response, server.StreamingResponse)
+    assert server.admission.in_flight == 0
+    assert stream(db_client)[-1][0] == "done"
+
+
+def test_slot_taken_while_the_response_was_pending_ends_the_stream_with_an_error(db_client, monkeypatch):
+    monkeypatch.setattr(server, "admission", server.AdmissionControl(1))
+    request = server.Request({"type": "http", "method": "POST", "headers": [], "client": ("203.0.113.7", 1234)})
+    response = db_client.portal.call(server.create_letter_stream, server.LetterCreate(**letter_payload()), request)
+    server.admission.in_flight = 1
+
+    async def body():
+        return [chunk async for chunk in response.body_iterator]
+    received = events(types.SimpleNamespace(text="".join(db_client.portal.call(body))))
+    assert received == [("error", {"detail": "Too many generations in progress, please retry shortly."})]
+    assert server.admission.in_flight == 1
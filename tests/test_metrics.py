@@ -0,0 +1,70 @@
+import re
+
+import pytest
+
+from backend import server
+from tests.conftest import card_payload
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics(monkeypatch):
+    monkeypatch.setattr(server, "request_metrics", server.RequestMetrics())
+
+
+def samples(text: str, name: str) -> dict:
+    found = {}
+    for line in text.splitlines():
+        match = re.fullmatch(rf"valentine_{name}(\{{.*\}})? (\S+)", line)
+        if match:
+            found[match.group(1) or ""] = float(match.group(2))
+    return found
+
+
+def test_requests_are_counted_by_route_template(db_client):
+    card = db_client.post("/api/cards", json=card_payload()).json()
+    for _ in range(2):
+        db_client.get(f"/api/cards/{card['id']}")
+    db_client.get("/api/nothing-here")
+
+    text = db_client.get("/metrics").text
+    requests = samples(text, "http_requests_total")
+    assert requests['{method="POST",route="/api/cards",status="200"}'] == 1
+    assert requests['{method="GET",route="/api/cards/{card_id}",status="200"}'] == 2
+    assert requests['{method="GET",route="unmatched",status="404"}'] == 1
+    assert not any(card["id"] in labels for labels in requests)
+
+
+def test_request_phases_split_llm_and_database_time(db_client):
+    db_client.post("/api/cards", json=card_payload())
+    text = db_client.get("/metrics").text
+
+    phases = samples(text, "http_request_phase_seconds_count")
+    for phase in ("llm", "db", "json"):
+        assert phases[f'{{method="POST",route="/api/cards",phase="{phase}"}}'] == 1
+    assert samples(text, "generations_total")[""] == 1
+    assert samples(text, "gemini_key_calls_total")['{key="TEST_KEY",outcome="success"}'] == 1
+
+
+def test_histograms_are_cumulative(client):
+    for _ in range(3):
+        client.get("/api/")
+    buckets = samples(client.get("/metrics").text, "http_request_duration_seconds_bucket")
+    route = [value for labels, value in buckets.items() if 'route="/api/"' in labels]
+    assert route == sorted(route)
+    assert route[-1] == 3
+
+
+def test_exposition_format_and_label_escaping():
+    out = server.PrometheusExposition("valentine_")
+    out.metric("things_total", "counter", "Things.", [({"name": 'a"b\\c\nd'}, 2)])
+    assert out.render() == (
+        "# HELP valentine_things_total Things.\n"
+        "# TYPE valentine_things_total counter\n"
+        'valentine_things_total{name="a\\"b\\\\c\\nd"} 2\n'
+    )
+
+
+def test_metrics_endpoint_content_type(client):
+    response = client.get("/metrics")
+    assert response.headers["content-type"] == "text/plain; version=0.0.4; charset=utf-8"
+    assert "# TYPE valentine_http_requests_total counter" in response.text
@@ -0,0 +1,129 @@
+import asyncio
+import time
+import uuid
+
+import asyncpg
+import pytest
+from fastapi.testclient import TestClient
+
+from backend import server
+
+
+def migrate(url: str, migrations=None):
+    async def run():
+        conn = await asyncpg.connect(url)
+        try:
+            return await server.run_migrations(conn)
+        finally:
+            await conn.close()
+    if migrations is not None:
+        original, server.MIGRATIONS = server.MIGRATIONS, migrations
+        try:
+            return asyncio.run(run())
+        finally:
+            server.MIGRATIONS = original
+    return asyncio.run(run())
+
+
+def fetch(url: str, sql: str, *args):
+    async def run():
+        conn = await asyncpg.connect(url)
+        try:
+            return await conn.fetch(sql, *args)
+        finally:
+            await conn.close()
+    return asyncio.run(run())
+
+
+def column_type(url: str, table: str) -> str:
+    rows = fetch(url, "SELECT data_type FROM information_schema.columns WHERE table_name = $1 AND column_name = 'id'", table)
+    return rows[0]["data_type"]
+
+
+def test_fresh_database_migrates_to_the_latest_version(database_url):
+    assert migrate(database_url) == server.SCHEMA_VERSION
+    assert migrate(database_url) == server.SCHEMA_VERSION
+    assert column_type(database_url, "valentine_cards") == "uuid"
+    assert column_type(database_url, "love_letters") == "uuid"
+    versions = [row["version"] for row in fetch(database_url, "SELECT version FROM schema_version ORDER BY version")]
+    assert versions == [version for version, _, _ in server.MIGRATIONS]
+
+
+def test_uuid_migration_keeps_existing_rows(database_url):
+    assert migrate(database_url, server.MIGRATIONS[:6]) == 6
+    card_id = str(uuid.uuid4())
+    fetch(database_url, "INSERT INTO valentine_cards (id, girlfriend_name, sender_name, description) VALUES ($1, 'A', 'B', 'C')", card_id)
+
+    assert migrate(database_url) == server.SCHEMA_VERSION
+    assert fetch(database_url, "SELECT id FROM valentine_cards")[0]["id"] == uuid.UUID(card_id)
+
+
+def test_uuid_migration_gives_up_when_the_table_is_busy(database_url, monkeypatch):
+    monkeypatch.setattr(server, "MIGRATION_LOCK_TIMEOUT_MS", 100)
+    assert migrate(database_url, server.MIGRATIONS[:6]) == 6
+
+    async def migrate_while_reading():
+        reader = await asyncpg.connect(database_url)
+        try:
+            async with reader.transaction():
+                await reader.fetch("SELECT * FROM valentine_cards")
+                conn = await asyncpg.connect(database_url)
+                try:
+                    await server.run_migrations(conn)
+                finally:
+                    await conn.close()
+        finally:
+            await reader.close()
+
+    with pytest.raises(asyncpg.LockNotAvailableError):
+        asyncio.run(migrate_while_reading())
+    assert column_type(database_url, "valentine_cards") == "character varying"
+    assert fetch(database_url, "SELECT MAX(version) AS version FROM schema_version")[0]["version"] == 6
+
+
+def test_uuid7_ids_are_time_ordered_and_versioned():
+    before = time.time_ns() // 1_000_000
+    ids = [server.uuid7() for _ in range(1000)]
+    after = time.time_ns() // 1_000_000
+
+    assert all(value.version == 7 and value.variant == uuid.RFC_4122 for value in ids)
+    assert all(before <= value.int >> 80 <= after for value in ids)
+    assert len(set(ids)) == len(ids)
+    assert [value.int >> 80 for value in ids] == sorted(value.int >> 80 for value in ids)
+
+
+def test_canonical_id_normalizes_or_rejects():
+    value = server.uuid7()
+    assert server.canonical_id(str(value).upper()) == str(value)
+    assert server.canonical_id(value.hex) == str(value)
+    assert server.canonical_id("not-a-uuid") is None
+    assert server.canonical_id("") is None
+
+
+def test_concurrent_runners_apply_each_migration_once(database_url):
+    async def run_concurrently():
+        conns = [await asyncpg.connect(database_url) for _ in range(3)]
+        try:
+            return await asyncio.gather(*(server.run_migrations(conn) for conn in conns))
+        finally:
+            for conn in conns:
+                await conn.close()
+
+    assert asyncio.run(run_concurrently()) == [server.SCHEMA_VERSION] * 3
+    assert len(fetch(database_url, "SELECT version FROM schema_version")) == len(server.MIGRATIONS)
+
+
+def test_failed_migration_rolls_back_and_stops(database_url):
+    broken = [*server.MIGRATIONS[:2], (3, "broken", "CREATE TABLE half_done (id INT); SELECT missing_column FROM idempotency_keys;")]
+    with pytest.raises(asyncpg.UndefinedColumnError):
+        migrate(database_url, broken)
+    assert fetch(database_url, "SELECT MAX(version) AS version FROM schema_version")[0]["version"] == 2
+    assert not fetch(database_url, "SELECT 1 FROM information_schema.tables WHERE table_name = 'half_done'")
+
+
+def test_workers_do_not_migrate_unless_told_to(database_url, gemini, monkeypatch, caplog):
+    monkeypatch.setattr(server, "RUN_MIGRATIONS_ON_STARTUP", False)
+    with TestClient(server.app):
+        pass
+    assert not fetch(database_url, "SELECT 1 FROM information_schema.tables WHERE table_name = 'valentine_cards'")
+    assert f"expected {server.SCHEMA_VERSION}" in caplog.text
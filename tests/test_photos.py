@@ -0,0 +1,59 @@
+import base64
+import hashlib
+
+from backend import server
+from tests.conftest import card_payload
+from tests.test_uploads import jpeg_bytes
+
+
+def data_url(data: bytes) -> str:
+    return "data:image/jpeg;base64," + base64.b64encode(data).decode()
+
+
+def test_inline_photos_are_stored_once_by_content_digest(db_client):
+    photo = jpeg_bytes(color=(12, 200, 90))
+    digest = hashlib.sha256(photo).hexdigest()
+    first = db_client.post("/api/cards", json=card_payload(photos=[data_url(photo)])).json()
+    second = db_client.post("/api/cards", json=card_payload(photos=[data_url(photo), f"{server.PHOTO_URL_PREFIX}{digest}"])).json()
+
+    assert first["photos"] == [f"{server.PHOTO_URL_PREFIX}{digest}"]
+    assert second["photos"] == [f"{server.PHOTO_URL_PREFIX}{digest}"] * 2
+    stored = [path for path in server.blob_store.root.rglob(f"{digest}*")]
+    assert len(stored) == len(server.IMAGE_VARIANTS)
+
+
+def test_photos_are_served_immutable_with_etags(db_client):
+    url = db_client.post("/api/cards", json=card_payload(photos=[data_url(jpeg_bytes(color=(1, 1, 1)))])).json()["photos"][0]
+    response = db_client.get(url)
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == server.PHOTO_CACHE_CONTROL
+    assert response.headers["content-type"] == "image/webp"
+    assert db_client.get(url, headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+
+
+def test_legacy_blobs_without_variants_are_still_served(db_client):
+    data = jpeg_bytes(color=(5, 6, 7))
+    digest = hashlib.sha256(data).hexdigest()
+    db_client.portal.call(server.blob_store.put, digest, data)
+
+    response = db_client.get(f"{server.PHOTO_URL_PREFIX}{digest}")
+    assert response.content == data
+    assert response.headers["etag"] == f'"{digest}"'
+
+
+def test_invalid_photo_inputs_are_rejected(db_client):
+    for photos, detail in (
+        (["https://example.com/a.jpg"], "Photos must be base64 image data URLs"),
+        (["data:image/png;base64,@@@@"], "Invalid base64 photo data"),
+        ([data_url(b"not an image")], "Invalid image"),
+        ([f"{server.PHOTO_URL_PREFIX}{'f' * 64}"], "Unknown photo reference"),
+    ):
+        response = db_client.post("/api/cards", json=card_payload(photos=photos))
+        assert response.status_code == 400
+        assert response.json()["detail"].startswith(detail)
+
+
+def test_unknown_digests_and_variants_are_404(client):
+    assert client.get(f"{server.PHOTO_URL_PREFIX}{'0' * 64}").status_code == 404
+    assert client.get(f"{server.PHOTO_URL_PREFIX}not-a-digest").status_code == 404
+    assert client.get(f"{server.PHOTO_URL_PREFIX}{'0' * 64}?variant=huge").status_code == 404
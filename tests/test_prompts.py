@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import types
+
+from google import genai
+
+from backend import server
+from tests.test_launcher import run_python
+
+DEFAULT_LETTER_TOKENS = {"love": 900, "proposal": 1200, "custom": 1200}
+
+
+def test_output_token_overrides_apply_valid_entries():
+    overrides = server.parse_output_token_overrides(" proposal=1500 , custom = 2000,", DEFAULT_LETTER_TOKENS)
+    assert overrides == {"proposal": 1500, "custom": 2000}
+
+
+def test_output_token_overrides_skip_malformed_entries(caplog):
+    with caplog.at_level(logging.WARNING, logger=server.logger.name):
+        overrides = server.parse_output_token_overrides(
+            "proposal=lots,love=-5,breakup=900,custom,love=1000", DEFAULT_LETTER_TOKENS
+        )
+    assert overrides == {"love": 1000}
+    assert caplog.text.count("Ignoring LETTER_MAX_OUTPUT_TOKENS entry") == 4
+
+
+def test_malformed_output_token_setting_does_not_break_startup():
+    code = "from backend import server; print(server.letter_output_tokens('proposal'), server.letter_output_tokens('love'))"
+    assert run_python(code, LETTER_MAX_OUTPUT_TOKENS="proposal=1e3,love=950") == "1200 950"
+
+
+def test_unknown_letter_types_use_the_love_cap():
+    assert server.letter_output_tokens("nonsense") == server.LETTER_OUTPUT_TOKENS["love"]
+
+
+def test_fit_prompt_input_keeps_short_values():
+    assert server.fit_prompt_input("context", "  We met\n in   Paris ", 10) == "We met in Paris"
+    assert server.key_scheduler.prompt_trims == {}
+
+
+def test_fit_prompt_input_cuts_at_a_sentence_within_budget():
+    text = "We met in Paris. " * 20 + "Then we moved to Rome"
+    fitted = server.fit_prompt_input("context", text, 20)
+    assert fitted.endswith("Paris. [...]")
+    assert len(fitted) <= 20 * server.PROMPT_CHARS_PER_TOKEN + len(" [...]")
+    assert server.key_scheduler.prompt_trims == {"context": 1}
+
+
+def test_fit_prompt_input_falls_back_to_a_word_boundary():
+    assert server.fit_prompt_input("name", "Anastasia " * 10, 4) == "Anastasia [...]"
+
+
+def test_letter_prompt_is_bounded_by_its_input_budgets():
+    huge = "word " * 10_000
+    system_instruction, prompt = server.build_letter_prompt("love", huge, huge, huge, "unknown-tone", huge)
+    assert system_instruction == server.LETTER_SYSTEM_INSTRUCTIONS["romantic"]
+    budget = server.PROMPT_CONTEXT_TOKENS + server.PROMPT_CUSTOM_TOKENS + 2 * server.PROMPT_NAME_TOKENS
+    assert server.estimate_tokens(prompt) < budget + 200
+    assert set(server.key_scheduler.prompt_trims) == {"name", "context", "custom_prompt"}
+
+
+def test_trim_partial_sentence():
+    assert server.trim_partial_sentence("I love you. You are my sun. And the") == "I love you. You are my sun."
+    assert server.trim_partial_sentence('She said "yes!" and then') == 'She said "yes!"'
+    assert server.trim_partial_sentence("Hi. A much longer unfinished thought") == "Hi. A much longer unfinished thought"
+
+
+def test_truncated_prose_is_cut_back_and_capped(gemini):
+    gemini.models.text = "Dear Zoe, you are wonderful. I think of you every"
+    response = gemini.models.generate_content
+
+    async def truncated(model, contents, config=None):
+        reply = await response(model, contents, config)
+        reply.candidates = [types.SimpleNamespace(finish_reason=genai.types.FinishReason.MAX_TOKENS)]
+        return reply
+    gemini.models.generate_content = truncated
+
+    state = server.key_scheduler.states[0]
+    text = asyncio.run(server.key_scheduler.generate(state, "letter", "prompt", "system", 321))
+    assert text == "Dear Zoe, you are wonderful."
+    assert gemini.models.calls[0][1].max_output_tokens == 321
+    assert server.key_scheduler.tokens["letter"]["truncated"] == 1
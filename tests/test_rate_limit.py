@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from backend import server
+from tests.conftest import card_payload
+
+
+def make_request(host: str = "203.0.113.7", headers: dict = None) -> Request:
+    return Request({
+        "type": "http",
+        "method": "POST",
+        "path": "/api/cards",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+        "client": (host, 1234),
+    })
+
+
+def test_cost_above_burst_is_charged_a_full_bucket():
+    limiter = server.RateLimiter("memory", 6, 10, 100)
+    asyncio.run(limiter.check(make_request(), 25))
+    assert limiter.buckets["ip:203.0.113.7"][0] == 0
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(limiter.check(make_request(), 1))
+    assert raised.value.status_code == 429
+
+
+def test_full_burst_drains_the_bucket():
+    limiter = server.RateLimiter("memory", 6, 10, 100)
+    asyncio.run(limiter.check(make_request(), 10))
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(limiter.check(make_request(), 1))
+    assert raised.value.status_code == 429
+    assert int(raised.value.headers["Retry-After"]) >= 1
+
+
+def test_disabled_limiter_allows_any_cost():
+    asyncio.run(server.RateLimiter("off", 6, 10, 100).check(make_request(), 1000))
+
+
+def test_batch_larger_than_burst_succeeds(db_client):
+    cards = [card_payload(description=f"d{i}") for i in range(server.RATE_LIMIT_BURST + 5)]
+    response = db_client.post("/api/cards/batch", json={"cards": cards})
+    assert response.status_code == 200
+    assert response.text.splitlines()[-1] == f'{{"done":true,"succeeded":{len(cards)},"failed":0}}'
+    assert db_client.post("/api/cards", json=card_payload()).status_code == 429
+
+
+def test_batch_items_each_hold_an_admission_slot(db_client, gemini, monkeypatch):
+    monkeypatch.setattr(server, "admission", server.AdmissionControl(2))
+    gemini.models.delay = 0.05
+    observed = []
+    generate_content = gemini.models.generate_content
+
+    async def tracking_generate_content(*args, **kwargs):
+        observed.append(server.admission.in_flight)
+        return await generate_content(*args, **kwargs)
+
+    monkeypatch.setattr(gemini.models, "generate_content", tracking_generate_content)
+    response = db_client.post("/api/cards/batch", json={"cards": [card_payload(description=f"d{i}") for i in range(6)]})
+
+    assert response.status_code == 200
+    assert response.text.splitlines()[-1] == '{"done":true,"succeeded":6,"failed":0}'
+    assert len(observed) == 6
+    assert max(observed) == 2
+    assert server.admission.in_flight == 0
+    assert server.admission.admitted == 6
+
+
+def test_batch_is_refused_when_generation_slots_are_full(db_client, monkeypatch):
+    monkeypatch.setattr(server, "admission", server.AdmissionControl(1))
+    server.admission.in_flight = 1
+    response = db_client.post("/api/cards/batch", json={"cards": [card_payload()]})
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
+
+
+def test_client_key_uses_trusted_forwarded_hop(monkeypatch):
+    monkeypatch.setattr(server, "RATE_LIMIT_PROXY_HOPS", 1)
+    request = make_request(host="10.0.0.1", headers={"X-Forwarded-For": "198.51.100.9, 192.0.2.44"})
+    assert server.client_key(request) == "ip:192.0.2.44"
+
+
+def test_clients_behind_a_proxy_get_separate_buckets(monkeypatch):
+    monkeypatch.setattr(server, "RATE_LIMIT_PROXY_HOPS", 1)
+    limiter = server.RateLimiter("memory", 6, 2, 100)
+    first = make_request(host="10.0.0.1", headers={"X-Forwarded-For": "192.0.2.1"})
+    second = make_request(host="10.0.0.1", headers={"X-Forwarded-For": "192.0.2.2"})
+    asyncio.run(limiter.check(first, 2))
+    asyncio.run(limiter.check(second, 2))
+    with pytest.raises(HTTPException):
+        asyncio.run(limiter.check(first, 1))
+
+
+def test_untrusted_forwarded_header_is_ignored_with_a_warning(monkeypatch, caplog):
+    monkeypatch.setattr(server, "RATE_LIMIT_PROXY_HOPS", 0)
+    server.warn_shared_proxy_bucket.cache_clear()
+    request = make_request(host="10.0.0.1", headers={"X-Forwarded-For": "192.0.2.1"})
+    with caplog.at_level("WARNING"):
+        assert server.client_key(request) == "ip:10.0.0.1"
+        server.client_key(request)
+    assert sum("RATE_LIMIT_PROXY_HOPS" in record.message for record in caplog.records) == 1
+
+
+def test_api_token_gets_its_own_bucket(monkeypatch):
+    monkeypatch.setattr(server, "API_TOKENS", {"secret"})
+    request = make_request(headers={"Authorization": "Bearer secret"})
+    assert server.client_key(request).startswith("token:")
+    assert server.client_key(make_request(headers={"Authorization": "Bearer other"})) == "ip:203.0.113.7"
@@ -0,0 +1,112 @@
+import asyncio
+
+import asyncpg
+
+from backend import server
+from tests.conftest import card_payload, letter_payload
+from tests.test_uploads import jpeg_bytes
+
+
+def run_sql(url: str, sql: str, *args):
+    async def execute():
+        conn = await asyncpg.connect(url)
+        try:
+            return await conn.execute(sql, *args)
+        finally:
+            await conn.close()
+    return asyncio.run(execute())
+
+
+def upload(client, color) -> str:
+    response = client.post("/api/photos", files=[("photo", ("a.jpg", jpeg_bytes(color=color), "image/jpeg"))])
+    assert response.status_code == 200
+    return response.json()["photos"][0]
+
+
+def test_unreferenced_uploads_are_collected_after_the_grace_period(db_client, database_url, monkeypatch):
+    monkeypatch.setattr(server, "UPLOAD_ORPHAN_HOURS", 24)
+    orphan = upload(db_client, (1, 2, 3))
+    kept = upload(db_client, (4, 5, 6))
+    fresh = upload(db_client, (7, 8, 9))
+    assert db_client.post("/api/cards", json=card_payload(photos=[kept])).status_code == 200
+    run_sql(database_url, "UPDATE photo_uploads SET uploaded_at = NOW() - interval '2 days' WHERE digest <> $1",
+            fresh.rsplit("/", 1)[1])
+
+    db_client.portal.call(server.retention_job.sweep)
+
+    assert db_client.get(orphan).status_code == 404
+    assert db_client.get(kept).status_code == 200
+    assert db_client.get(fresh).status_code == 200
+    assert server.retention_job.uploads == 2
+    assert server.retention_job.blobs == 1
+
+
+def test_photo_uploads_are_rate_limited(client, monkeypatch):
+    monkeypatch.setattr(server, "rate_limiter", server.RateLimiter("memory", 6, 1, 100))
+    assert client.post("/api/photos", files=[("photo", ("a.jpg", jpeg_bytes(), "image/jpeg"))]).status_code == 200
+    response = client.post("/api/photos", files=[("photo", ("a.jpg", jpeg_bytes(), "image/jpeg"))])
+    assert response.status_code == 429
+
+
+def test_expired_cards_and_letters_are_deleted_in_batches(db_client, database_url, monkeypatch):
+    monkeypatch.setattr(server, "retention_job", server.RetentionJob(30))
+    monkeypatch.setattr(server, "RETENTION_BATCH_SIZE", 2)
+    monkeypatch.setattr(server, "RETENTION_BATCH_PAUSE", 0)
+    expired_only = upload(db_client, (10, 20, 30))
+    shared = upload(db_client, (40, 50, 60))
+    old_cards = [
+        db_client.post("/api/cards", json=card_payload(photos=[expired_only, shared]), headers={"Idempotency-Key": f"k{i}"}).json()
+        for i in range(3)
+    ]
+    old_letter = db_client.post("/api/letters", json=letter_payload()).json()
+    for resource in (*old_cards, old_letter):
+        path = "cards" if "poem" in resource else "letters"
+        assert db_client.get(f"/api/{path}/{resource['id']}").status_code == 200
+    run_sql(database_url, "UPDATE valentine_cards SET created_at = NOW() - interval '31 days'")
+    run_sql(database_url, "UPDATE love_letters SET created_at = NOW() - interval '31 days'")
+    run_sql(database_url, "UPDATE idempotency_keys SET created_at = NOW() - interval '31 days'")
+    fresh = db_client.post("/api/cards", json=card_payload(photos=[shared])).json()
+
+    db_client.portal.call(server.retention_job.sweep)
+
+    assert all(db_client.get(f"/api/cards/{card['id']}").status_code == 404 for card in old_cards)
+    assert db_client.get(f"/api/letters/{old_letter['id']}").status_code == 404
+    assert db_client.get(f"/api/cards/{fresh['id']}").status_code == 200
+    assert db_client.get(expired_only).status_code == 404
+    assert db_client.get(shared).status_code == 200
+    assert server.retention_job.deleted == {"card": 3, "letter": 1}
+    assert server.retention_job.idempotency_keys == 3
+    assert server.retention_job.blobs == 1
+
+
+def test_expired_ids_are_discarded_from_every_worker_cache(db_client, database_url, monkeypatch):
+    monkeypatch.setattr(server, "retention_job", server.RetentionJob(30))
+    monkeypatch.setattr(server, "CLUSTER_IDS_PER_EVENT", 2)
+    monkeypatch.setattr(server, "CLUSTER_EVENTS", True)
+    db_client.portal.call(server.cluster_events.start)
+    cards = [db_client.post("/api/cards", json=card_payload(description=f"d{i}")).json() for i in range(3)]
+    run_sql(database_url, "UPDATE valentine_cards SET created_at = NOW() - interval '31 days'")
+
+    async def sweep_and_collect():
+        received = []
+        listener = await asyncpg.connect(database_url)
+        await listener.add_listener(server.CLUSTER_CHANNEL, lambda conn, pid, channel, payload: received.append(payload))
+        try:
+            await server.retention_job.sweep()
+            await asyncio.sleep(0.2)
+        finally:
+            await listener.close()
+        return received
+
+    received = db_client.portal.call(sweep_and_collect)
+    messages = [server.json.loads(payload) for payload in received]
+    assert [len(message["ids"]) for message in messages] == [2, 1]
+    assert {resource_id for message in messages for resource_id in message["ids"]} == {card["id"] for card in cards}
+
+    # Another worker shares the handlers but not the origin, so it acts on the sweeper's events
+    monkeypatch.setattr(server.cluster_events, "origin", "other-worker")
+    for card in cards:
+        server.response_cache.put(f"card:{card['id']}", b"{}")
+    for payload in received:
+        server.cluster_events.dispatch(None, 0, server.CLUSTER_CHANNEL, payload)
+    assert all(server.response_cache.get(f"card:{card['id']}") is None for card in cards)
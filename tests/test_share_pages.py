@@ -0,0 +1,85 @@
+import io
+import json
+import re
+
+from PIL import Image
+
+from backend import server
+from tests.conftest import card_payload, letter_payload
+from tests.test_retention import upload
+
+INDEX = b'<html><head><title>App</title><meta name="description" content="default" /></head><body><div id="root"></div></body></html>'
+HOSTILE_NAME = '</script><script>alert(1)</script>'
+
+
+def page_request(*headers):
+    return server.Request({
+        "type": "http", "method": "GET", "scheme": "https", "server": ("valentine.test", 443), "path": "/",
+        "root_path": "", "query_string": b"", "headers": [(name.encode(), value.encode()) for name, value in headers],
+    })
+
+
+def use_index(monkeypatch, tmp_path):
+    (tmp_path / "index.html").write_bytes(INDEX)
+    manifest = server.StaticManifest(tmp_path)
+    manifest.build()
+    monkeypatch.setattr(server, "static_manifest", manifest)
+
+
+def inline_data(page: str) -> dict:
+    return json.loads(re.search(r"window.__INITIAL_DATA__=(.*?)</script>", page).group(1))
+
+
+def test_share_page_embeds_the_letter_and_open_graph_tags(db_client, monkeypatch, tmp_path):
+    use_index(monkeypatch, tmp_path)
+    letter = db_client.post("/api/letters", json=letter_payload(recipient_name=HOSTILE_NAME)).json()
+
+    response = db_client.portal.call(server.share_page_response, "letter", letter["id"], page_request())
+    page = response.body.decode()
+    assert f"<title>A letter for {server.html.escape(HOSTILE_NAME)}</title>" in page
+    assert f'content="https://valentine.test/api/letters/{letter["id"]}/og.jpg"' in page
+    assert page.count("<script>") == 1
+    assert inline_data(page) == {"kind": "letter", "resource": letter}
+    assert "<noscript><article>" in page
+    assert response.headers["cache-control"] == server.INDEX_CACHE_CONTROL
+
+    assert db_client.portal.call(server.blob_store.exists, f"share.letter.{letter['id']}")
+    revalidation = page_request(("if-none-match", response.headers["etag"]))
+    assert db_client.portal.call(server.share_page_response, "letter", letter["id"], revalidation).status_code == 304
+
+
+def test_unknown_or_pending_resources_get_the_plain_index(db_client, monkeypatch, tmp_path):
+    use_index(monkeypatch, tmp_path)
+    pending = db_client.post("/api/cards?async=1", json=card_payload()).json()
+    for resource_id in ("not-an-id", pending["id"]):
+        response = db_client.portal.call(server.share_page_response, "card", resource_id, page_request())
+        assert response.body == INDEX
+
+
+def test_og_image_is_rendered_once_with_the_first_photo(db_client, monkeypatch):
+    photo = upload(db_client, (200, 40, 90))
+    card = db_client.post("/api/cards", json=card_payload(photos=[photo])).json()
+
+    response = db_client.get(f"/api/cards/{card['id']}/og.jpg")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    assert Image.open(io.BytesIO(response.content)).size == server.OG_IMAGE_SIZE
+
+    monkeypatch.setattr(server, "render_og_image", None)
+    assert db_client.get(f"/api/cards/{card['id']}/og.jpg").content == response.content
+    assert db_client.get(f"/api/cards/{card['id']}/og.jpg", headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+
+
+def test_og_image_waits_for_ready_content(db_client):
+    pending = db_client.post("/api/letters?async=1", json=letter_payload()).json()
+    assert db_client.get(f"/api/letters/{pending['id']}/og.jpg").status_code == 404
+
+
+def test_backslashes_in_user_text_are_kept_literally(db_client, monkeypatch, tmp_path):
+    use_index(monkeypatch, tmp_path)
+    letter = db_client.post("/api/letters", json=letter_payload(recipient_name="Zoe \\o/ \\1")).json()
+
+    for _ in range(2):
+        response = db_client.portal.call(server.share_page_response, "letter", letter["id"], page_request())
+        assert response.status_code == 200
+        assert "<title>A letter for Zoe \\o/ \\1</title>" in response.body.decode()
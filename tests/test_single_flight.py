@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from backend import server
+from tests.conftest import card_payload, letter_payload
+
+
+def test_concurrent_calls_share_one_task():
+    flights = server.SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "done"
+
+    async def run():
+        return await asyncio.gather(*(flights.run("key", work) for _ in range(5)))
+
+    assert asyncio.run(run()) == ["done"] * 5
+    assert calls == [1]
+    assert flights.coalesced == 4
+    assert flights.calls == {}
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_task():
+    flights = server.SingleFlight()
+
+    async def run():
+        first = asyncio.ensure_future(flights.run("key", lambda: asyncio.sleep(0.02, "value")))
+        second = asyncio.ensure_future(flights.run("key", lambda: asyncio.sleep(0.02, "other")))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == "value"
+
+
+def test_errors_reach_every_waiter_and_are_not_cached():
+    flights = server.SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    async def run():
+        results = await asyncio.gather(flights.run("key", fail), flights.run("key", fail), return_exceptions=True)
+        return results, await flights.run("key", lambda: asyncio.sleep(0, "retry"))
+
+    results, retry = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert retry == "retry"
+
+
+def test_identical_generations_reach_gemini_once(gemini):
+    gemini.models.delay = 0.05
+
+    async def run():
+        return await asyncio.gather(*(
+            server.generate_romantic_content("Ana", "Loves hiking", "Ben", use_cache=False) for _ in range(4)
+        ))
+
+    assert len({content.poem for content in asyncio.run(run())}) == 1
+    assert len(gemini.models.calls) == 1
+
+
+def test_idempotency_key_replays_the_same_card(db_client, gemini):
+    headers = {"Idempotency-Key": "order-42"}
+    first = db_client.post("/api/cards", json=card_payload(), headers=headers)
+    second = db_client.post("/api/cards", json=card_payload(), headers=headers)
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert len(gemini.models.calls) == 1
+
+
+@pytest.mark.parametrize("path, payload", [("/api/cards", card_payload()), ("/api/letters", letter_payload())])
+def test_idempotency_key_is_bounded(db_client, path, payload):
+    assert db_client.post(path, json=payload, headers={"Idempotency-Key": "x" * 256}).status_code == 422
+    assert db_client.post(path, json=payload, headers={"Idempotency-Key": "x" * 255}).status_code == 200
+
+
+@pytest.mark.parametrize("path, payload, changed", [
+    ("/api/cards", card_payload(), card_payload(description="Changed")),
+    ("/api/letters", letter_payload(), letter_payload(context="Changed")),
+])
+def test_reused_idempotency_key_with_a_different_body_is_rejected(db_client, path, payload, changed):
+    headers = {"Idempotency-Key": "order-43"}
+    first = db_client.post(path, json=payload, headers=headers)
+    assert first.status_code == 200
+    rejected = db_client.post(path, json=changed, headers=headers)
+    assert rejected.status_code == 422
+    assert rejected.json()["detail"] == "Idempotency-Key was already used with a different request body"
+    assert db_client.post(path, json=payload, headers=headers).json() == first.json()
+
+
+def test_racing_requests_with_different_bodies_do_not_share_a_result(db_client, gemini):
+    gemini.models.delay = 0.1
+    request = server.Request({"type": "http", "headers": [], "client": ("203.0.113.7", 1234)})
+
+    async def race():
+        return await asyncio.gather(*(
+            server.create_card(server.CardCreate(**payload), request, "order-44", False)
+            for payload in (card_payload(), card_payload(description="Changed"))
+        ), return_exceptions=True)
+
+    results = db_client.portal.call(race)
+    assert sum(isinstance(result, server.HTTPException) and result.status_code == 422 for result in results) == 1
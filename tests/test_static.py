@@ -0,0 +1,67 @@
+import gzip
+
+import pytest
+from fastapi import HTTPException
+
+from backend import server
+
+INDEX = b"<html><head><title>Valentine</title></head><body><div id=root></div></body></html>" * 20
+SCRIPT = b"console.log('hello valentine');\n" * 100
+
+
+def request(*headers):
+    return server.Request({"type": "http", "headers": [(name.encode(), value.encode()) for name, value in headers]})
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    (tmp_path / "static" / "js").mkdir(parents=True)
+    (tmp_path / "index.html").write_bytes(INDEX)
+    (tmp_path / "static" / "js" / "main.js").write_bytes(SCRIPT)
+    (tmp_path / "favicon.ico").write_bytes(b"icon")
+    assert server.precompress_static(tmp_path) == 2 * len(server.available_encodings())
+    manifest = server.StaticManifest(tmp_path)
+    manifest.build()
+    return manifest
+
+
+def test_precompressed_variants_are_served_and_not_listed_as_assets(manifest):
+    assert set(manifest.assets) == {"index.html", "static/js/main.js", "favicon.ico"}
+    response = manifest.response(request(("accept-encoding", "gzip")), "static/js/main.js")
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["cache-control"] == server.STATIC_IMMUTABLE_CACHE_CONTROL
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert gzip.decompress(open(response.path, "rb").read()) == SCRIPT
+
+
+def test_assets_revalidate_with_their_etag(manifest):
+    etag = manifest.response(request(), "favicon.ico").headers["etag"]
+    response = manifest.response(request(("if-none-match", etag)), "favicon.ico")
+    assert response.status_code == 304
+    assert response.headers["cache-control"] == f"public, max-age={server.STATIC_MAX_AGE}"
+
+
+def test_client_routes_fall_back_to_an_uncached_index(manifest):
+    response = manifest.response(request(("accept-encoding", "br")), "card/123")
+    assert response.headers["cache-control"] == server.INDEX_CACHE_CONTROL
+    assert response.headers["content-encoding"] == "br"
+    assert server.brotli.decompress(response.body) == INDEX
+    revalidation = request(("accept-encoding", "br"), ("if-none-match", response.headers["etag"]))
+    assert manifest.response(revalidation, "letter/9").status_code == 304
+
+
+@pytest.mark.parametrize("path", ["static/js/missing.js", "api/unknown", "robots.txt"])
+def test_missing_files_are_404_instead_of_the_index(manifest, path):
+    with pytest.raises(HTTPException) as raised:
+        manifest.response(request(), path)
+    assert raised.value.status_code == 404
+
+
+def test_stale_precompressed_variants_are_ignored(manifest, tmp_path):
+    script = tmp_path / "static" / "js" / "main.js"
+    gz = script.with_name("main.js.gz")
+    stat = gz.stat()
+    script.write_bytes(SCRIPT + b"// changed\n")
+    server.os.utime(script, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    manifest.build()
+    assert "gzip" not in manifest.assets["static/js/main.js"].encodings
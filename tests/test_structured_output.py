@@ -0,0 +1,75 @@
+import asyncio
+import json
+import types
+
+import pytest
+
+from backend import server
+from tests.conftest import CARD_JSON
+
+
+def generate_card():
+    return asyncio.run(server.generate_romantic_content("Ana", "Loves hiking", "Ben"))
+
+
+def reply_with(gemini, *texts):
+    replies = iter(texts)
+
+    async def generate_content(model, contents, config=None):
+        gemini.models.calls.append((contents, config))
+        return types.SimpleNamespace(text=next(replies), usage_metadata=None, candidates=None)
+    gemini.models.generate_content = generate_content
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('```json\n{"a": 1}\n```', {"a": 1}),
+    ('{"a": [1, 2,], "b": 3,}', {"a": [1, 2], "b": 3}),
+    ('{"a": "cut off mid', {"a": "cut off mid"}),
+    ('{"a": ["x", "y"', {"a": ["x", "y"]}),
+    ('{"a": "line\nbreak"}', {"a": "line\nbreak"}),
+    ('{"a": "brace } in string"}', {"a": "brace } in string"}),
+    ('{"a":', {"a": None}),
+    ('{"a": "esc\\', {"a": "esc"}),
+    ('{"a": 1}} trailing', {"a": 1}),
+])
+def test_repair_json(text, expected):
+    assert json.loads(server.repair_json(text)) == expected
+
+
+def test_repair_json_needs_an_object():
+    with pytest.raises(ValueError):
+        server.repair_json("Sorry, I cannot help with that")
+
+
+def test_valid_content_is_parsed_without_repair():
+    assert server.parse_generated_content(CARD_JSON).poem == "Roses are red"
+    assert server.key_scheduler.repairs == {"local": 0, "retry": 0, "failed": 0}
+
+
+def test_truncated_content_is_repaired_locally():
+    content = server.parse_generated_content('Here you go: {"poem": "Roses", "love_notes": ["a", "b",], "scratch_message": "Be mi')
+    assert content.love_notes == ["a", "b"]
+    assert content.scratch_message == "Be mi"
+    assert server.key_scheduler.repairs["local"] == 1
+
+
+def test_card_requests_schema_bound_json(gemini):
+    assert generate_card().poem == "Roses are red"
+    config = gemini.models.calls[0][1]
+    assert config.response_mime_type == "application/json"
+    assert config.response_schema is server.GeneratedContent
+
+
+def test_unparseable_reply_is_repaired_by_the_same_key(gemini):
+    reply_with(gemini, '{"poem": "Roses"}', CARD_JSON)
+    assert generate_card().scratch_message == "Be mine"
+    assert len(gemini.models.calls) == 2
+    assert '{"poem": "Roses"}' in gemini.models.calls[1][0]
+    assert server.key_scheduler.repairs["retry"] == 1
+
+
+def test_failed_repair_makes_generation_unavailable(gemini):
+    reply_with(gemini, "no json here", "still none")
+    with pytest.raises(server.GenerationUnavailable):
+        generate_card()
+    assert server.key_scheduler.repairs["failed"] == 1
@@ -0,0 +1,66 @@
+import io
+
+from PIL import Image
+
+from backend import server
+
+
+def jpeg_bytes(color=(200, 30, 40), size=(64, 48)) -> bytes:
+    output = io.BytesIO()
+    Image.new("RGB", size, color).save(output, format="JPEG")
+    return output.getvalue()
+
+
+def test_malformed_multipart_body_is_a_400(client):
+    response = client.post(
+        "/api/photos", content=b"garbage", headers={"Content-Type": "multipart/form-data; boundary=zz"}
+    )
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Malformed multipart body"
+
+
+def test_missing_boundary_is_a_400(client):
+    response = client.post("/api/photos", content=b"--zz--", headers={"Content-Type": "multipart/form-data"})
+    assert response.status_code == 400
+
+
+def test_multipart_upload_returns_photo_references(client):
+    response = client.post("/api/photos", files=[
+        ("photo", ("a.jpg", jpeg_bytes(), "image/jpeg")),
+        ("photo", ("b.jpg", jpeg_bytes(color=(10, 90, 200)), "image/jpeg")),
+    ])
+    assert response.status_code == 200
+    photos = response.json()["photos"]
+    assert len(photos) == 2
+    assert all(server.DIGEST_RE.match(photo[len(server.PHOTO_URL_PREFIX):]) for photo in photos)
+    assert client.get(photos[0]).headers["content-type"].startswith("image/")
+
+
+def test_too_many_photos_is_a_413(client, monkeypatch):
+    monkeypatch.setattr(server, "UPLOAD_MAX_PHOTOS", 1)
+    response = client.post("/api/photos", files=[
+        ("photo", ("a.jpg", jpeg_bytes(), "image/jpeg")),
+        ("photo", ("b.jpg", jpeg_bytes(), "image/jpeg")),
+    ])
+    assert response.status_code == 413
+
+
+def test_format_bytes_never_reports_zero():
+    assert server.format_bytes(10 * 1024 * 1024) == "10MB"
+    assert server.format_bytes(1536 * 1024) == "1.5MB"
+    assert server.format_bytes(500 * 1024) == "500KB"
+    assert server.format_bytes(1000) == "1000 bytes"
+
+
+def test_photo_over_a_sub_megabyte_cap_names_the_limit(client, monkeypatch):
+    monkeypatch.setattr(server, "UPLOAD_MAX_PHOTO_BYTES", 512)
+    response = client.post("/api/photos", files=[("photo", ("a.jpg", jpeg_bytes(size=(256, 256)), "image/jpeg"))])
+    assert response.status_code == 413
+    assert response.json()["detail"] == "Photos must be at most 512 bytes each"
+
+
+def test_request_body_cap_names_the_limit(client, monkeypatch):
+    monkeypatch.setattr(server, "UPLOAD_MAX_REQUEST_BYTES", 100 * 1024)
+    response = client.post("/api/photos", content=b"x" * (200 * 1024), headers={"Content-Type": "image/jpeg"})
+    assert response.status_code == 413
+    assert response.json()["detail"] == "Request body must be at most 100KB"